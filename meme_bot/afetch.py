@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+afetch.py – asyncio twin of meme_fetcher_4.main() for meme_bot
+
+• sources and downloads use one shared httpx.AsyncClient (httpx already ships
+  with python-telegram-bot), so a slow source holds a socket, not a thread
+• pyodbc calls run on DB_EXEC, a dedicated executor sized to the connection
+  pool; each step borrows a pooled connection only for its own duration
+• every source has an in-flight limit and a bounded wait queue – when both
+  are full the source is skipped for that request instead of piling up
+• breakers, scoring, CAND_CACHE, the blacklist and journaling are the ones
+  from meme_fetcher_4; the sync API there stays as it is for the CLI
+"""
+
+import os, time, random, hashlib, asyncio, logging, tempfile, functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from urllib.parse import quote_plus
+
+import httpx
+import meme_fetcher_4 as mf
+import profiling
+from profiling import traced
+from metrics import STAGE, NEAR_DUP, QUEUE, COALESCED, executor_depth
+
+log = logging.getLogger("afetch")
+
+# ─── CONFIG ─────────────────────────────────────────────────────────────────
+ASYNC_FETCH   = os.getenv("ASYNC_FETCH","1")=="1"          # 0 = mf.main() on a thread
+HTTP_MAX_CONN = int(os.getenv("HTTP_MAX_CONN","200"))      # sockets across all sources
+SRC_INFLIGHT  = int(os.getenv("SRC_INFLIGHT","32"))        # per source
+SRC_QUEUE     = int(os.getenv("SRC_QUEUE","64"))           # waiting beyond that → skip
+SRC_LIMITS    = dict((k, int(v)) for k, v in (                  # e.g. "reddit=8,giphy=16"
+    p.split("=") for p in os.getenv("SRC_LIMITS","").split(",") if "=" in p))
+
+DB_EXEC = ThreadPoolExecutor(max_workers=mf.PG_POOL_SIZE, thread_name_prefix="db")
+QUEUE.track(lambda: executor_depth(DB_EXEC), executor="db")
+
+# ─── PLUMBING ───────────────────────────────────────────────────────────────
+_CLIENT: httpx.AsyncClient | None = None
+
+def _client() -> httpx.AsyncClient:
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.AsyncClient(
+            timeout=20, follow_redirects=True,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONN,
+                                max_keepalive_connections=HTTP_MAX_CONN // 4))
+    return _CLIENT
+
+async def aclose():
+    global _CLIENT
+    if _CLIENT: await _CLIENT.aclose(); _CLIENT = None
+
+async def run_db(fn, *args):
+    """Run a blocking DB/store call on DB_EXEC."""
+    return await asyncio.get_running_loop().run_in_executor(
+        DB_EXEC, profiling.bind(functools.partial(fn, *args)))
+
+def _with_db(fn, *args):
+    with mf.pooled_db() as db:
+        return fn(db, *args)
+
+async def with_db(fn, *args):
+    """fn(db, *args) on DB_EXEC with a connection borrowed just for the call."""
+    return await run_db(_with_db, fn, *args)
+
+class _Borrowed:
+    """Db stand-in for SeenSet: every method call borrows a pooled connection."""
+    _identity_clause = mf.Db._identity_clause
+    def __getattr__(self, name):
+        return lambda *a: _with_db(lambda db: getattr(db, name)(*a))
+
+# ─── PER-SOURCE LIMITS ──────────────────────────────────────────────────────
+class Busy(Exception): pass
+
+class Limiter:
+    """At most `inflight` calls running and `queue` waiting; beyond that, Busy."""
+    def __init__(self, inflight: int, queue: int):
+        self.sem = asyncio.Semaphore(inflight); self.queue = queue; self.waiting = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.sem.locked() and self.waiting >= self.queue: raise Busy
+        self.waiting += 1
+        try: await self.sem.acquire()
+        finally: self.waiting -= 1
+        try: yield
+        finally: self.sem.release()
+
+_LIMITS: dict[str, Limiter] = {}
+
+def _limiter(name: str) -> Limiter:
+    lim = _LIMITS.get(name)
+    if lim is None:
+        lim = _LIMITS[name] = Limiter(SRC_LIMITS.get(name, SRC_INFLIGHT), SRC_QUEUE)
+    return lim
+
+async def _call(src: "mf.Source", key: str | None, lang: str) -> list[dict]:
+    try:
+        async with _limiter(src.name).slot():
+            return await src.acall(key, lang)
+    except Busy:
+        log.info("source %s saturated, skipped", src.name)
+        return mf.NoResult()
+
+# ─── SINGLE-FLIGHT ──────────────────────────────────────────────────────────
+class Flight:
+    """
+    mf.SingleFlight for coroutines: callers with the same key await one
+    shielded task, so a caller that is cancelled (fan-out, deadline) does
+    not cancel it for the others; the task is cancelled when the last one
+    leaves.
+    """
+    def __init__(self, kind: str):
+        self.kind = kind; self._d: dict = {}      # key -> [started, Task, waiters]
+
+    def _done(self, key, e, task):
+        if self._d.get(key) is e: del self._d[key]
+        if not task.cancelled(): task.exception()   # retrieved even if every caller left
+
+    async def do(self, key, factory, max_age: float | None = None):
+        now = time.monotonic(); e = self._d.get(key)
+        if e and not e[1].done() and (max_age is None or now - e[0] < max_age):
+            COALESCED.inc(kind=self.kind)
+        else:
+            e = self._d[key] = [now, asyncio.ensure_future(factory()), 0]
+            e[1].add_done_callback(functools.partial(self._done, key, e))
+        e[2] += 1
+        try:
+            return await asyncio.shield(e[1])
+        finally:
+            e[2] -= 1
+            if not e[2] and not e[1].done(): e[1].cancel()   # nobody is waiting any more
+
+SEARCHES = Flight("search")
+DOWNLOADS = Flight("download")
+
+async def _cached(src: "mf.Source", ckey: tuple, key: str | None, lang: str) -> list[dict]:
+    k = (src.name,) + ckey
+    cand = mf.CAND_CACHE.peek(k)
+    if cand is not None: return cand
+    return await SEARCHES.do(k, lambda: _fill(src, k, key, lang),
+                             max_age=mf._p95(src.name) if mf.HEDGE else None)
+
+async def _fill(src: "mf.Source", k: tuple, key: str | None, lang: str) -> list[dict]:
+    cand = mf.CAND_CACHE.peek(k)
+    return cand if cand is not None else mf.CAND_CACHE.put(k, await _call(src, key, lang))
+
+# ─── SOURCES ────────────────────────────────────────────────────────────────
+async def _get_json(source: str, url: str, **kw):
+    r = await _client().get(url, **kw)
+    wait = mf._retry_after(r.headers)
+    if r.status_code in (429, 503):
+        raise mf.RateLimited(f"{source}: HTTP {r.status_code}", wait or mf.SRC_BACKOFF)
+    r.raise_for_status()
+    if wait: mf.SOURCES.cooldown(source, wait)
+    return r.json()
+
+async def meme_api_random(sub: str) -> dict:
+    return mf._parse_meme_api(await _get_json("meme-api", mf._meme_api_url(sub)), sub)
+
+async def reddit_search(q: str, lang: str) -> list[dict]:
+    return mf._parse_reddit(await _get_json("reddit", mf._reddit_url(q), headers=mf.HEADERS), lang)
+
+async def giphy_ru_search(q: str) -> list[dict]:
+    if not mf.GIPHY_KEY: return []
+    host = mf.GIPHY_HOST or "https://api.giphy.com/v1"
+    js = await _get_json("giphy", f"{host}/gifs/search?api_key={mf.GIPHY_KEY}&q={quote_plus(q)}"
+                                  "&lang=ru&limit=25&rating=pg-13")
+    return mf._parse_giphy(js, q)
+
+async def pikabu_ru(tag: str | None) -> list[dict]:
+    return mf._parse_pikabu(await _get_json("pikabu", mf._pikabu_url(tag)))
+
+for _name, _fn in {
+        "reddit": lambda key, lang: reddit_search(key or ("мем" if lang == "rus" else "meme"), lang),
+        "meme-api": lambda key, lang: _one(meme_api_random(random.choice(mf.ENG_SUBS))),
+        "giphy": lambda key, lang: giphy_ru_search(key or "мем"),
+        "pikabu": lambda key, lang: pikabu_ru(key)}.items():
+    mf.SOURCES[_name].asearch = _fn
+
+async def _one(coro) -> list[dict]:
+    return [await coro]
+
+# ─── FAN-OUT / PICK ─────────────────────────────────────────────────────────
+async def fan_out(calls: list[tuple], accept, merge: bool = False,
+                  deadline: float | None = None) -> list[dict]:
+    """mf.fan_out() on tasks; abandoned and hedged calls are really cancelled."""
+    n = len(calls); now = time.monotonic()
+    end = now + (deadline if deadline is not None else mf.FETCH_DEADLINE)
+    owner = {}; live = [0] * n; res: list = [None] * n; t0 = [now] * n
+    hedged = set(); first_hit = None
+    def launch(i):
+        name, fn, args = calls[i]
+        t = asyncio.ensure_future(fn(*args)); owner[t] = i; live[i] += 1
+    for i in range(n): launch(i)
+    try:
+        while owner:
+            now = time.monotonic()
+            hits = [i for i in range(n) if res[i]]
+            if all(r is not None for r in res): break
+            if hits and not merge and (all(res[j] is not None for j in range(hits[0]))
+                                       or now >= first_hit + mf.FANOUT_GRACE): break
+            if now >= end: break
+            timeout = end - now
+            if first_hit and not merge: timeout = min(timeout, first_hit + mf.FANOUT_GRACE - now)
+            if mf.HEDGE:
+                for i in range(n):
+                    p = mf._p95(calls[i][0])
+                    if res[i] is not None or i in hedged or p is None: continue
+                    if now >= t0[i] + p: launch(i); hedged.add(i)
+                    else: timeout = min(timeout, t0[i] + p - now)
+            done, _ = await asyncio.wait(list(owner), timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for f in done:
+                i = owner.pop(f); live[i] -= 1
+                if res[i]: continue
+                try: got = await accept(f.result(), calls[i][0])
+                except Exception: got = []
+                if got:
+                    res[i] = got; first_hit = first_hit or time.monotonic()
+                elif live[i] == 0: res[i] = []
+    finally:
+        for f in owner: f.cancel()
+    if merge: return [m for r in res if r for m in r]
+    return next((r for r in res if r), [])
+
+def _acceptor(blacklist, origin: dict, taken=frozenset()):
+    accept = mf._acceptor(blacklist, origin, taken)
+    async def aaccept(cand: list[dict], name: str | None = None) -> list[dict]:
+        if blacklist is None or not cand: return accept(cand, name)
+        return await run_db(accept, cand, name)
+    return aaccept
+
+async def _pick(lang: str, key: str | None, blacklist, deadline) -> dict | None:
+    got = await _pick_n(lang, key, blacklist, deadline, 1)
+    return got[0] if got else None
+
+async def _pick_n(lang: str, key: str | None, blacklist, deadline, k: int,
+                  taken=frozenset()) -> list[dict]:
+    srcs = mf._sources(lang, key, k)
+    ckey = (mf.norm_key(key), lang); origin = {}
+    accept = _acceptor(blacklist, origin, taken)
+    calls = [(s.name, _cached, (s, ckey, key, lang)) if s.cached
+             else (s.name, _call, (s, key, lang)) for s in srcs]
+    merge = mf.FANOUT_MODE == "merge" or len(set(srcs)) < len(srcs)
+    if mf.FANOUT:
+        cand = await fan_out(calls, accept, merge=merge, deadline=deadline)
+    else:
+        cand = []
+        for name, fn, args in calls:
+            cand += await accept(await fn(*args), name)
+            if len(cand) >= k and not merge: break
+    cand = list({c['url']: c for c in cand}.values())
+    got = random.sample(cand, min(k, len(cand)))
+    for m in got: mf._picked(m, lang, srcs, ckey, origin)
+    return got
+
+async def pick_english_meme(key: str | None, blacklist=None, deadline=None) -> dict:
+    if key:
+        m = await _pick("eng", key, blacklist, deadline)
+        if m: return m
+    api = mf.SOURCES["meme-api"]
+    got = await _call(api, key, "eng") if api.available(time.monotonic()) else []
+    if got: return got[0]
+    raise RuntimeError("meme-api unavailable")
+
+async def pick_russian_meme(key: str | None, blacklist=None, deadline=None) -> dict:
+    m = await _pick("rus", key, blacklist, deadline)
+    if m: return m
+    raise RuntimeError("No RU meme found")
+
+async def fetch_external_unique(key: str | None, lang: str, blacklist) -> dict:
+    with STAGE.time(stage="external"):
+        end = time.monotonic() + mf.FETCH_DEADLINE
+        for _ in range(20):
+            left = end - time.monotonic()
+            if left <= 0: break
+            m = await (pick_russian_meme(key, blacklist, left) if lang == "rus"
+                       else pick_english_meme(key, blacklist, left))
+            if not await run_db(blacklist.__contains__, m['url']): return m
+        raise RuntimeError("External fetch failed to find unique")
+
+async def fetch_external_many(key: str | None, lang: str, blacklist, n: int,
+                              taken=frozenset()) -> list[dict]:
+    with STAGE.time(stage="external"):
+        got = {}; end = time.monotonic() + mf.FETCH_DEADLINE
+        for _ in range(5):
+            left = end - time.monotonic()
+            if left <= 0 or len(got) >= n: break
+            for m in await _pick_n(lang, key, blacklist, left, n - len(got), set(taken) | set(got)):
+                got[m['url']] = m
+        return [dict(m) for m in got.values()]   # callers add id/path; cached dicts are shared
+
+# ─── DOWNLOAD ───────────────────────────────────────────────────────────────
+@asynccontextmanager
+async def _media(url: str):
+    async with _client().stream("GET", url, headers=mf.HEADERS, timeout=30) as r:
+        r.raise_for_status()
+        mf._check_media(url, r.headers)
+        yield r
+
+async def _capped(r: httpx.Response):
+    size = 0
+    async for chunk in r.aiter_bytes(mf.DL_CHUNK):
+        size += len(chunk)
+        if size > mf.DL_MAX_BYTES:
+            raise mf.DownloadRejected(f"{r.url}: larger than {mf.DL_MAX_BYTES} bytes")
+        yield chunk
+
+@traced("afetch.download")
+async def download(url: str) -> Path:
+    """mf.download() without a thread: one transfer per url into STORE on a miss."""
+    path = await run_db(mf.STORE.get, url)
+    if path: return path
+    return await DOWNLOADS.do(url, lambda: _download_once(url))
+
+async def _download_once(url: str) -> Path:
+    path = await run_db(mf.STORE.get, url)
+    if path: return path
+    with STAGE.time(stage="download"):
+        fd, tmp = tempfile.mkstemp(dir=mf.DOWNLOAD_DIR, suffix=".part")
+        h = hashlib.sha256(); size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async with _media(url) as r:
+                    async for chunk in _capped(r):
+                        h.update(chunk); f.write(chunk); size += len(chunk)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True); raise
+        return await run_db(mf.STORE.put_file, url, Path(tmp), h.hexdigest(), size)
+
+async def read_stream(url: str) -> bytes:
+    """STREAM_UPLOAD body, capped at DL_MAX_BYTES."""
+    async with _media(url) as r:
+        return b"".join([c async for c in _capped(r)])
+
+# ─── MAIN ───────────────────────────────────────────────────────────────────
+def _cached_row(db, keywords, lang, field, val):
+    row = db.find_cached_url(keywords, lang, field, val)
+    if row: row["file_id"] = db.file_id(row["id"]) if mf.FILE_IDS else None
+    return row
+
+def _external_row(db, meme):
+    url_id = db.ensure_url(meme['url'], meme['title'], meme['source'])
+    return url_id, db.file_id(url_id) if mf.FILE_IDS else None
+
+def _near(db, url_id, path, field, val):
+    return db.near_seen(mf.phash_of(db, url_id, path), url_id, field, val)
+
+def _deliver(db, url_id, url, path, keywords, lang, field, val):
+    if mf.PHASH: mf.phash_of(db, url_id, path)
+    db.add_journal(url_id, field, val, url)
+    if keywords or lang:
+        db.add_keyword_usage(url_id, keywords, lang, field, val)
+
+def _blacklist(field, val):
+    with STAGE.time(stage="blacklist"):
+        return mf.SeenSet(_Borrowed(), field, val)
+
+@traced("afetch.main")
+async def main(keywords: str | None, lang: str | None,
+               user: int | None, chat: int | None) -> dict:
+    """Same contract as meme_fetcher_4.main(); no thread is held across network waits."""
+    field = 'USER_ID' if user is not None else 'CHAT_ID'
+    val = user if user is not None else chat
+    bl = await run_db(_blacklist, field, val)
+    cached = await with_db(_cached_row, keywords, lang, field, val)
+    if cached:
+        path = None if cached["file_id"] or mf.STREAM_UPLOAD else await download(cached['url'])
+        await with_db(_deliver, cached['id'], cached['url'], path, keywords, lang, field, val)
+        return dict(cached, path=path)
+
+    for left in range(mf.PHASH_RETRY if mf.PHASH else 1, 0, -1):
+        meme = await fetch_external_unique(keywords, lang, bl)
+        url_id, fid = await with_db(_external_row, meme)
+        path = None if fid or mf.STREAM_UPLOAD else await download(meme['url'])
+        if left == 1 or not await with_db(_near, url_id, path, field, val): break
+        NEAR_DUP.inc(path="external")
+        await with_db(lambda db: db.add_journal(url_id, field, val, meme['url']))
+        bl.add(meme['url'])
+    await with_db(_deliver, url_id, meme['url'], path, keywords, lang, field, val)
+    return dict(meme, id=url_id, file_id=fid, path=path)
+
+async def _try_download(url: str) -> Path | None:
+    try: return await download(url)
+    except Exception as e:
+        log.warning("album: %s dropped: %s", url, e); return None
+
+@traced("afetch.main_many")
+async def main_many(keywords: str | None, lang: str | None,
+                    user: int | None, chat: int | None, n: int) -> list[dict]:
+    """Same contract as meme_fetcher_4.main_many(); downloads run concurrently."""
+    field = 'USER_ID' if user is not None else 'CHAT_ID'
+    val = user if user is not None else chat
+    memes = await with_db(mf.Db.find_cached_urls, keywords, lang, field, val, n)
+    if len(memes) < n:
+        bl = await run_db(_blacklist, field, val)
+        ext = await fetch_external_many(keywords, lang, bl, n - len(memes), {m['url'] for m in memes})
+        for m, url_id in zip(ext, await with_db(mf.Db.ensure_urls, ext)): m['id'] = url_id
+        memes += ext
+    fids = await with_db(mf.Db.file_ids, [m['id'] for m in memes]) if mf.FILE_IDS else {}
+    for m in memes: m['file_id'] = fids.get(m['id'])
+    need = [m for m in memes if not (m['file_id'] or mf.STREAM_UPLOAD)]
+    paths = dict(zip([m['url'] for m in need],
+                     await asyncio.gather(*(_try_download(m['url']) for m in need))))
+    for m in memes: m['path'] = paths.get(m['url'])
+    return await with_db(mf.album_deliver, memes, keywords, lang, field, val)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+run.py – offline benchmarks for meme_fetcher_4 / meme_bot
+
+Usage
+-----
+python bench/run.py fetch                          # sources + download, stubs only
+python bench/run.py db --journal 10000,1000000     # scratch Postgres via PG_* env
+python bench/run.py e2e --chats 50 --n 500         # send_meme → fake Telegram (+ PG)
+python bench/run.py all --out new.json
+python bench/run.py compare base.json new.json     # exit 1 on a p95 regression
+
+Sources and Telegram are served by stubs.py with --latency/--jitter. Suites
+that need Postgres (re)create the schema PG_SCHEMA (default memes_bench)
+from schema.sql + migrate.DDL and never touch other schemas.
+"""
+
+import os, sys, json, time, asyncio, argparse, tempfile, statistics, subprocess, platform
+from pathlib import Path
+from types import SimpleNamespace
+
+HERE = Path(__file__).parent
+sys.path.insert(0, str(HERE.parent))
+from stubs import Stubs, ROUTES
+
+# ─── measuring ──────────────────────────────────────────────────────────────
+def stats(lat:list[float], errors:int=0, wall:float|None=None)->dict:
+    s = sorted(lat); n = len(s)
+    q = lambda p: s[min(n - 1, int(n * p))] if n else None
+    return {"n": n, "errors": errors,
+            "mean": statistics.fmean(s) if n else None,
+            "p50": q(.50), "p95": q(.95), "p99": q(.99),
+            "max": s[-1] if n else None,
+            "throughput": n / wall if wall else None}
+
+def timeit(fn, n:int, before=None)->dict:
+    lat, err, t0 = [], 0, time.perf_counter()
+    for _ in range(n):
+        if before: before()
+        t = time.perf_counter()
+        try: fn()
+        except Exception: err += 1; continue
+        lat.append(time.perf_counter() - t)
+    return stats(lat, err, time.perf_counter() - t0)
+
+class NoSeen:
+    """Blacklist stand-in for the DB-less fetch suite."""
+    def filter(self, urls): return list(urls)
+    def __contains__(self, url): return False
+
+# ─── suites ─────────────────────────────────────────────────────────────────
+def suite_fetch(args, mf, stubs)->dict:
+    ns, out = NoSeen(), {}
+    for lang, key, pick in (("eng", "cat", mf.pick_english_meme),
+                            ("rus", "кот", mf.pick_russian_meme)):
+        out[f"fetch.pick_{lang}.cold"] = timeit(lambda: pick(key, ns), args.n, mf.CAND_CACHE.clear)
+        out[f"fetch.pick_{lang}.warm"] = timeit(lambda: pick(key, ns), args.n)
+    out["fetch.meme_api_random"] = timeit(lambda: mf.meme_api_random("memes"), args.n)
+    urls = [f"{stubs.base}/img/bench_{i}.jpg" for i in range(args.n)]
+    it = iter(urls); out["fetch.download.miss"] = timeit(lambda: mf.download(next(it)), args.n)
+    it = iter(urls); out["fetch.download.hit"] = timeit(lambda: mf.download(next(it)), args.n)
+    out["fetch.source_hits"] = dict(stubs.hits)
+    return out
+
+def reset_schema(mf, migrate):
+    schema = os.environ["PG_SCHEMA"]
+    with mf.pooled_db() as db:
+        cur = db.cx.cursor()
+        cur.execute(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+        cur.execute(f'CREATE SCHEMA "{schema}"')
+        cur.execute(f'SET search_path TO "{schema}",public')
+        for stmt in (HERE / "schema.sql").read_text().split(";"):
+            if stmt.strip(): cur.execute(stmt)
+        db.cx.commit()
+        migrate.apply_ddl(db)
+    mf._UNSEEN_BUILT.clear(); mf._BLOOMS.clear()
+
+def seed(mf, journal:int, heavy_chat:int)->dict:
+    """urls = max(20k, journal/4); heavy_chat has seen half the journal."""
+    urls = max(20000, journal // 4)
+    heavy = min(journal // 2, urls - 1000)
+    with mf.pooled_db() as db:
+        cur = db.cx.cursor()
+        cur.execute('INSERT INTO "memes_all_urls" ("url","name","source","date_upload") '
+                    "SELECT 'http://bench.invalid/'||g||'.jpg', 'meme '||g, 'bench', "
+                    "NOW() - g * interval '1 second' FROM generate_series(1,?) g", urls)
+        cur.execute('INSERT INTO "memes_key_words_using" '
+                    '("ID_URL","Keywords_Searched_user","Language","USER_ID") '
+                    "SELECT \"ID\", (ARRAY['cat','dog','work','code','coffee'])[1+\"ID\"%5], "
+                    "CASE WHEN \"ID\"%3=0 THEN 'rus' ELSE 'eng' END, 1 FROM \"memes_all_urls\"")
+        cur.execute('INSERT INTO "memes_queries_journal" ("CHAT_ID","URL_ID") '
+                    'SELECT ?, g FROM generate_series(1,?) g', heavy_chat, heavy)
+        cur.execute('INSERT INTO "memes_queries_journal" ("USER_ID","URL_ID") '
+                    'SELECT 1000+(g%5000), 1+(g::bigint*7919)%? FROM generate_series(1,?) g',
+                    urls, journal - heavy)
+        db.cx.commit()
+        db.cx.autocommit = True
+        db.cx.cursor().execute("ANALYZE")
+        db.cx.autocommit = False
+    return {"urls": urls, "journal": journal, "heavy_identity_rows": heavy}
+
+def suite_db(args, mf, stubs)->dict:
+    import migrate
+    out, chat = {}, -100
+    for size in [int(x) for x in args.journal.split(",")]:
+        reset_schema(mf, migrate)
+        out[f"db.{size}.seed"] = seed(mf, size, chat)
+        cand = [f"http://bench.invalid/{i}.jpg" for i in range(1, 200, 2)]
+        with mf.pooled_db() as db:
+            out[f"db.{size}.blacklist.first"] = timeit(
+                lambda: db.blacklist("CHAT_ID", chat).filter(cand), 1)
+            out[f"db.{size}.blacklist.filter100"] = timeit(
+                lambda: db.blacklist("CHAT_ID", chat).filter(cand), args.n)
+            for queued in (False, True):
+                mf.UNSEEN_QUEUE = queued
+                if queued: db.build_unseen("cat", "eng", "CHAT_ID", chat)
+                out[f"db.{size}.find_cached.{'queue' if queued else 'scan'}"] = timeit(
+                    lambda: db.find_cached_url("cat", "eng", "CHAT_ID", chat), args.n)
+            mf.UNSEEN_QUEUE = False
+            out[f"db.{size}.main"] = timeit(
+                lambda: mf.main("cat", "eng", None, chat, db=db), args.n)
+    return out
+
+def suite_e2e(args, mf, stubs)->dict:
+    import migrate, telegram
+    import meme_bot
+    reset_schema(mf, migrate); seed(mf, 10000, -100)
+
+    async def run():
+        bot = telegram.Bot("123:bench", base_url=os.environ["TELEGRAM_API_BASE"])
+        await bot.initialize()
+        app = SimpleNamespace(bot_data={})
+        await meme_bot._post_init(app)
+        ctx, sem, lat, err = SimpleNamespace(bot=bot), asyncio.Semaphore(args.chats), [], [0]
+        async def one(i):
+            async with sem:
+                t = time.perf_counter()
+                try:
+                    await meme_bot.send_meme(ctx, 0, -1 - i % args.chats, meme_bot.LANG_EN,
+                                             "cat" if i % 2 else None)
+                except Exception:
+                    err[0] += 1; return
+                lat.append(time.perf_counter() - t)
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.n)))
+        wall = time.perf_counter() - t0
+        await meme_bot._post_shutdown(app); await bot.shutdown()
+        return stats(lat, err[0], wall)
+    return {f"e2e.send_meme.c{args.chats}": asyncio.run(run())}
+
+# ─── compare ────────────────────────────────────────────────────────────────
+def compare(base:str, new:str, threshold:float)->int:
+    A = json.loads(Path(base).read_text())["results"]
+    B = json.loads(Path(new).read_text())["results"]
+    bad = 0
+    for k in sorted(set(A) & set(B)):
+        a, b = A[k], B[k]
+        if not (isinstance(a, dict) and a.get("p95") and b.get("p95")): continue
+        d = (b["p95"] - a["p95"]) / a["p95"]
+        flag = "  REGRESSION" if d > threshold else ""
+        bad += bool(flag)
+        print(f"{k:42} p50 {a['p50']*1e3:9.2f} → {b['p50']*1e3:9.2f} ms   "
+              f"p95 {a['p95']*1e3:9.2f} → {b['p95']*1e3:9.2f} ms  {d:+7.1%}{flag}")
+    return 1 if bad else 0
+
+# ─── main ───────────────────────────────────────────────────────────────────
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("suite", choices=["fetch", "db", "e2e", "all", "compare"])
+    p.add_argument("reports", nargs="*", help="compare: base.json new.json")
+    p.add_argument("--n", type=int, default=100, help="iterations per measurement")
+    p.add_argument("--latency", type=float, default=0.05, help="stub latency, seconds")
+    p.add_argument("--jitter", type=float, default=0.02)
+    p.add_argument("--img-bytes", type=int, default=64 << 10)
+    p.add_argument("--journal", default="10000,100000,1000000",
+                   help="journal sizes for the db suite (up to 10000000)")
+    p.add_argument("--chats", type=int, default=20, help="e2e concurrency")
+    p.add_argument("--threshold", type=float, default=0.10, help="compare: p95 tolerance")
+    p.add_argument("--out", help="write the JSON report here")
+    args = p.parse_args()
+    if args.suite == "compare":
+        sys.exit(compare(args.reports[0], args.reports[1], args.threshold))
+
+    stubs = Stubs({r: args.latency for r in ROUTES}, args.jitter, args.img_bytes).start()
+    os.environ.update(stubs.env())
+    os.environ["MEME_DIR"] = tempfile.mkdtemp(prefix="memes_bench_")
+    for k, v in (("GIPHY_KEY", "bench"), ("PG_PORT", "5432"),
+                 ("PG_SCHEMA", "memes_bench"), ("PREFETCH", "0")):
+        os.environ.setdefault(k, v)
+    import meme_fetcher_4 as mf
+
+    results = {}
+    if args.suite in ("fetch", "all"): results |= suite_fetch(args, mf, stubs)
+    if args.suite in ("db", "all"):    results |= suite_db(args, mf, stubs)
+    if args.suite in ("e2e", "all"):   results |= suite_e2e(args, mf, stubs)
+    mf.close_pool(); stubs.stop()
+
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                             capture_output=True, text=True).stdout.strip()
+    except OSError:
+        rev = ""
+    report = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "git": rev,
+                       "python": platform.python_version(), "args": vars(args)},
+              "results": results}
+    text = json.dumps(report, indent=1, ensure_ascii=False)
+    if args.out: Path(args.out).write_text(text)
+    print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+-- schema.sql – memes_* tables as used by meme_fetcher_4 / meme_bot
+-- Fixture for bench/run.py; run inside a scratch schema (PG_SCHEMA).
+
+CREATE TABLE "memes_all_urls" (
+    "ID"          bigserial PRIMARY KEY,
+    "url"         text NOT NULL,
+    "name"        text,
+    "source"      text,
+    "date_upload" timestamp NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE "memes_queries_journal" (
+    "ID"       bigserial PRIMARY KEY,
+    "USER_ID"  bigint,
+    "CHAT_ID"  bigint,
+    "URL_ID"   bigint NOT NULL REFERENCES "memes_all_urls" ("ID"),
+    "date_time" timestamp NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE "memes_key_words_using" (
+    "ID"                     bigserial PRIMARY KEY,
+    "ID_URL"                 bigint NOT NULL REFERENCES "memes_all_urls" ("ID"),
+    "Keywords_Searched_user" text,
+    "Language"               text,
+    "USER_ID"                bigint,
+    "CHAT_ID"                bigint
+);
+
+CREATE TABLE "memes_actions_tg_bot" (
+    "Action_ID"        int NOT NULL,
+    "User_ID"          bigint NOT NULL,
+    "Chat_ID"          bigint NOT NULL,
+    "date_time_action" timestamp NOT NULL DEFAULT NOW(),
+    UNIQUE ("User_ID","Chat_ID")
+);
+
+CREATE TABLE "memes_user_list" (
+    "USER_ID_TELEGRAM" bigint PRIMARY KEY,
+    "LANG_ID"          int NOT NULL DEFAULT 1
+);
+
+CREATE TABLE "memes_chat_list" (
+    "CHAT_ID_TELEGRAM" bigint PRIMARY KEY,
+    "LANG_ID"          int NOT NULL DEFAULT 1
+);
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+stubs.py – local stand-ins for the meme sources and the Telegram Bot API
+
+One threaded HTTP server, routed by path prefix:
+
+  /reddit/search.json        reddit search      (fixtures/reddit_search.json)
+  /memeapi/gimme/<sub>       meme-api random    (fixtures/meme_api.json, cycled)
+  /pikabu/v1/story|post/...  pikabu             (fixtures/pikabu_*.json)
+  /giphy/v1/gifs/search      giphy search       (fixtures/giphy_search.json)
+  /img/<name>                deterministic image bytes (IMG_BYTES each)
+  /tg/bot<token>/<method>    fake Bot API: getMe, sendPhoto, sendAnimation,
+                             sendMediaGroup, sendMessage, sendChatAction
+
+Every route sleeps latency[route] (+ uniform jitter) before answering.
+"""
+
+import json, time, random, hashlib, itertools, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES = Path(__file__).parent / "fixtures"
+ROUTES = ("reddit","memeapi","pikabu","giphy","img","tg")
+
+def _load(name:str, base:str):
+    return json.loads((FIXTURES/name).read_text().replace("{base}", base))
+
+class Stubs:
+    def __init__(self, latency:dict[str,float]|None=None, jitter:float=0.0,
+                 img_bytes:int=64<<10, host:str="127.0.0.1", port:int=0):
+        self.latency = {r: 0.0 for r in ROUTES} | (latency or {})
+        self.jitter, self.img_bytes = jitter, img_bytes
+        self.hits = {r: 0 for r in ROUTES}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.base = f"http://{host}:{self.server.server_address[1]}"
+        self.fx = {n: _load(n, self.base) for n in (
+            "reddit_search.json","meme_api.json","pikabu_story.json",
+            "pikabu_random.json","giphy_search.json")}
+        self._meme_api = itertools.cycle(self.fx["meme_api.json"])
+
+    # env for meme_fetcher_4 / meme_bot
+    def env(self)->dict[str,str]:
+        return {"REDDIT_BASE": f"{self.base}/reddit",
+                "MEME_API_BASE": f"{self.base}/memeapi",
+                "PIKABU_BASE": f"{self.base}/pikabu",
+                "GIPHY_HOST": f"{self.base}/giphy/v1",
+                "TELEGRAM_API_BASE": f"{self.base}/tg/bot"}
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="stubs", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    # ─── routing ───────────────────────────────────────────────────────────
+    def image(self, name:str)->bytes:
+        seed = hashlib.sha256(name.encode()).digest()
+        body = (seed * (self.img_bytes // len(seed) + 1))[:self.img_bytes]
+        return b"\xff\xd8\xff\xe0" + body          # JPEG magic, unique per name
+
+    def route(self, method:str, path:str, query:dict, body:bytes):
+        """-> (status, content-type, payload bytes)"""
+        parts = path.strip("/").split("/")
+        if parts[0] == "reddit":
+            return 200, "application/json", json.dumps(self.fx["reddit_search.json"]).encode()
+        if parts[0] == "memeapi":
+            with self._lock: m = dict(next(self._meme_api))
+            m["subreddit"] = parts[-1]
+            return 200, "application/json", json.dumps(m).encode()
+        if parts[0] == "pikabu":
+            name = "pikabu_story.json" if "story" in parts else "pikabu_random.json"
+            return 200, "application/json", json.dumps(self.fx[name]).encode()
+        if parts[0] == "giphy":
+            return 200, "application/json", json.dumps(self.fx["giphy_search.json"]).encode()
+        if parts[0] == "img":
+            ctype = "image/gif" if path.endswith(".gif") else "image/jpeg"
+            return 200, ctype, self.image(parts[-1])
+        if parts[0] == "tg":
+            return 200, "application/json", json.dumps(self.telegram(parts[-1], body)).encode()
+        return 404, "text/plain", b"not found"
+
+    def telegram(self, method:str, body:bytes)->dict:
+        n = next(self._ids)
+        chat = {"id": 1, "type": "private", "first_name": "bench"}
+        msg = {"message_id": n, "date": int(time.time()), "chat": chat}
+        photo = [{"file_id": f"bench-photo-{n}", "file_unique_id": f"u{n}",
+                  "width": 320, "height": 320}]
+        if method == "getMe":
+            res = {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "sendPhoto":
+            res = msg | {"photo": photo}
+        elif method == "sendAnimation":
+            res = msg | {"animation": {"file_id": f"bench-anim-{n}", "file_unique_id": f"u{n}",
+                                       "width": 320, "height": 320, "duration": 1}}
+        elif method == "sendMediaGroup":
+            res = [msg | {"message_id": n * 100 + i, "photo": photo} for i in range(2)]
+        elif method == "sendMessage":
+            res = msg | {"text": "bench"}
+        else:
+            res = True
+        return {"ok": True, "result": res}
+
+    def _handler(self):
+        stubs = self
+        class H(BaseHTTPRequestHandler):
+            def _serve(self):
+                u = urlparse(self.path)
+                route = u.path.strip("/").split("/")[0]
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                delay = stubs.latency.get(route, 0.0) + random.uniform(0, stubs.jitter)
+                if delay: time.sleep(delay)
+                with stubs._lock:
+                    if route in stubs.hits: stubs.hits[route] += 1
+                code, ctype, payload = stubs.route(self.command, u.path, parse_qs(u.query), body)
+                self.send_response(code)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            do_GET = do_POST = _serve
+            def log_message(self, *a): pass
+        return H
+
+if __name__ == "__main__":
+    import argparse
+    p = argparse.ArgumentParser()
+    p.add_argument("--port", type=int, default=8099)
+    p.add_argument("--latency", type=float, default=0.05)
+    a = p.parse_args()
+    s = Stubs({r: a.latency for r in ROUTES}, port=a.port).start()
+    for k, v in s.env().items(): print(f"export {k}={v}")
+    threading.Event().wait()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+broadcast.py – daily «meme of the day» push to every registered user and chat
+
+    BROADCAST_AT=09:00 python meme_bot.py      # scheduler inside the bot (UTC)
+    python broadcast.py [--day 2025-04-01]     # one run now, e.g. from cron
+
+• one meme per language and day, uploaded once (to its first recipient);
+  everyone else gets the returned file_id
+• sends go through a global token bucket (BCAST_RATE msg/s) and a per-chat
+  pacer (1/s private, 20/min groups); a 429 pauses the whole bucket for
+  its retry_after and the send is retried
+• journal rows are written in batches every BCAST_FLUSH s; recipients are
+  paged by id with an anti-join on the journal, so a restart skips whoever
+  already got the day's meme (at most one unflushed batch is sent twice)
+• memes_broadcast (python migrate.py) keeps the day's pick and a lease, so
+  with several bot processes exactly one sends each language
+"""
+
+import os, time, asyncio, logging, argparse
+from datetime import datetime, timedelta, timezone
+
+from telegram.error import RetryAfter, Forbidden, BadRequest, TelegramError
+
+import meme_fetcher_4 as mf
+import afetch
+import media
+from metrics import BCAST
+
+log = logging.getLogger("broadcast")
+
+# ─── CONFIG ─────────────────────────────────────────────────────────────────
+BROADCAST_AT     = os.getenv("BROADCAST_AT","")                  # HH:MM UTC; empty = no scheduler
+BROADCAST_KW     = os.getenv("BROADCAST_KEYWORD") or None        # theme of the day's pick
+BCAST_RATE       = float(os.getenv("BCAST_RATE","25"))           # msg/s, Telegram allows ~30
+BCAST_CHAT_GAP   = float(os.getenv("BCAST_CHAT_GAP","1"))        # s between sends to one private chat
+BCAST_GROUP_GAP  = float(os.getenv("BCAST_GROUP_GAP","3"))       # … to one group (20/min)
+BCAST_CONCURRENCY = int(os.getenv("BCAST_CONCURRENCY","32"))     # sends in flight
+BCAST_PAGE       = 1000                                          # recipients per query
+BCAST_FLUSH      = float(os.getenv("BCAST_FLUSH","5"))           # journal batch + lease renewal
+BCAST_LEASE      = 120                                           # s before another process takes over
+BCAST_TRIES      = 3
+LANGS = {1: "eng", 2: "rus"}                                     # memes_*_list.LANG_ID
+LISTS = (("USER_ID", "memes_user_list", "USER_ID_TELEGRAM"),
+         ("CHAT_ID", "memes_chat_list", "CHAT_ID_TELEGRAM"))
+
+# ─── RATE LIMITS ────────────────────────────────────────────────────────────
+class TokenBucket:
+    """rate tokens/s up to burst; pause() stops the refill (429 retry_after)."""
+    def __init__(self, rate:float=BCAST_RATE, burst:float|None=None):
+        self.rate = rate; self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst; self.t = time.monotonic(); self.until = 0.0
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            if now < self.until:
+                await asyncio.sleep(self.until - now); continue
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate); self.t = now
+            if self.tokens >= 1:
+                self.tokens -= 1; return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, secs:float):
+        self.until = max(self.until, time.monotonic() + secs)
+        self.tokens = 0; self.t = self.until
+
+class ChatPacer:
+    """Minimum gap between two sends to one chat (retries, chats in both lists)."""
+    def __init__(self):
+        self.next:dict[int,float] = {}
+
+    async def wait(self, chat:int):
+        now = time.monotonic()
+        at = max(now, self.next.get(chat, 0))
+        self.next[chat] = at + (BCAST_GROUP_GAP if chat < 0 else BCAST_CHAT_GAP)
+        if len(self.next) > 4 * BCAST_PAGE:
+            self.next = {c: t for c, t in self.next.items() if t > now}
+        if at > now: await asyncio.sleep(at - now)
+
+# ─── DB ─────────────────────────────────────────────────────────────────────
+def claim(db:mf.Db, day, lang_id:int)->dict|None:
+    """The day's row for lang, leased to us; None when done or leased elsewhere."""
+    cur = db.cx.cursor()
+    cur.execute('INSERT INTO "memes_broadcast" ("DAY","LANG_ID") VALUES (?,?) '
+                'ON CONFLICT DO NOTHING', day, lang_id)
+    row = cur.execute(
+        'UPDATE "memes_broadcast" SET "lease_until"=NOW()+make_interval(secs=>?) '
+        'WHERE "DAY"=? AND "LANG_ID"=? AND "done_at" IS NULL '
+        'AND ("lease_until" IS NULL OR "lease_until"<NOW()) '
+        'RETURNING "URL_ID","file_id","sent"', BCAST_LEASE, day, lang_id).fetchone()
+    db.cx.commit()
+    return dict(id=row[0], file_id=row[1], sent=row[2]) if row else None
+
+def renew(db:mf.Db, day, lang_id:int, sent:int)->bool:
+    """Extend the lease and record progress; False if it was lost meanwhile."""
+    row = db.cx.cursor().execute(
+        'UPDATE "memes_broadcast" SET "lease_until"=NOW()+make_interval(secs=>?), "sent"=? '
+        'WHERE "DAY"=? AND "LANG_ID"=? AND "lease_until">NOW() RETURNING 1',
+        BCAST_LEASE, sent, day, lang_id).fetchone()
+    db.cx.commit()
+    return row is not None
+
+def set_pick(db:mf.Db, day, lang_id:int, url_id:int, file_id:str|None):
+    db.cx.cursor().execute('UPDATE "memes_broadcast" SET "URL_ID"=?, "file_id"=? '
+                           'WHERE "DAY"=? AND "LANG_ID"=?', url_id, file_id, day, lang_id)
+    if mf.FILE_IDS and file_id: db.set_file_id(url_id, file_id)
+    db.cx.commit()
+
+def finish(db:mf.Db, day, lang_id:int, sent:int):
+    db.cx.cursor().execute('UPDATE "memes_broadcast" SET "done_at"=NOW(), "sent"=?, '
+                           '"lease_until"=NULL WHERE "DAY"=? AND "LANG_ID"=?', sent, day, lang_id)
+    db.cx.commit()
+
+def past_urls(db:mf.Db, lang_id:int)->set[str]:
+    return {r[0] for r in db.cx.cursor().execute(
+        'SELECT u."url" FROM "memes_broadcast" b JOIN "memes_all_urls" u ON u."ID"=b."URL_ID" '
+        'WHERE b."LANG_ID"=?', lang_id)}
+
+def url_of(db:mf.Db, url_id:int)->str:
+    return db.cx.cursor().execute(
+        'SELECT "url" FROM "memes_all_urls" WHERE "ID"=?', url_id).fetchone()[0]
+
+def recipients(db:mf.Db, table:str, col:str, clause:str, lang_id:int, url_id:int,
+               after:int, n:int=BCAST_PAGE)->list[int]:
+    """Next ids of the list in lang after `after` whose journal lacks url_id."""
+    return [r[0] for r in db.cx.cursor().execute(
+        f'SELECT l."{col}" FROM "{table}" l WHERE l."LANG_ID"=? AND l."{col}">? '
+        f'AND NOT EXISTS (SELECT 1 FROM "memes_queries_journal" j '
+        f'WHERE j."{clause}"=l."{col}" AND j."URL_ID"=?) ORDER BY 1 LIMIT ?',
+        lang_id, after, url_id, n)]
+
+# ─── SENDING ────────────────────────────────────────────────────────────────
+def _file_id(msg)->str|None:
+    """Same "<kind>:<file_id>" form as memes_all_urls.tg_file_id."""
+    if msg.photo: return msg.photo[-1].file_id
+    if msg.animation: return "animation:" + msg.animation.file_id
+    if msg.video: return "video:" + msg.video.file_id
+    return None
+
+class _Past(set):
+    """Blacklist of memes already broadcast in the language."""
+    def filter(self, urls): return [u for u in urls if u not in self]
+
+class Broadcast:
+    """One language of one day's run."""
+    def __init__(self, bot, day, lang_id:int, bucket:TokenBucket, pacer:ChatPacer):
+        self.bot, self.day, self.lang_id = bot, day, lang_id
+        self.lang = LANGS[lang_id]
+        self.bucket, self.pacer = bucket, pacer
+        self.rows:list[tuple] = []; self.sent = 0; self.lost = False
+
+    async def _pick(self)->dict:
+        seen = _Past(await afetch.with_db(past_urls, self.lang_id))
+        meme = await asyncio.get_running_loop().run_in_executor(
+            None, mf.fetch_external_unique, BROADCAST_KW, self.lang, seen)
+        url_id = await afetch.with_db(lambda db: db.ensure_url(meme['url'], meme['title'], meme['source']))
+        fid = await afetch.with_db(lambda db: db.file_id(url_id)) if mf.FILE_IDS else None
+        await afetch.with_db(set_pick, self.day, self.lang_id, url_id, fid)
+        return dict(id=url_id, url=meme['url'], file_id=fid)
+
+    async def _deliver(self, chat:int, media_)->object:
+        """One send with the limits applied; waits out 429s, retries network errors."""
+        tries = 0
+        while True:
+            await self.bucket.take(); await self.pacer.wait(chat)
+            try:
+                if isinstance(media_, tuple):                   # (path, kind): upload
+                    with media_[0].open("rb") as f:
+                        return await getattr(self.bot, f"send_{media_[1]}")(chat, f, write_timeout=30)
+                kind, _, fid = media_.rpartition(":")
+                return await getattr(self.bot, f"send_{kind or 'photo'}")(chat, fid)
+            except RetryAfter as e:
+                BCAST.inc(lang=self.lang, result="retry_after")
+                log.warning("429 from Telegram, pausing %ss", e.retry_after)
+                self.bucket.pause(float(e.retry_after))
+            except (Forbidden, BadRequest):
+                raise
+            except TelegramError as e:
+                tries += 1
+                if tries >= BCAST_TRIES: raise
+                log.warning("send to %s failed (%s), retrying", chat, e)
+
+    def _done(self, clause:str, ident:int):
+        self.rows.append((clause, ident, self.meme['id'], self.hash)); self.sent += 1
+        BCAST.inc(lang=self.lang, result="sent")
+
+    async def _one(self, clause:str, ident:int, fid:str):
+        try: await self._deliver(ident, fid)
+        except Forbidden:                                       # blocked the bot / kicked
+            BCAST.inc(lang=self.lang, result="forbidden"); return
+        except TelegramError as e:
+            BCAST.inc(lang=self.lang, result="error")
+            log.warning("broadcast to %s dropped: %s", ident, e); return
+        self._done(clause, ident)
+
+    async def _flush(self, final:bool=False):
+        rows, self.rows = self.rows, []
+        if rows: await afetch.with_db(lambda db: db.write_rows(rows, []))
+        if not await afetch.with_db(renew, self.day, self.lang_id, self.sent) and not final:
+            log.warning("lease for %s/%s lost, stopping", self.day, self.lang); self.lost = True
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(BCAST_FLUSH); await self._flush()
+
+    async def _targets(self):
+        for clause, table, col in LISTS:
+            after = -(1 << 63)
+            while not self.lost:
+                page = await afetch.with_db(recipients, table, col, clause,
+                                            self.lang_id, self.meme['id'], after)
+                for ident in page: yield clause, ident
+                if len(page) < BCAST_PAGE: break
+                after = page[-1]
+
+    async def _upload(self, targets)->str|None:
+        """Upload to recipients until one accepts; its file_id serves the rest."""
+        errors = 0
+        path = await afetch.download(self.meme['url']) if afetch.ASYNC_FETCH else \
+            await asyncio.get_running_loop().run_in_executor(None, mf.download, self.meme['url'])
+        up = await media.prepare(mf.STORE, path)
+        async for clause, ident in targets:
+            try: msg = await self._deliver(ident, up)
+            except Forbidden:
+                BCAST.inc(lang=self.lang, result="forbidden"); continue
+            except TelegramError as e:                          # e.g. media Telegram refuses
+                BCAST.inc(lang=self.lang, result="error"); errors += 1
+                if errors >= BCAST_TRIES: raise
+                log.warning("upload to %s failed: %s", ident, e); continue
+            self._done(clause, ident)
+            fid = _file_id(msg)
+            if fid: await afetch.with_db(set_pick, self.day, self.lang_id, self.meme['id'], fid)
+            return fid
+        return None
+
+    async def run(self)->int|None:
+        """Send the day's meme to everyone still missing it; None if not ours to run."""
+        row = await afetch.with_db(claim, self.day, self.lang_id)
+        if row is None: return None
+        self.sent = row['sent'] or 0
+        self.meme = (dict(row, url=await afetch.with_db(url_of, row['id'])) if row['id']
+                     else await self._pick())
+        self.hash = mf.url_hash(self.meme['url'])
+        log.info("broadcast %s/%s: %s (%s sent before)", self.day, self.lang, self.meme['url'], self.sent)
+        targets = self._targets(); flusher = asyncio.create_task(self._flusher())
+        pending = set()
+        try:
+            fid = self.meme['file_id'] or await self._upload(targets)
+            if fid:
+                async for clause, ident in targets:
+                    if self.lost: break
+                    if len(pending) >= BCAST_CONCURRENCY:
+                        _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    pending.add(asyncio.create_task(self._one(clause, ident, fid)))
+                if pending: await asyncio.wait(pending)
+        finally:
+            for t in (flusher, *pending): t.cancel()
+            await self._flush(final=True)
+        if not self.lost: await afetch.with_db(finish, self.day, self.lang_id, self.sent)
+        log.info("broadcast %s/%s done: %s sent", self.day, self.lang, self.sent)
+        return self.sent
+
+# ─── SCHEDULER ──────────────────────────────────────────────────────────────
+async def run_day(bot, day=None)->dict:
+    """Both languages of a day (default today, UTC), sharing one rate limit."""
+    day = day or datetime.now(timezone.utc).date()
+    bucket, pacer, out = TokenBucket(), ChatPacer(), {}
+    for lang_id in LANGS:
+        try: out[LANGS[lang_id]] = await Broadcast(bot, day, lang_id, bucket, pacer).run()
+        except Exception:
+            log.exception("broadcast %s/%s failed", day, LANGS[lang_id])
+    return out
+
+def _next_run(now:datetime, at:str=BROADCAST_AT)->datetime:
+    h, m = map(int, at.split(":"))
+    t = now.replace(hour=h, minute=m, second=0, microsecond=0)
+    return t if t > now else t + timedelta(days=1)
+
+async def scheduler(bot):
+    """Run at BROADCAST_AT every day; a run missed or cut short today resumes at start."""
+    now = datetime.now(timezone.utc)
+    if _next_run(now).date() != now.date():       # today's slot has passed
+        await run_day(bot)
+    while True:
+        now = datetime.now(timezone.utc)
+        await asyncio.sleep((_next_run(now) - now).total_seconds())
+        await run_day(bot)
+
+# ─── CLI ────────────────────────────────────────────────────────────────────
+async def _cli(day):
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+    token = os.getenv("TELEGRAM_TOKEN")
+    if not token: raise SystemExit("TELEGRAM_TOKEN is not set")
+    bot = Bot(token, base_url=os.getenv("TELEGRAM_API_BASE","https://api.telegram.org/bot"),
+              request=HTTPXRequest(connection_pool_size=BCAST_CONCURRENCY))
+    async with bot:
+        try: print(await run_day(bot, day))
+        finally: await afetch.aclose()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s | %(message)s")
+    p = argparse.ArgumentParser()
+    p.add_argument("--day", type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+                   help="resume or redo that day's run (default today, UTC)")
+    asyncio.run(_cli(p.parse_args().day))
+    mf.close_pool()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+media.py – normalize downloaded memes before they go to Telegram
+
+• the real type comes from the magic bytes, not the url
+• stills larger than MEDIA_MAX_SIDE px / MEDIA_MAX_BYTES are downscaled and
+  re-encoded as JPEG (Pillow; without it stills pass through unchanged)
+• GIFs become H.264 MP4 for send_animation (ffmpeg; without it the GIF is
+  sent as an animation as-is)
+• results are cached next to the original as <sha>.tg.<ext> (store.py)
+• dhash() gives the 64-bit perceptual hash used to spot reposts
+
+Encoding runs in a ProcessPoolExecutor; the bot awaits the process future
+directly, so neither the event loop nor a fetch thread waits on the CPU.
+"""
+
+import os, uuid, shutil, asyncio, logging, subprocess, multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:                      # optional: stills are sent untouched
+    Image = None
+
+log = logging.getLogger("media")
+
+MEDIA_PIPELINE  = os.getenv("MEDIA_PIPELINE","1")=="1"
+MEDIA_WORKERS   = int(os.getenv("MEDIA_WORKERS","2"))
+MEDIA_MAX_SIDE  = int(os.getenv("MEDIA_MAX_SIDE","1280"))        # px, longest side
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES",str(1<<20)))   # target for stills
+MEDIA_TIMEOUT   = float(os.getenv("MEDIA_TIMEOUT","60"))         # per ffmpeg run
+FFMPEG          = os.getenv("FFMPEG") or shutil.which("ffmpeg")
+JPEG_QUALITY    = (85,75,60,45)                                  # tried in order
+
+# ─── TYPES ──────────────────────────────────────────────────────────────────
+KIND = {"gif":"animation","mp4":"video","webm":"video"}             # else photo
+KIND_BY_EXT = {".jpg":"photo",".mp4":"animation"}                   # derived files
+
+def sniff(head:bytes)->str:
+    """Real media type from the first 16 bytes: jpeg|png|gif|webp|mp4|webm|''."""
+    if head[:3]==b"\xff\xd8\xff": return "jpeg"
+    if head[:8]==b"\x89PNG\r\n\x1a\n": return "png"
+    if head[:6] in (b"GIF87a",b"GIF89a"): return "gif"
+    if head[:4]==b"RIFF" and head[8:12]==b"WEBP": return "webp"
+    if head[4:8]==b"ftyp": return "mp4"
+    if head[:4]==b"\x1a\x45\xdf\xa3": return "webm"
+    return ""
+
+def kind_of(data:bytes|Path)->str:
+    """photo | animation | video – the Bot API method to send it with."""
+    head=data[:16] if isinstance(data,bytes) else data.open("rb").read(16)
+    return KIND.get(sniff(head),"photo")
+
+def dhash(path:Path)->int|None:
+    """64-bit difference hash of the (first frame of the) image; None if unreadable."""
+    if Image is None: return None
+    try:
+        with Image.open(path) as im:
+            im.draft("L",(64,64))                # JPEG: decode at 1/8 scale
+            px=im.convert("L").resize((9,8),Image.LANCZOS).tobytes()
+    except Exception:
+        return None
+    h=0
+    for y in range(0,72,9):
+        for x in range(y,y+8): h=h<<1|(px[x]<px[x+1])
+    return h
+
+# ─── WORKER SIDE (runs in the process pool) ─────────────────────────────────
+def _part(src:Path, ext:str)->Path:
+    """<sha>.tg.<ext>.<pid>-<rand>.part: concurrent jobs never share a temp file."""
+    return src.with_name(f"{src.stem}.tg.{ext}.{os.getpid()}-{uuid.uuid4().hex[:8]}.part")
+
+def _gif_to_mp4(src:Path)->Path:
+    out=_part(src,"mp4")
+    subprocess.run([FFMPEG,"-v","error","-y","-i",str(src),"-an",
+                    "-vf",f"scale='trunc(min({MEDIA_MAX_SIDE},iw)/2)*2':-2",
+                    "-c:v","libx264","-preset","veryfast","-crf","28",
+                    "-pix_fmt","yuv420p","-movflags","+faststart","-f","mp4",str(out)],
+                   check=True,timeout=MEDIA_TIMEOUT,capture_output=True)
+    return out
+
+def _recompress(src:Path)->Path:
+    with Image.open(src) as im:
+        if (im.format in ("JPEG","PNG") and max(im.size)<=MEDIA_MAX_SIDE
+                and src.stat().st_size<=MEDIA_MAX_BYTES):
+            return src
+        im.thumbnail((MEDIA_MAX_SIDE,MEDIA_MAX_SIDE),Image.LANCZOS)
+        if "A" in im.getbands() or im.mode=="P":   # flatten transparency on white
+            rgba=im.convert("RGBA"); im=Image.new("RGB",im.size,"white")
+            im.paste(rgba,mask=rgba.getchannel("A"))
+        else:
+            im=im.convert("RGB")
+    out=_part(src,"jpg")
+    for q in JPEG_QUALITY:
+        im.save(out,"JPEG",quality=q,optimize=True,progressive=True)
+        if out.stat().st_size<=MEDIA_MAX_BYTES: break
+    return out
+
+def normalize(src:str)->tuple[str,str]:
+    """-> (path to upload, kind). A new file is left as <sha>.tg.<ext>.<job>.part."""
+    p=Path(src); t=sniff(p.open("rb").read(16))
+    if t=="gif":
+        return str(_gif_to_mp4(p) if FFMPEG else p),"animation"
+    if t in KIND or Image is None:
+        return str(p),KIND.get(t,"photo")
+    return str(_recompress(p)),"photo"
+
+# ─── BOT SIDE ───────────────────────────────────────────────────────────────
+_POOL:ProcessPoolExecutor|None=None
+_DONE:OrderedDict=OrderedDict()             # original path -> (upload path, kind)
+_DONE_MAX=4096
+_INFLIGHT:dict[Path,asyncio.Future]={}     # original path -> prepare in progress
+
+def _pool()->ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        # spawn, not fork: workers never inherit the bot's threads or locks. A
+        # spawn child re-imports the parent's __main__ as __mp_main__, so each
+        # worker also runs meme_bot.py's (and meme_fetcher_4's) module-level
+        # setup – keep entry points behind `if __name__ == "__main__"`
+        _POOL=ProcessPoolExecutor(MEDIA_WORKERS,mp_context=multiprocessing.get_context("spawn"))
+    return _POOL
+
+def shutdown():
+    global _POOL
+    if _POOL: _POOL.shutdown(cancel_futures=True); _POOL=None
+
+async def prepare(store, path:Path)->tuple[Path,str]:
+    """(path, kind) to upload for a stored original; encodes at most once."""
+    hit=_DONE.get(path)
+    if hit and hit[0].exists(): return hit
+    fut=_INFLIGHT.get(path)
+    if fut is None:                          # concurrent sends of one meme share the job
+        fut=_INFLIGHT[path]=asyncio.ensure_future(_prepare(store,path))
+        fut.add_done_callback(lambda _: _INFLIGHT.pop(path,None))
+    return await asyncio.shield(fut)
+
+async def _prepare(store, path:Path)->tuple[Path,str]:
+    global _POOL
+    loop=asyncio.get_running_loop()
+    if not MEDIA_PIPELINE:
+        return path,await loop.run_in_executor(None,kind_of,path)
+    out=await loop.run_in_executor(None,store.derived,path)
+    if out:
+        res=(out,KIND_BY_EXT.get(out.suffix,"photo"))
+    else:
+        try:
+            dst,kind=await asyncio.wrap_future(_pool().submit(normalize,str(path)))
+            dst=Path(dst)
+            if dst!=path: dst=await loop.run_in_executor(None,store.put_derived,path,dst)
+        except Exception as e:              # corrupt media, ffmpeg error, dead worker, store race
+            if isinstance(e,BrokenProcessPool): _POOL=None
+            log.warning("normalize %s failed, sending the original: %s",path.name,e)
+            return path,await loop.run_in_executor(None,kind_of,path)
+        res=(dst,kind)
+    _DONE[path]=res; _DONE.move_to_end(path)
+    while len(_DONE)>_DONE_MAX: _DONE.popitem(last=False)
+    return res
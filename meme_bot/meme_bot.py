@@ -3,18 +3,27 @@
 meme_bot.py – Telegram bridge for meme_fetcher_4 (v1.2, April‑2025)
 
 • /start  → buttons GET MEME | REGISTER | CANCEL | Language switch
-• GET MEME → choose AnyMeme (random) or ByKeyWords
-• Handles per‑user / per‑chat locks via memes_actions_tg_bot
+• GET MEME → choose AnyMeme (random), Album (ALBUM_SIZE memes) or ByKeyWords
+• /get_memes N [keywords] → N memes as one album (send_media_group)
+• Per‑user / per‑chat locks live in memory (LockManager, 10 min expiry)
 • Registration stored in memes_user_list or memes_chat_list
-• Cleans memes/ folder to 500 newest images
+• memes/ is a content-addressed store capped by STORE_MAX_BYTES
+• BOT_MODE=worker runs behind webhook.py's front, one process per core
+• BROADCAST_AT=HH:MM pushes a daily meme to every registered identity (broadcast.py)
+• /profile (ADMIN_IDS) or PROFILE=1: slow-request traces and profiles (profiling.py)
 """
 
 import os, logging, shlex, subprocess, tempfile
 #new line
-import asyncio, functools
+import asyncio, functools, time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import ExitStack, nullcontext
 #from telegram import   
 from pathlib import Path
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup,constants
+from telegram import InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
     MessageHandler, ContextTypes, filters
@@ -23,6 +32,14 @@ from telegram.ext import (
 #from meme_fetcher_4 import Db, make_dsn   # uses your corrected file
 #from meme_fetcher_4 import main as fetch_meme_sync
 import meme_fetcher_4 as mf
+import prefetch
+import afetch
+import webhook
+import broadcast
+import media
+import metrics
+import profiling
+from metrics import STAGE
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(levelname)s %(name)s | %(message)s")
@@ -31,22 +48,127 @@ log = logging.getLogger("bot")
 # ─── constants ────────────────────────────────────────────────────────────
 BTN_GET, BTN_REG, BTN_CANCEL, BTN_LANG = "GET", "REG", "CANCEL", "LANG"
 BTN_ANY, BTN_KEY, BTN_LANG_MEME = "ANY", "KEY", "LANG_MEME"
+BTN_ALBUM = "ALBUM"
 LANG_EN, LANG_RU = 1, 2
 LANG_EN_MEME, LANG_RU_MEME = 1,2
+BOT_DEADLINE = float(os.getenv("BOT_DEADLINE","25"))   # seconds until we give up on a meme
+WRITE_BEHIND = os.getenv("WRITE_BEHIND","1") == "1"     # batch journal/keyword inserts
+IDCACHE_SIZE = int(os.getenv("IDCACHE_SIZE","50000"))     # cached identity lookups
+IDCACHE_TTL  = float(os.getenv("IDCACHE_TTL","60"))       # staleness bound across processes
+LOCK_TTL     = float(os.getenv("LOCK_TTL","600"))         # the "10 min lock" from /start
+LOCK_SWEEP   = float(os.getenv("LOCK_SWEEP","30"))
+LOCK_PERSIST = os.getenv("LOCK_PERSIST","0") == "1"       # write-through to memes_actions_tg_bot
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE","https://api.telegram.org/bot")
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS",str(min(32,(os.cpu_count() or 1)+4))))
+BOT_MODE      = os.getenv("BOT_MODE","polling")             # polling | worker (see webhook.py)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES","64"))  # handlers in flight; LOCKS guard each identity
+FETCH_MAX     = int(os.getenv("FETCH_MAX",str(max(1,mf.PG_POOL_SIZE-2))))   # of those, fetching; leaves connections for lookups and write-behind
+STREAM_MAX    = int(os.getenv("STREAM_MAX","8"))            # STREAM_UPLOAD sends in flight, each holds ≤ DL_MAX_BYTES (an album ≤ its size ×)
+ALBUM_SIZE    = max(2, min(10, int(os.getenv("ALBUM_SIZE","5"))))          # «Album» button; /get_memes N takes 2..10
+ADMIN_IDS     = {int(x) for x in os.getenv("ADMIN_IDS","").split(",") if x.strip()}  # may use /profile
+
+PREFETCHER: prefetch.Prefetcher | None = None
+FETCH_SLOTS = asyncio.Semaphore(FETCH_MAX)       # the DB-bound part of a handler; uploads run unbounded
+STREAM_SLOTS = asyncio.Semaphore(STREAM_MAX)     # PTB buffers the whole upload anyway
 
 # --- helper so we can pass to run_in_executor -----------------------
+@profiling.traced()
 def _fetch_sync(keywords, lang, user, chat):
     """
-    Runs meme_fetcher_4.main() synchronously and
-    returns the Path of the file it downloaded.
+    Serves from the prefetch pool when it has an unseen meme, otherwise
+    runs meme_fetcher_4.main() synchronously and
+    returns its delivery dict (id, url, file_id, path).
     """
-    mf.main(keywords, lang, user, chat)
-    # main() always downloads into mf.DOWNLOAD_DIR and names by time
-    newest = max(
-        (p for p in mf.DOWNLOAD_DIR.iterdir() if p.is_file()),
-        key=lambda p: p.stat().st_mtime
-    )
-    return newest
+    if PREFETCHER:
+        meme = PREFETCHER.serve(keywords, lang, user, chat)
+        if meme: return meme
+    with mf.pooled_db() as db:
+        return mf.main(keywords, lang, user, chat, db=db)
+
+async def _fetch(keywords, lang, user, chat):
+    """The delivery dict: afetch.main() on the loop, or _fetch_sync on a thread."""
+    async with FETCH_SLOTS:
+        return await _fetch_one(keywords, lang, user, chat)
+
+async def _fetch_one(keywords, lang, user, chat):
+    if not afetch.ASYNC_FETCH:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, profiling.bind(_fetch_sync), keywords, lang, user, chat)
+    if PREFETCHER:
+        meme = await afetch.run_db(PREFETCHER.serve, keywords, lang, user, chat)
+        if meme: return meme
+    return await afetch.main(keywords, lang, user, chat)
+
+async def _download(url):
+    if afetch.ASYNC_FETCH: return await afetch.download(url)
+    return await asyncio.get_running_loop().run_in_executor(None, profiling.bind(mf.download), url)
+
+async def _stream(url):
+    if afetch.ASYNC_FETCH: return await afetch.read_stream(url)
+    return await asyncio.get_running_loop().run_in_executor(None, _read_stream, url)
+
+def _read_stream(url):
+    with mf.open_stream(url) as f:
+        return f.read()
+
+def _save_file_id(url_id, file_id):
+    with mf.pooled_db() as db:
+        db.set_file_id(url_id, file_id)
+
+def _save_file_ids(pairs):
+    with mf.pooled_db() as db:
+        db.set_file_ids(pairs)
+
+@profiling.traced()
+def _fetch_many_sync(keywords, lang, user, chat, n):
+    with mf.pooled_db() as db:
+        return mf.main_many(keywords, lang, user, chat, n, db=db)
+
+async def _fetch_many(keywords, lang, user, chat, n):
+    async with FETCH_SLOTS:
+        if afetch.ASYNC_FETCH: return await afetch.main_many(keywords, lang, user, chat, n)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, profiling.bind(_fetch_many_sync), keywords, lang, user, chat, n)
+
+# file_ids of animations/videos are stored as "<kind>:<file_id>"
+SEND = {"photo": "send_photo", "animation": "send_animation", "video": "send_video"}
+ACTION = {"photo": constants.ChatAction.UPLOAD_PHOTO,
+          "animation": constants.ChatAction.UPLOAD_VIDEO,
+          "video": constants.ChatAction.UPLOAD_VIDEO}
+
+def _split_file_id(file_id):
+    kind, _, fid = file_id.rpartition(":")
+    return kind or "photo", fid
+
+def _msg_file_id(msg):
+    if msg.photo: return msg.photo[-1].file_id
+    if msg.animation: return "animation:" + msg.animation.file_id
+    if msg.video: return "video:" + msg.video.file_id
+    return None
+
+async def _send(bot, chat_id, kind, media_, **kw):
+    with STAGE.time(stage=f"send_{kind}"):
+        return await getattr(bot, SEND[kind])(chat_id, media_, **kw)
+
+# media groups take photos and videos only: GIFs go as their MP4 or alone
+INPUT = {"photo": InputMediaPhoto, "video": InputMediaVideo}
+
+async def _album_media(meme, files):
+    """(kind, file_id | bytes | file, save its new file_id?) for one album meme."""
+    fid = meme.get("file_id")
+    if fid:
+        kind, f = _split_file_id(fid)
+        if kind in INPUT: return kind, f, False
+        if meme.get("path") is None and not mf.STREAM_UPLOAD:
+            meme["path"] = await _download(meme["url"])
+    if meme.get("path") is None:
+        data = await _stream(meme["url"])
+        return media.kind_of(data), data, not fid
+    path, kind = await media.prepare(mf.STORE, meme["path"])
+    f = files.enter_context(path.open("rb"))
+    if kind == "animation" and path.suffix == ".mp4":
+        return "video", f, False             # keep the animation file_id for single sends
+    return kind, f, not fid
 
 # ─── helper text -----------------------------------------------------------
 def text_start(lang):
@@ -84,6 +206,10 @@ def text_choose_mode(lang):
             if lang == LANG_EN else
             "Ладно, поехали!  «AnyMeme» — случайный, «ByKeyWords» — по ключу.")
 
+def text_timeout(lang):
+    return ("Sorry, no meme found in time, try again" if lang == LANG_EN
+            else "Извините, мем не нашёлся вовремя, попробуйте ещё раз")
+
 def text_kw_prompt(lang):
     return ("Type key words and send" if lang == LANG_EN
             else "Введите ключевые слова и отправьте сообщение")
@@ -100,48 +226,153 @@ def kb_start(lang):
 def kb_mode(lang):
     lang_btn = "English Language" if lang == LANG_RU else "Русский Язык"
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("AnyMeme",     callback_data=BTN_ANY)],
+        [InlineKeyboardButton("AnyMeme",     callback_data=BTN_ANY),
+         InlineKeyboardButton(f"Album ×{ALBUM_SIZE}", callback_data=BTN_ALBUM)],
         [InlineKeyboardButton("ByKeyWords",  callback_data=BTN_KEY)],
         [InlineKeyboardButton("Cancel",  callback_data=BTN_CANCEL)],
         [InlineKeyboardButton(lang_btn,   callback_data=BTN_LANG_MEME)]
          
     ])
 
+# ─── identity cache --------------------------------------------------------
+_MISS = object()
+
+class IdentityCache:
+    """
+    Bounded TTL/LRU cache for per-identity lookups, keyed by tuples:
+    ("lang", uid, cid), ("reg", uid, cid).
+    BotDB writes through it, so only other processes can make it stale
+    and IDCACHE_TTL bounds that.
+    """
+    def __init__(self, size=IDCACHE_SIZE, ttl=IDCACHE_TTL):
+        self.size, self.ttl = size, ttl
+        self._d = OrderedDict()               # key -> (expires, value)
+    def get(self, key):
+        e = self._d.get(key)
+        if e is None or e[0] < time.monotonic():
+            return _MISS
+        self._d.move_to_end(key)
+        return e[1]
+    def put(self, key, value):
+        self._d[key] = (time.monotonic() + self.ttl, value)
+        self._d.move_to_end(key)
+        while len(self._d) > self.size:
+            self._d.popitem(last=False)
+        return value
+    def drop(self, kind, uid=None, cid=None):
+        for k in [k for k in self._d if k[0] == kind
+                  and (uid is None or k[1] == uid) and (cid is None or k[2] == cid)]:
+            del self._d[k]
+
+IDCACHE = IdentityCache()
+
+# ─── action state / locks --------------------------------------------------
+def _persist_action(uid, cid, aid):
+    try:
+        with mf.pooled_db() as db:
+            if aid:
+                db.cx.cursor().execute(
+                    'INSERT INTO "memes_actions_tg_bot" ("Action_ID","User_ID","Chat_ID") '
+                    'VALUES (?,?,?) ON CONFLICT ("User_ID","Chat_ID") DO UPDATE '
+                    'SET "Action_ID"=EXCLUDED."Action_ID", "date_time_action" = NOW()',
+                    aid, uid, cid)
+            else:
+                db.cx.cursor().execute(
+                    'DELETE FROM "memes_actions_tg_bot" WHERE "User_ID"=? AND "Chat_ID"=?',
+                    uid, cid)
+            db.cx.commit()
+    except Exception as e:
+        log.warning("persist action %s/%s=%s failed: %s", uid, cid, aid, e)
+
+def _load_actions(ttl):
+    with mf.pooled_db() as db:
+        return db.cx.cursor().execute(
+            'SELECT "User_ID","Chat_ID","Action_ID",'
+            ' EXTRACT(EPOCH FROM NOW()-"date_time_action") '
+            'FROM "memes_actions_tg_bot" WHERE "Action_ID">0 '
+            'AND "date_time_action" > NOW() - make_interval(secs => ?)', ttl).fetchall()
+
+class LockManager:
+    """
+    In-memory per-(user, chat) action state 0→1→2→3 that expires after
+    LOCK_TTL. Reads and compare-and-set run on the event loop, so they are
+    atomic between awaits; lock(key) serializes long steps like a meme send.
+    With LOCK_PERSIST=1 transitions are written through to
+    memes_actions_tg_bot in the background and live rows load at startup.
+    """
+    def __init__(self, ttl=LOCK_TTL, persist=LOCK_PERSIST):
+        self.ttl, self.persist = ttl, persist
+        self._state = {}                      # key -> (action, expires)
+        self._locks = {}                      # key -> asyncio.Lock
+    def get(self, key):
+        e = self._state.get(key)
+        return e[0] if e and e[1] > time.monotonic() else 0
+    def set(self, key, aid, write=True):
+        if aid: self._state[key] = (aid, time.monotonic() + self.ttl)
+        else:   self._state.pop(key, None)
+        if write and self.persist:
+            asyncio.get_running_loop().run_in_executor(None, _persist_action, *key, aid)
+    def cas(self, key, expect, new):
+        if self.busy(key) or self.get(key) != expect: return False
+        self.set(key, new); return True
+    def lock(self, key):
+        return self._locks.setdefault(key, asyncio.Lock())
+    def busy(self, key):
+        l = self._locks.get(key)
+        return bool(l and l.locked())
+    def load(self, rows):
+        for uid, cid, aid, age in rows:
+            self._state[(uid, cid)] = (aid, time.monotonic() + self.ttl - float(age))
+    def sweep(self):
+        now = time.monotonic()
+        for k in [k for k, e in self._state.items() if e[1] <= now]:
+            self.set(k, 0)                    # crashed/abandoned flows unlock here
+        for k in [k for k, l in self._locks.items() if not l.locked() and k not in self._state]:
+            del self._locks[k]
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(LOCK_SWEEP)
+            self.sweep()
+
+LOCKS = LockManager()
+
 # ─── DB wrapper ------------------------------------------------------------
 class BotDB(mf.Db):
+    """
+    Borrows a warm connection from the shared pool on first use (cache hits
+    never touch it); close_all returns it. Handlers reach the SQL only via
+    _db_call, so a connection is never held across a send.
+    """
     def __init__(self):
-        dsn, tun = mf.make_dsn()
-        super().__init__(dsn)
-        self.tun = tun
+        self.pool, self.broken, self._cx = mf.get_pool(), False, None
+    @property
+    def cx(self):
+        if self._cx is None:
+            self._cx = profiling.traced_cx(self.pool.get())   # as mf.Db does
+        return self._cx
     def close_all(self):
-        super().close()
-        if self.tun: self.tun.stop()
+        if self._cx is not None:
+            self.pool.put(profiling.raw_cx(self._cx), self.broken)
+            self._cx = None
 
-    # lock helpers
+    # lock helpers (state lives in LOCKS, not in the DB)
     def lock_exists(self, uid, cid):
-        return self.cx.cursor().execute(
-            'SELECT 1 FROM "memes_actions_tg_bot" WHERE "User_ID"=? AND "Chat_ID"=? AND "Action_ID">0',
-            uid, cid).fetchone() is not None
+        return LOCKS.get((uid, cid)) > 0 or LOCKS.busy((uid, cid))
     def action_id(self, uid, cid):
-        row = self.cx.cursor().execute(
-            'SELECT "Action_ID" FROM "memes_actions_tg_bot" '
-            'WHERE "User_ID"=? AND "Chat_ID"=?', uid, cid).fetchone()
-        return row[0] if row else None
+        return LOCKS.get((uid, cid))
     def set_action(self, uid, cid, aid):
         #print(uid, cid, aid)
-        self.cx.cursor().execute(
-            'INSERT INTO "memes_actions_tg_bot" ("Action_ID","User_ID","Chat_ID") '
-            'VALUES (?,?,?) ON CONFLICT ("User_ID","Chat_ID") DO UPDATE '
-            'SET "Action_ID"=EXCLUDED."Action_ID", "date_time_action" = NOW()',
-            aid, uid, cid)
-        self.cx.commit()
+        LOCKS.set((uid, cid), aid)
+    def cas_action(self, uid, cid, expect, new):
+        return LOCKS.cas((uid, cid), expect, new)
     def clear_lock(self, uid, cid):
-        self.cx.cursor().execute(
-            'DELETE FROM "memes_actions_tg_bot" WHERE "User_ID"=? AND "Chat_ID"=?',
-            uid, cid)
-        self.cx.commit()
+        LOCKS.set((uid, cid), 0)
     # language
     def lang(self, uid, cid):
+        lang = IDCACHE.get(("lang", uid, cid))
+        if lang is not _MISS: return lang
+        return IDCACHE.put(("lang", uid, cid), self._lang(uid, cid))
+    def _lang(self, uid, cid):
         if cid:
             row = self.cx.cursor().execute(
                 'SELECT "LANG_ID" FROM "memes_chat_list" WHERE "CHAT_ID_TELEGRAM"=?', cid
@@ -153,6 +384,10 @@ class BotDB(mf.Db):
         return row[0] if row else LANG_EN
     # registration
     def is_registered(self, uid, cid):
+        reg = IDCACHE.get(("reg", 0 if cid else uid, cid))
+        if reg is not _MISS: return reg
+        return IDCACHE.put(("reg", 0 if cid else uid, cid), self._is_registered(uid, cid))
+    def _is_registered(self, uid, cid):
         if cid:
             return self.cx.cursor().execute(
                 'SELECT 1 FROM "memes_chat_list" WHERE "CHAT_ID_TELEGRAM"=?', cid
@@ -170,43 +405,135 @@ class BotDB(mf.Db):
                 'INSERT INTO "memes_user_list" ("USER_ID_TELEGRAM","LANG_ID") VALUES(?,?)',
                 uid, lang_id)
         self.cx.commit()
+        IDCACHE.put(("reg", 0 if cid else uid, cid), True)
+        # the language now comes from the new row
+        if cid: IDCACHE.drop("lang", cid=cid)
+        else:   IDCACHE.drop("lang", uid=uid)
+
+# handlers look identities up through these: a cache miss borrows a pooled
+# connection on DB_EXEC and returns it right away, never across a send
+async def _db_call(method, *args):
+    def call():
+        db = BotDB()
+        try: return getattr(db, method)(*args)
+        finally: db.close_all()
+    return await afetch.run_db(call)
+
+async def _lang(uid, cid):
+    lang = IDCACHE.get(("lang", uid, cid))
+    return lang if lang is not _MISS else await _db_call("lang", uid, cid)
+
+async def _registered(uid, cid):
+    reg = IDCACHE.get(("reg", 0 if cid else uid, cid))
+    return reg if reg is not _MISS else await _db_call("is_registered", uid, cid)
 
 # ─── meme sending helper ----------------------------------------------------
+@profiling.traced()
 async def send_meme(ctx, uid, cid, lang, keywords=None):
     """
-    Fetches a meme in a background thread, prunes cache,
-    and sends the image without blocking the event‑loop.
+    Fetches a meme without blocking the event‑loop (afetch, or a
+    background thread with ASYNC_FETCH=0) and sends it: by cached
+    Telegram file_id when we have one, otherwise by uploading the
+    normalized file (media.py) as a photo, animation or video (and
+    remembering its file_id).
     """
     lang_arg = "rus" if lang == LANG_RU else "eng"
 
     loop = asyncio.get_running_loop()
-    img_path: Path = await loop.run_in_executor(
-        None,
-        _fetch_sync,           # the blocking function
-        keywords, lang_arg,
-        uid if cid == 0 else None,
-        cid  if cid != 0 else None
-    )
-
-    # ---- prune cache to newest 500 files ---------------------------
-    files = sorted(
-        (p for p in mf.DOWNLOAD_DIR.iterdir() if p.is_file()),
-        key=lambda p: p.stat().st_mtime,
-        reverse=True
-    )
-    for old in files[500:]:
+    try:
+        with STAGE.time(stage="fetch"):    # includes the executor queue wait
+            meme: dict = await asyncio.wait_for(_fetch(
+                keywords, lang_arg,
+                uid if cid == 0 else None,
+                cid  if cid != 0 else None
+            ), BOT_DEADLINE)
+    except asyncio.TimeoutError:
+        log.warning("meme for %s/%s missed the %ss deadline", uid, cid, BOT_DEADLINE)
+        await ctx.bot.send_message(chat_id=cid or uid, text=text_timeout(lang))
+        return
+
+    # ---- send by file_id ------------------------------------------
+    chat_id = cid or uid
+    if meme.get("file_id"):
+        kind, fid = _split_file_id(meme["file_id"])
         try:
-            old.unlink()
-        except Exception as e:
-            log.warning("Delete %s failed: %s", old, e)
-
-    # ---- send ------------------------------------------------------
-    await ctx.bot.send_chat_action(chat_id=cid or uid,
-                                   action=constants.ChatAction.UPLOAD_PHOTO)
-    with img_path.open("rb") as f:
-        await ctx.bot.send_photo(chat_id=cid or uid,
-                                 photo=f,
-                                 write_timeout=30)
+            await _send(ctx.bot, chat_id, kind, fid)
+            return
+        except BadRequest as e:
+            log.warning("file_id for %s rejected: %s", meme["url"], e)
+            if not mf.STREAM_UPLOAD:
+                meme["path"] = await _download(meme["url"])
+
+    # ---- upload ----------------------------------------------------
+    path = meme.get("path")
+    if path is None:
+        # stream mode: read the capped body off the loop, skip the temp file;
+        # the body sits in memory until sent, so STREAM_SLOTS bounds the total
+        async with STREAM_SLOTS:
+            with STAGE.time(stage="download"):
+                data = await _stream(meme["url"])
+            kind = media.kind_of(data)
+            await ctx.bot.send_chat_action(chat_id=chat_id, action=ACTION[kind])
+            msg = await _send(ctx.bot, chat_id, kind, data, write_timeout=30)
+    else:
+        with STAGE.time(stage="normalize"):
+            path, kind = await media.prepare(mf.STORE, path)
+        await ctx.bot.send_chat_action(chat_id=chat_id, action=ACTION[kind])
+        with path.open("rb") as f:
+            msg = await _send(ctx.bot, chat_id, kind, f, write_timeout=30)
+    fid = _msg_file_id(msg)
+    if mf.FILE_IDS and fid:
+        await loop.run_in_executor(None, _save_file_id, meme["id"], fid)
+
+@profiling.traced()
+async def send_album(ctx, uid, cid, lang, n, keywords=None):
+    """
+    Up to n memes as one send_media_group: one cached lookup, one round of
+    source calls and one journal batch for the whole album (main_many).
+    """
+    lang_arg = "rus" if lang == LANG_RU else "eng"
+    chat_id = cid or uid
+    try:
+        with STAGE.time(stage="fetch_album"):
+            memes = await asyncio.wait_for(_fetch_many(
+                keywords, lang_arg,
+                uid if cid == 0 else None,
+                cid  if cid != 0 else None, n
+            ), BOT_DEADLINE)
+    except asyncio.TimeoutError:
+        memes = []
+    if not memes:
+        log.warning("album for %s/%s came back empty", uid, cid)
+        await ctx.bot.send_message(chat_id=chat_id, text=text_timeout(lang))
+        return
+
+    async with (STREAM_SLOTS if mf.STREAM_UPLOAD else nullcontext()), ExitStack() as files:
+        items = []
+        for m in memes:
+            try: items.append((m, *await _album_media(m, files)))
+            except Exception as e: log.warning("album: %s skipped: %s", m["url"], e)
+        group = [it for it in items if it[1] in INPUT]
+        alone = [it for it in items if it[1] not in INPUT]
+        if len(group) == 1: alone, group = group + alone, []
+        await ctx.bot.send_chat_action(chat_id=chat_id, action=ACTION["photo"])
+        sent = []
+        if group:
+            try:
+                with STAGE.time(stage="send_album"):
+                    msgs = await ctx.bot.send_media_group(
+                        chat_id, [INPUT[k](x) for _, k, x, _ in group], write_timeout=60)
+                sent += zip(group, msgs)
+            except BadRequest as e:              # e.g. a stale file_id: send one by one
+                log.warning("media group for %s rejected: %s", chat_id, e)
+                alone = group + alone
+        for it in alone:
+            if hasattr(it[2], "seek"): it[2].seek(0)
+            try: sent.append((it, await _send(ctx.bot, chat_id, it[1], it[2], write_timeout=30)))
+            except BadRequest as e: log.warning("album: %s rejected: %s", it[0]["url"], e)
+    pairs = [(m["id"], _msg_file_id(msg)) for (m, _, _, save), msg in sent
+             if save and _msg_file_id(msg)]
+    if mf.FILE_IDS and pairs:
+        await asyncio.get_running_loop().run_in_executor(None, _save_file_ids, pairs)
 
 # ─── handlers ---------------------------------------------------------------
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -214,13 +541,12 @@ async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cid = 0 if update.effective_chat.type == "private" else update.effective_chat.id
     db = BotDB()
     try:
-        lang = db.lang(uid, cid)
+        lang = await _lang(uid, cid)
         ctx.user_data["lang"] = lang
         ctx.user_data["lang_meme"] = 1 if lang == 2 else 2
-        if db.lock_exists(uid, cid):
+        if not db.cas_action(uid, cid, 0, 1):
             await update.message.reply_text(text_lock(lang))
             return
-        db.set_action(uid, cid, 1)
         await update.message.reply_text(text_start(lang), reply_markup=kb_start(lang))
     finally: db.close_all()
 
@@ -230,18 +556,17 @@ async def get_meme(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cid = 0 if update.effective_chat.type == "private" else update.effective_chat.id
     db = BotDB()
     try:
-        lang = db.lang(uid, cid)
+        lang = await _lang(uid, cid)
         ctx.user_data["lang"] = lang
         ctx.user_data["lang_meme"] = 1 if lang == 2 else 2
         lang_meme = ctx.user_data["lang_meme"]
-        if not db.is_registered(uid, cid):
+        if not await _registered(uid, cid):
             await update.message.reply_text(not_yet_registered(lang))
             db.set_action(uid, cid, 0)
             return
-        if db.lock_exists(uid, cid):
+        if not db.cas_action(uid, cid, 0, 2):
             await update.message.reply_text(text_lock(lang))
             return
-        db.set_action(uid, cid, 2)
         await update.message.reply_text(text_choose_mode(lang),
                                           reply_markup=kb_mode(lang_meme))
     finally: db.close_all()
@@ -252,19 +577,50 @@ async def get_any_meme(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cid = 0 if update.effective_chat.type == "private" else update.effective_chat.id
     db = BotDB()
     try:
-        lang = db.lang(uid, cid)
+        lang = await _lang(uid, cid)
         ctx.user_data["lang"] = lang
         ctx.user_data["lang_meme"] = 1 if lang == 2 else 2
         lang_meme = ctx.user_data["lang_meme"]
-        if not db.is_registered(uid, cid):
+        if not await _registered(uid, cid):
+            await update.message.reply_text(not_yet_registered(lang))
+            db.set_action(uid, cid, 0)
+            return
+        if db.lock_exists(uid, cid):
+            await update.message.reply_text(text_lock(lang))
+            return
+        async with LOCKS.lock((uid, cid)):
+            await send_meme(ctx, uid, cid, 1 if lang_meme == 2 else 2)
+            db.set_action(uid, cid, 0)
+    finally: db.close_all()
+
+async def cmd_profile(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """/profile on [cprofile] | off | status | cpu [secs] | mem | dump – ADMIN_IDS only."""
+    if update.effective_user.id not in ADMIN_IDS: return
+    text = await asyncio.get_running_loop().run_in_executor(None, profiling.command, ctx.args or [])
+    await update.message.reply_text(text)
+
+async def get_memes(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """/get_memes [N] [keywords] – an album of N (2..10) memes."""
+    uid = update.effective_user.id
+    cid = 0 if update.effective_chat.type == "private" else update.effective_chat.id
+    args = ctx.args or []
+    count = args and args[0].isascii() and args[0].isdigit()     # not "²" or "٣"
+    n = max(2, min(10, int(args[0]))) if count else ALBUM_SIZE
+    kw = " ".join(args[1:] if count else args).strip() or None
+    db = BotDB()
+    try:
+        lang = await _lang(uid, cid)
+        ctx.user_data["lang"] = lang
+        if not await _registered(uid, cid):
             await update.message.reply_text(not_yet_registered(lang))
             db.set_action(uid, cid, 0)
             return
         if db.lock_exists(uid, cid):
             await update.message.reply_text(text_lock(lang))
             return
-        await send_meme(ctx, uid, cid, 1 if lang_meme == 2 else 2)
-        db.set_action(uid, cid, 0)
+        async with LOCKS.lock((uid, cid)):
+            await send_album(ctx, uid, cid, lang, n, kw)
+            db.set_action(uid, cid, 0)
     finally: db.close_all()
 
 async def cb_query(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -273,7 +629,7 @@ async def cb_query(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cid = 0 if q.message.chat.type == "private" else q.message.chat.id
     db = BotDB()
     try:
-        lang = ctx.user_data.get("lang", db.lang(uid, cid))
+        lang = ctx.user_data.get("lang") or await _lang(uid, cid)
         try:
             lang_meme = ctx.user_data["lang_meme"]
         except:
@@ -298,18 +654,18 @@ async def cb_query(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
         # register
         if q.data == BTN_REG:
-            if db.is_registered(uid, cid):
+            if await _registered(uid, cid):
                 await q.edit_message_text(text_registered(lang),
                                           reply_markup=kb_start(lang))
             else:
-                db.register(uid, cid, lang)
+                await _db_call("register", uid, cid, lang)
                 await q.edit_message_text(text_reg_ok(lang),
                                           reply_markup=kb_start(lang))
             return
 
         # GET MEME
         if q.data == BTN_GET:
-            if db.is_registered(uid, cid):
+            if await _registered(uid, cid):
                 db.set_action(uid, cid, 2)          # select mode
                 await q.edit_message_text(text_choose_mode(lang),
                                           reply_markup=kb_mode(lang_meme))
@@ -320,17 +676,26 @@ async def cb_query(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
         # AnyMeme
         if q.data == BTN_ANY:
-            if db.action_id(uid, cid) != 2:
+            if LOCKS.busy((uid, cid)) or db.action_id(uid, cid) != 2:
                 await q.answer(text_lock(lang)); return
-            await send_meme(ctx, uid, cid, 1 if lang_meme == 2 else 2)
-            db.set_action(uid, cid, 0)
+            async with LOCKS.lock((uid, cid)):
+                await send_meme(ctx, uid, cid, 1 if lang_meme == 2 else 2)
+                db.set_action(uid, cid, 0)
+            return
+
+        # Album
+        if q.data == BTN_ALBUM:
+            if LOCKS.busy((uid, cid)) or db.action_id(uid, cid) != 2:
+                await q.answer(text_lock(lang)); return
+            async with LOCKS.lock((uid, cid)):
+                await send_album(ctx, uid, cid, 1 if lang_meme == 2 else 2, ALBUM_SIZE)
+                db.set_action(uid, cid, 0)
             return
 
         # ByKeyWords
         if q.data == BTN_KEY:
-            if db.action_id(uid, cid) != 2:
+            if not db.cas_action(uid, cid, 2, 3):
                 await q.answer(text_lock(lang)); return
-            db.set_action(uid, cid, 3)
             await q.edit_message_text(text_kw_prompt(lang));
             #db.set_action(uid, cid, 0)
             return
@@ -347,30 +712,75 @@ async def cb_query(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def txt_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     cid = 0 if update.effective_chat.type == "private" else update.effective_chat.id
+    if LOCKS.busy((uid, cid)) or LOCKS.get((uid, cid)) != 3:
+        return                   # not waiting for keywords – no DB, no cache
     db = BotDB()
     try:
-        if db.action_id(uid, cid) != 3: return   # not waiting for keywords
-        lang = ctx.user_data.get("lang", db.lang(uid, cid))
+        lang = ctx.user_data.get("lang") or await _lang(uid, cid)
         try:
             lang_meme = 1 if ctx.user_data["lang_meme"] == 2 else 2 
         except:
             lang_meme = lang 
         kw = update.message.text.strip()
-        await send_meme(ctx, uid, cid, lang_meme, kw)
-        db.set_action(uid, cid, 0)
+        async with LOCKS.lock((uid, cid)):
+            await send_meme(ctx, uid, cid, lang_meme, kw)
+            db.set_action(uid, cid, 0)
     finally:
         db.close_all()
         #pass
 # ─── main -------------------------------------------------------------------
+async def _post_init(app):
+    global PREFETCHER
+    # start the tunnel and open warm connections before the first update
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
+    loop.set_default_executor(pool)
+    metrics.QUEUE.track(lambda: metrics.executor_depth(pool), executor="fetch")
+    app.bot_data["metrics"] = metrics.serve()
+    await loop.run_in_executor(None, mf.get_pool().warm)
+    if WRITE_BEHIND: mf.start_write_behind()
+    if mf.PHASH:
+        await loop.run_in_executor(None, mf.load_near_index)
+    if LOCK_PERSIST:
+        LOCKS.load(await loop.run_in_executor(None, _load_actions, LOCK_TTL))
+    app.bot_data["lock_sweeper"] = loop.create_task(LOCKS.run_sweeper())
+    if prefetch.PREFETCH:
+        PREFETCHER = prefetch.Prefetcher()
+        app.bot_data["prefetch_task"] = loop.create_task(PREFETCHER.run())
+    if broadcast.BROADCAST_AT:
+        app.bot_data["broadcast"] = loop.create_task(broadcast.scheduler(app.bot))
+
+async def _post_shutdown(app):
+    for name in ("prefetch_task", "lock_sweeper", "broadcast"):
+        task = app.bot_data.get(name)
+        if task: task.cancel()
+    if PREFETCHER: PREFETCHER.close()
+    media.shutdown()
+    await afetch.aclose()
+    srv = app.bot_data.get("metrics")
+    if srv: srv.shutdown()
+    await asyncio.get_running_loop().run_in_executor(None, mf.stop_write_behind)
+    mf.close_pool()
+
 def main():
-    token = 'my_token'          # export or .env
-    app = ApplicationBuilder().token(token).build()
+    token = os.getenv("TELEGRAM_TOKEN")
+    if not token: raise SystemExit("TELEGRAM_TOKEN is not set")
+    builder = (ApplicationBuilder().token(token)
+               .base_url(TELEGRAM_API_BASE).concurrent_updates(CONCURRENT_UPDATES)
+               .post_init(_post_init).post_shutdown(_post_shutdown))
+    if BOT_MODE == "worker": builder = builder.updater(None)
+    app = builder.build()
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("get_meme", get_meme))
     app.add_handler(CommandHandler("get_any_meme", get_any_meme))
+    app.add_handler(CommandHandler("get_memes", get_memes))
+    app.add_handler(CommandHandler("profile", cmd_profile))
     app.add_handler(CallbackQueryHandler(cb_query))
     app.add_handler(MessageHandler(~filters.COMMAND, txt_handler))
-    app.run_polling()
+    if BOT_MODE == "worker":
+        asyncio.run(webhook.run_worker(app))     # updates arrive from webhook.py's front
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -6,19 +6,38 @@ meme_fetcher.py  v4.0  (per‑user / per‑chat logic)
 Usage examples
 --------------
 # random ENG meme for user 42
-python meme_fetcher.py --user 42
+python meme_fetcher_4.py --user 42
 
 # RU meme about cats for chat 777
-python meme_fetcher.py "кот" rus --chat 777
+python meme_fetcher_4.py "кот" rus --chat 777
+
+# bulk: one JSON job per line, {"user"|"chat": id, "keywords": .., "lang": .., "id": ..}
+python meme_fetcher_4.py --bulk jobs.jsonl --workers 32 --out results.jsonl --resume
+python meme_fetcher_4.py --bulk - --dry-run < jobs.jsonl     # resolve only, no writes
 """
 
-import os, sys, random, re, requests, argparse, time
+import os, sys, json, random, re, requests, argparse, time, threading, queue, hashlib, tempfile, math
+import asyncio
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED, ALL_COMPLETED
+from contextlib import contextmanager
 from pathlib import Path
 from urllib.parse import quote_plus, urlparse
+from email.utils import parsedate_to_datetime
+import logging
 import pyodbc
 from sshtunnel import SSHTunnelForwarder
 import giphy_client
 from giphy_client.rest import ApiException
+from store import Store
+import media
+import profiling
+from profiling import traced
+from metrics import (STAGE, SOURCE, CACHED, FALLBACK, BREAKER, NEAR_DUP, QUEUE, DL_BYTES, COALESCED, WB_ERRORS,
+                     PHASHES, executor_depth)
+
+log = logging.getLogger("fetcher")
 
 # ─── CONFIG ─────────────────────────────────────────────────────────────────
 GIPHY_KEY = os.getenv("GIPHY_KEY")
@@ -32,12 +51,76 @@ PG_PORT   = int(os.getenv("PG_PORT","my_port"))
 PG_DB     = os.getenv("PG_DB","postgres")
 PG_UID    = os.getenv("PG_UID","postgres")
 PG_PWD    = os.getenv("PG_PWD","")
+PG_SCHEMA = os.getenv("PG_SCHEMA")                            # search_path override (bench)
+
+# source endpoints – overridable so bench/ can point them at local stubs
+REDDIT_BASE   = os.getenv("REDDIT_BASE","https://www.reddit.com")
+MEME_API_BASE = os.getenv("MEME_API_BASE","https://meme-api.com")
+PIKABU_BASE   = os.getenv("PIKABU_BASE","https://api.pikabu.ru")
+GIPHY_HOST    = os.getenv("GIPHY_HOST")                       # e.g. http://127.0.0.1:8081/v1
+
+PG_POOL_SIZE    = int(os.getenv("PG_POOL_SIZE","8"))
+PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT","10"))  # wait for a free connection
+PG_POOL_PING    = float(os.getenv("PG_POOL_PING","30"))     # idle secs before health check
+
+BLOOM        = os.getenv("BLOOM","1")!="0"                   # per-identity seen-URL filter
+BLOOM_BITS   = int(os.getenv("BLOOM_BITS",str(1<<18)))       # 32 KiB per identity
+BLOOM_K      = int(os.getenv("BLOOM_K","7"))
+BLOOM_MAX_ID = int(os.getenv("BLOOM_MAX_ID","2000"))         # identities kept (LRU)
+BLOOM_LAG    = int(os.getenv("BLOOM_LAG","5000"))            # journal IDs re-read: commits land out of ID order
+SEEN_BATCH   = 500                                           # hashes per anti-join
+
+UNSEEN_QUEUE = os.getenv("UNSEEN_QUEUE","0")=="1"            # needs `python migrate.py`
+
+KW_INDEX = os.getenv("KW_INDEX","0")=="1"                    # stemmed keyword column (migrate.py)
+KW_FUZZY = os.getenv("KW_FUZZY","1")=="1"                    # + pg_trgm ranked fallback
+
+PHASH         = os.getenv("PHASH","0")=="1"                  # near-duplicate skip (migrate.py)
+PHASH_DIST    = int(os.getenv("PHASH_DIST","6"))             # max differing dHash bits
+PHASH_SCAN    = 20                                           # extra cached rows to look past
+PHASH_RETRY   = 3                                            # external picks per request
+PHASH_REFRESH = float(os.getenv("PHASH_REFRESH","60"))       # pull other processes' hashes
+
+FANOUT         = os.getenv("FANOUT","1")=="1"                # query sources concurrently
+FANOUT_MODE    = os.getenv("FANOUT_MODE","first")            # first | merge
+FANOUT_GRACE   = float(os.getenv("FANOUT_GRACE","1.5"))      # wait for a preferred source
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS","16"))
+FETCH_DEADLINE = float(os.getenv("FETCH_DEADLINE","15"))     # whole external search
+HEDGE          = os.getenv("HEDGE","1")=="1"                 # duplicate calls slower than p95
+HEDGE_MIN_SAMPLES = 20
+
+SRC_ADAPTIVE    = os.getenv("SRC_ADAPTIVE","1")=="1"         # reorder sources by score
+SRC_WINDOW      = 100                                        # rolling outcomes per source
+SRC_MIN_SAMPLES = 10                                         # before a source is scored
+SRC_BREAK_AFTER = int(os.getenv("SRC_BREAK_AFTER","3"))      # straight failures → open
+SRC_BACKOFF     = float(os.getenv("SRC_BACKOFF","5"))        # first pause, doubles
+SRC_BACKOFF_MAX = float(os.getenv("SRC_BACKOFF_MAX","300"))
+
+FILE_IDS = os.getenv("FILE_IDS","0")=="1"                   # reuse Telegram file_ids (migrate.py)
+
+UPSERT_URLS  = os.getenv("UPSERT_URLS","0")=="1"            # one-statement url id (migrate.py)
+WB_BATCH     = int(os.getenv("WB_BATCH","200"))              # write-behind flush size
+WB_INTERVAL  = float(os.getenv("WB_INTERVAL","1.0"))         # ... or age in seconds
+WB_MAX       = int(os.getenv("WB_MAX","50000"))              # buffered rows; newer ones dropped beyond
+WB_RETRIES   = 3                                             # failed flushes before rows go one by one
+WB_BACKOFF   = float(os.getenv("WB_BACKOFF","30"))           # cap on the wait between failing flushes
+SQL_ROWS     = 500                                           # rows per multi-row INSERT
+
+CAND_TTL = float(os.getenv("CAND_TTL","600"))               # search results reuse window
+CAND_MAX = int(os.getenv("CAND_MAX","512"))                 # (keyword, lang, source) entries
 
 #Windows Version
 #DOWNLOAD_DIR = Path("memes"); DOWNLOAD_DIR.mkdir(exist_ok=True)
 #linux version
-DOWNLOAD_DIR = Path(__file__).parent.resolve() / "memes"
+DOWNLOAD_DIR = Path(os.getenv("MEME_DIR") or Path(__file__).parent.resolve() / "memes")
 DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+STORE_MAX_BYTES = int(os.getenv("STORE_MAX_BYTES",str(512<<20)))
+STORE = Store(DOWNLOAD_DIR, STORE_MAX_BYTES)
+DL_BYTES.track(lambda: STORE.total)
+
+DL_MAX_BYTES  = int(os.getenv("DL_MAX_BYTES",str(20<<20)))   # reject bigger media
+DL_CHUNK      = 64<<10
+STREAM_UPLOAD = os.getenv("STREAM_UPLOAD","0")=="1"          # pipe to Telegram, no file
 
 # ─── UTILS ──────────────────────────────────────────────────────────────────
 CYRILLIC_RE = re.compile('[а-яА-ЯёЁ]')
@@ -45,20 +128,59 @@ HEADERS = {'User-Agent': 'MemeFetcher/4.0'}
 
 def is_cyrillic(txt:str)->bool: return bool(CYRILLIC_RE.search(txt))
 
+def url_hash(url:str)->str:
+    """Same value as Postgres md5("url") – the key of the blacklist anti-join."""
+    return hashlib.md5(url.encode()).hexdigest()
+
 ENG_SUBS = ['memes','dankmemes','me_irl']
 RUS_SUBS = ['ru_memes','RussianMemes','pikabu']
 
 # ─── EXTERNAL SOURCES ───────────────────────────────────────────────────────
-def meme_api_random(sub:str)->dict:
-    data=requests.get(f'https://meme-api.com/gimme/{sub}',timeout=20).json()
+class RateLimited(RuntimeError):
+    """429/503 or an exhausted quota; the source pauses for retry_after seconds."""
+    def __init__(self,msg:str,retry_after:float):
+        super().__init__(msg); self.retry_after=retry_after
+
+def _retry_after(h)->float|None:
+    """Seconds to wait per Retry-After (delta or HTTP date) or X-Ratelimit-* headers."""
+    v=h.get("Retry-After")
+    if v:
+        try: return max(0.0,float(v))
+        except ValueError:
+            try: return max(0.0,parsedate_to_datetime(v).timestamp()-time.time())
+            except (TypeError,ValueError): pass
+    try:
+        if float(h.get("X-Ratelimit-Remaining","1"))<1:
+            return float(h.get("X-Ratelimit-Reset") or SRC_BACKOFF)
+    except ValueError: pass
+    return None
+
+def _get_json(source:str, url:str, **kw):
+    r=requests.get(url,timeout=20,**kw)
+    wait=_retry_after(r.headers)
+    if r.status_code in (429,503):
+        raise RateLimited(f"{source}: HTTP {r.status_code}",wait or SRC_BACKOFF)
+    r.raise_for_status()
+    if wait: SOURCES.cooldown(source,wait)       # quota spent: answer now, pause after
+    return r.json()
+
+# url builders / parsers are shared with the async fetcher (afetch.py)
+def _meme_api_url(sub:str)->str: return f'{MEME_API_BASE}/gimme/{sub}'
+
+def _parse_meme_api(data:dict, sub:str)->dict:
     return {'url':data['url'],'title':data['title'],'source':f"meme-api/{sub}"}
 
+def meme_api_random(sub:str)->dict:
+    return _parse_meme_api(_get_json("meme-api",_meme_api_url(sub)),sub)
+
+def _reddit_url(q:str)->str:
+    return ( f"{REDDIT_BASE}/search.json?q="+quote_plus(q)+
+             "&sort=relevance&t=year&limit=100" )
+
 def reddit_search(q:str, subs:list[str], lang:str)->list[dict]:
-    url = ( "https://www.reddit.com/search.json?q="+quote_plus(q)+
-            "&sort=relevance&t=year&limit=100" )
-    try:
-        js=requests.get(url,headers=HEADERS,timeout=20).json()
-    except: return []
+    return _parse_reddit(_get_json("reddit",_reddit_url(q),headers=HEADERS),lang)
+
+def _parse_reddit(js:dict, lang:str)->list[dict]:
     out=[]
     for ch in js.get("data",{}).get("children",[]):
         d=ch["data"]
@@ -74,10 +196,15 @@ def reddit_search(q:str, subs:list[str], lang:str)->list[dict]:
 def giphy_ru_search(q:str)->list[dict]:
     if not GIPHY_KEY: return []
     api=giphy_client.DefaultApi()
+    if GIPHY_HOST:
+        api.api_client.host=GIPHY_HOST
+        api.api_client.configuration.host=GIPHY_HOST
     try:
         rsp=api.gifs_search_get(GIPHY_KEY,q,lang="ru",limit=25,rating="pg-13")
-    except ApiException:
-        return []
+    except ApiException as e:
+        if e.status==429:
+            raise RateLimited("giphy: HTTP 429",_retry_after(e.headers or {}) or SRC_BACKOFF) from e
+        raise
     out=[]
     for g in rsp.data:
         out.append({'url':g.images.original.url,
@@ -85,12 +212,20 @@ def giphy_ru_search(q:str)->list[dict]:
                     'source':f"giphy/{g.id}"})
     return out
 
+def _parse_giphy(js:dict, q:str)->list[dict]:
+    """giphy_ru_search() output from the raw REST JSON (async path)."""
+    return [{'url':g['images']['original']['url'],
+             'title':g.get('title') or q,
+             'source':f"giphy/{g['id']}"} for g in js.get('data',[])]
+
+def _pikabu_url(tag:str|None)->str:
+    return (f"{PIKABU_BASE}/v1/story?tag={quote_plus(tag)}"
+            if tag else f"{PIKABU_BASE}/v1/post/random")
+
 def pikabu_ru(tag:str|None=None)->list[dict]:
-    url = (f"https://api.pikabu.ru/v1/story?tag={quote_plus(tag)}"
-           if tag else "https://api.pikabu.ru/v1/post/random")
-    try:
-        js=requests.get(url,timeout=20).json()
-    except: return []
+    return _parse_pikabu(_get_json("pikabu",_pikabu_url(tag)))
+
+def _parse_pikabu(js:dict)->list[dict]:
     posts=js.get("stories") or js.get("posts") or []
     out=[]
     for p in posts:
@@ -100,52 +235,608 @@ def pikabu_ru(tag:str|None=None)->list[dict]:
                     'source':f"pikabu/{p.get('story_id',p.get('id'))}"})
     return out
 
-def pick_english_meme(key:str|None)->dict:
-    if key:
-        cand=reddit_search(key,ENG_SUBS,'eng')
+# ─── SOURCE REGISTRY ────────────────────────────────────────────────────────
+_LAT:dict[str,deque]=defaultdict(lambda: deque(maxlen=200))   # seconds per source
+
+class NoResult(list):
+    """The empty result of a failed call; unlike a search that found nothing it is not cached."""
+
+class Source:
+    """
+    One pluggable source: search(key, lang) -> [meme]. Keeps rolling success,
+    yield (share of results the identity had not seen) and latency, and a
+    circuit breaker: SRC_BREAK_AFTER straight failures – or one rate limit –
+    pause the source with doubling backoff, then a single probe call decides.
+    """
+    def __init__(self,name:str,search,langs=("eng","rus"),priority:int=0,cached:bool=True,
+                 asearch=None):
+        self.name=name; self.search=search; self.asearch=asearch; self.langs=tuple(langs)
+        self.priority=priority; self.cached=cached
+        self.ok:deque=deque(maxlen=SRC_WINDOW)       # 1 success / 0 error
+        self.hits:deque=deque(maxlen=SRC_WINDOW)     # accepted share of one result
+        self.fails=0; self.tripped=False
+        self.open_until=0.0; self.probe_until=0.0
+        self._lock=threading.Lock()
+
+    def available(self,now:float)->bool:
+        """False while paused; after the pause one caller gets to probe."""
+        with self._lock:
+            if now<self.open_until: return False
+            if not self.tripped: return True
+            if now<self.probe_until: return False
+            self.probe_until=now+FETCH_DEADLINE; return True
+
+    def call(self,key:str|None,lang:str)->list[dict]:
+        t=time.monotonic()
+        try:
+            out=self.search(key,lang)
+        except RateLimited as e:
+            self._fail(e,e.retry_after); return NoResult()
+        except Exception as e:
+            self._fail(e,None); return NoResult()
+        finally:
+            self._timed(t)
+        self._ok(); return out
+
+    async def acall(self,key:str|None,lang:str)->list[dict]:
+        """call() for the event loop: asearch, or search on the source pool."""
+        t=time.monotonic()
+        try:
+            out=await (self.asearch(key,lang) if self.asearch else
+                       asyncio.get_running_loop().run_in_executor(_SRC_POOL,self.search,key,lang))
+        except RateLimited as e:
+            self._fail(e,e.retry_after); return NoResult()
+        except Exception as e:
+            self._fail(e,None); return NoResult()
+        finally:
+            self._timed(t)
+        self._ok(); return out
+
+    def _timed(self,t:float):
+        dt=time.monotonic()-t
+        _LAT[self.name].append(dt); SOURCE.observe(dt,source=self.name)
+
+    def _ok(self):
+        with self._lock:
+            self.ok.append(1); self.fails=0; self.tripped=False
+
+    def _fail(self,err:Exception,wait:float|None):
+        with self._lock:
+            self.ok.append(0); self.fails+=1
+            if wait is None:
+                if self.fails<SRC_BREAK_AFTER: return
+                wait=min(SRC_BACKOFF_MAX,SRC_BACKOFF*2**(self.fails-SRC_BREAK_AFTER))
+            self.open_until=time.monotonic()+wait; self.tripped=True
+        log.warning("source %s paused for %.1fs: %s",self.name,wait,err)
+
+    def cooldown(self,wait:float):
+        with self._lock: self.open_until=max(self.open_until,time.monotonic()+wait)
+
+    def note_yield(self,got:int,total:int):
+        self.hits.append(got/total if total else 0.0)
+
+    def score(self)->float|None:
+        """success rate × yield / median latency; None until SRC_MIN_SAMPLES calls."""
+        if len(self.ok)<SRC_MIN_SAMPLES: return None
+        lat=sorted(_LAT[self.name]); p50=lat[len(lat)//2] if lat else 1.0
+        y=sum(self.hits)/len(self.hits) if self.hits else 0.0
+        return sum(self.ok)/len(self.ok)*y/max(p50,0.05)
+
+class SourceRegistry:
+    def __init__(self):
+        self._src:dict[str,Source]={}
+
+    def register(self,name:str,search,langs=("eng","rus"),priority:int|None=None,
+                 cached:bool=True,asearch=None)->Source:
+        """
+        Add (or replace) a source; lower priority is asked first until scored.
+        asearch(key, lang) is an optional coroutine twin used by afetch.py.
+        """
+        s=Source(name,search,langs,len(self._src) if priority is None else priority,cached,
+                 asearch)
+        self._src[name]=s
+        BREAKER.track(lambda: int(time.monotonic()<s.open_until),source=name)
+        return s
+
+    def __getitem__(self,name:str)->Source:
+        return self._src[name]
+
+    def cooldown(self,name:str,wait:float):
+        s=self._src.get(name)
+        if s: s.cooldown(wait)
+
+    def note_yield(self,name:str,got:int,total:int):
+        s=self._src.get(name)
+        if s: s.note_yield(got,total)
+
+    def ordered(self,lang:str)->list[Source]:
+        """Sources for lang: unscored ones first (to gather samples), then best score."""
+        srcs=sorted((s for s in self._src.values() if lang in s.langs),key=lambda s:s.priority)
+        if SRC_ADAPTIVE:
+            sc={s.name:s.score() for s in srcs}
+            srcs.sort(key=lambda s: -math.inf if sc[s.name] is None else -sc[s.name])
+        return srcs
+
+SOURCES=SourceRegistry()
+register_source=SOURCES.register
+
+def _reddit(key,lang):
+    return reddit_search(key or ("мем" if lang=="rus" else "meme"),
+                         RUS_SUBS if lang=="rus" else ENG_SUBS,lang)
+
+register_source("reddit",_reddit,langs=("eng","rus"))
+register_source("meme-api",lambda key,lang: [meme_api_random(random.choice(ENG_SUBS))],
+                langs=("eng",),cached=False)
+register_source("giphy",lambda key,lang: giphy_ru_search(key or "мем"),langs=("rus",))
+register_source("pikabu",lambda key,lang: pikabu_ru(key),langs=("rus",))
+
+# ─── FAN-OUT ────────────────────────────────────────────────────────────────
+_SRC_POOL=ThreadPoolExecutor(max_workers=FANOUT_WORKERS,thread_name_prefix="src")
+QUEUE.track(lambda: executor_depth(_SRC_POOL),executor="sources")
+
+def _p95(name:str)->float|None:
+    lat=sorted(_LAT[name])
+    return lat[int(len(lat)*.95)] if len(lat)>=HEDGE_MIN_SAMPLES else None
+
+def fan_out(calls:list[tuple], accept=None, merge:bool=False,
+            deadline:float|None=None)->list[dict]:
+    """
+    Query every (name, fn, args) source at once, in priority order.
+    first: the best-priority hit, waiting at most FANOUT_GRACE for earlier sources
+    merge: all hits collected until every source answered or the deadline passed
+    A source still running after its p95 gets one hedged duplicate; stragglers
+    are abandoned (queued ones cancelled, running ones left to time out).
+    """
+    accept=accept or (lambda c,name=None: c)
+    n=len(calls); now=time.monotonic()
+    end=now+(deadline if deadline is not None else FETCH_DEADLINE)
+    owner={}; live=[0]*n; res:list=[None]*n; t0=[now]*n; hedged=set(); first_hit=None
+    def launch(i):
+        name,fn,args=calls[i]
+        f=_SRC_POOL.submit(fn,*args); owner[f]=i; live[i]+=1
+    for i in range(n): launch(i)
+    while True:
+        now=time.monotonic()
+        hits=[i for i in range(n) if res[i]]
+        if all(r is not None for r in res): break
+        if hits and not merge and (all(res[j] is not None for j in range(hits[0]))
+                                   or now>=first_hit+FANOUT_GRACE): break
+        if now>=end: break
+        timeout=end-now
+        if first_hit and not merge: timeout=min(timeout,first_hit+FANOUT_GRACE-now)
+        if HEDGE:
+            for i in range(n):
+                p=_p95(calls[i][0])
+                if res[i] is not None or i in hedged or p is None: continue
+                if now>=t0[i]+p: launch(i); hedged.add(i)
+                else: timeout=min(timeout,t0[i]+p-now)
+        done,_=wait(list(owner),timeout=timeout,return_when=FIRST_COMPLETED)
+        for f in done:
+            i=owner.pop(f); live[i]-=1
+            if res[i]: continue
+            try: got=accept(f.result(),calls[i][0])
+            except Exception: got=[]
+            if got:
+                res[i]=got; first_hit=first_hit or time.monotonic()
+            elif live[i]==0: res[i]=[]
+    for f in owner: f.cancel()
+    if merge: return [m for r in res if r for m in r]
+    return next((r for r in res if r),[])
+
+# ─── KEYWORDS ───────────────────────────────────────────────────────────────
+_PUNCT_RE=re.compile(r"[^\w\s]|_")
+_RU_ENDINGS=sorted(("иями","ями","ами","ого","его","ому","ему","ыми","ими","иях","ах","ях",
+                    "ией","ия","ие","ий","ый","ой","ей","ая","яя","ое","ее","ые","ых","их",
+                    "ом","ем","ам","ям","ов","ев","ую","юю","ть","ться","а","я","о","е",
+                    "ы","и","у","ю","ь","й"),key=len,reverse=True)
+
+def norm_key(key:str|None)->str:
+    """casefold, ё→е, punctuation → space, single spaces."""
+    return " ".join(_PUNCT_RE.sub(" ",(key or "").casefold().replace("ё","е")).split())
+
+def _stem(w:str)->str:
+    """Light suffix stripping: кошки/кошка → кошк, memes/meme → mem, cats → cat."""
+    if CYRILLIC_RE.search(w):
+        for e in _RU_ENDINGS:
+            if w.endswith(e) and len(w)-len(e)>=3: return w[:-len(e)]
+        return w
+    if w.endswith("ies") and len(w)>4: w=w[:-3]+"y"
+    elif w.endswith("sses"): w=w[:-2]
+    elif w.endswith("s") and not w.endswith(("ss","us","is")) and len(w)>3: w=w[:-1]
+    for e in ("ing","ed"):
+        if w.endswith(e) and len(w)-len(e)>=3: w=w[:-len(e)]; break
+    return w[:-1] if w.endswith("e") and len(w)>3 else w
+
+def stem_key(key:str|None)->str|None:
+    """Normalized, stemmed keyword (KW_INDEX key); None for an empty query."""
+    words=[_stem(w) for w in norm_key(key).split()]
+    return " ".join(dict.fromkeys(words)) or None
+
+def _kw(key:str|None)->str|None:
+    """The value compared with stored keywords: stemmed with KW_INDEX, raw otherwise."""
+    return stem_key(key) if KW_INDEX else key
+
+# ─── SINGLE-FLIGHT ──────────────────────────────────────────────────────────
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one execution of fn and get
+    its result (or exception). A call only joins a flight younger than
+    max_age, so a hedge fired after a source's p95 starts a fresh one.
+    """
+    def __init__(self,kind:str):
+        self.kind=kind; self._d:dict={}      # key -> (started, Future)
+        self._lock=threading.Lock()
+
+    def do(self,key,fn,*args,max_age:float|None=None):
+        now=time.monotonic()
+        with self._lock:
+            e=self._d.get(key)
+            if e and (max_age is None or now-e[0]<max_age):
+                COALESCED.inc(kind=self.kind); fut=e[1]; lead=False
+            else:
+                e=self._d[key]=(now,Future()); fut=e[1]; lead=True
+        if not lead: return fut.result()
+        try: fut.set_result(fn(*args))
+        except BaseException as err: fut.set_exception(err)
+        finally:
+            with self._lock:
+                if self._d.get(key) is e: del self._d[key]
+        return fut.result()
+
+SEARCHES=SingleFlight("search")          # (source, keyword, lang) → candidate list
+DOWNLOADS=SingleFlight("download")       # url → stored path
+
+# ─── CANDIDATE CACHE ────────────────────────────────────────────────────────
+
+class CandidateCache:
+    """
+    TTL + LRU cache of search results keyed by (source, keyword, lang).
+    A result list is fetched once and its memes are handed out without
+    repeats (claim) until it runs dry or expires.
+    """
+    def __init__(self,ttl:float=CAND_TTL,size:int=CAND_MAX):
+        self.ttl=ttl; self.size=size
+        self._d:OrderedDict=OrderedDict()       # key -> (expires, {url: meme}, fetched count)
+        self._lock=threading.Lock()
+
+    def get(self,key:tuple,fn,args:tuple)->list[dict]:
+        """Cached candidates; on a miss one search per key runs, concurrent misses share it."""
+        cand=self.peek(key)
+        if cand is not None: return cand
+        return SEARCHES.do(key,self._fill,key,fn,args,max_age=_p95(key[0]) if HEDGE else None)
+
+    def _fill(self,key:tuple,fn,args:tuple)->list[dict]:
+        cand=self.peek(key)                  # a flight that just ended may have filled it
+        return cand if cand is not None else self.put(key,fn(*args))
+
+    def peek(self,key:tuple)->list[dict]|None:
+        with self._lock:
+            e=self._d.get(key)
+            if e and e[0]>time.monotonic() and (e[1] or not e[2]):   # claimed dry: refetch
+                self._d.move_to_end(key); return list(e[1].values())
+        return None
+
+    def put(self,key:tuple,cand:list[dict])->list[dict]:
+        if isinstance(cand,NoResult): return cand
         random.shuffle(cand)
-        return cand[0] if cand else meme_api_random(random.choice(ENG_SUBS))
-    return meme_api_random(random.choice(ENG_SUBS))
-
-def pick_russian_meme(key:str|None)->dict:
-    cand=reddit_search(key or "мем",RUS_SUBS,"rus")
-    if cand: random.shuffle(cand); return cand[0]
-    cand=giphy_ru_search(key or "мем")
-    if cand: random.shuffle(cand); return cand[0]
-    cand=pikabu_ru(key)
-    if cand: random.shuffle(cand); return cand[0]
+        with self._lock:
+            self._d[key]=(time.monotonic()+self.ttl,{c['url']:c for c in cand},len(cand))
+            self._d.move_to_end(key)
+            while len(self._d)>self.size: self._d.popitem(last=False)
+        return cand
+
+    def claim(self,key:tuple,url:str):
+        with self._lock:
+            e=self._d.get(key)
+            if e: e[1].pop(url,None)
+
+    def clear(self):
+        with self._lock: self._d.clear()
+
+CAND_CACHE=CandidateCache()
+
+def _acceptor(blacklist, origin:dict|None=None, taken=frozenset()):
+    """
+    Shuffle a source's candidates and drop the ones the identity has seen
+    (or that are already `taken`); feeds the source's yield and maps
+    accepted urls to it in `origin`.
+    """
+    def accept(cand:list[dict], name:str|None=None)->list[dict]:
+        cand=[c for c in cand if c['url'] not in taken]; random.shuffle(cand); got=cand
+        if blacklist is not None and cand:
+            ok=set(blacklist.filter([c['url'] for c in cand]))
+            got=[c for c in cand if c['url'] in ok]
+        if name:
+            SOURCES.note_yield(name,len(got),len(cand))
+            if origin is not None: origin.update((c['url'],name) for c in got)
+        return got
+    return accept
+
+def _pick(lang:str, key:str|None, blacklist, deadline, claim:bool=True)->dict|None:
+    got=_pick_n(lang,key,blacklist,deadline,1,claim=claim)
+    return got[0] if got else None
+
+def _sources(lang:str, key:str|None, k:int)->list:
+    """Usable SOURCES for lang; a keyless ENG album is k random meme-api calls."""
+    srcs=[s for s in SOURCES.ordered(lang) if s.available(time.monotonic())]
+    if lang=="eng" and not key: srcs=[s for s in srcs if s.name=="meme-api"]*k
+    return srcs
+
+def _pick_n(lang:str, key:str|None, blacklist, deadline, k:int, taken=frozenset(),
+            claim:bool=True)->list[dict]:
+    """
+    Up to k distinct memes from one round over the usable SOURCES; cached
+    sources' searches go through CAND_CACHE (claim=False only peeks).
+    """
+    srcs=_sources(lang,key,k)
+    ckey=(norm_key(key),lang); origin={}
+    accept=_acceptor(blacklist,origin,taken)
+    calls=[(s.name,CAND_CACHE.get,((s.name,)+ckey,s.call,(key,lang))) if s.cached
+           else (s.name,s.call,(key,lang)) for s in srcs]
+    merge=FANOUT_MODE=="merge" or len(set(srcs))<len(srcs)
+    if FANOUT:
+        cand=fan_out(calls,accept,merge=merge,deadline=deadline)
+    else:
+        cand=[]
+        for name,fn,args in calls:
+            cand+=accept(fn(*args),name)
+            if len(cand)>=k and not merge: break
+    cand=list({c['url']:c for c in cand}.values())
+    got=random.sample(cand,min(k,len(cand)))
+    for m in got: _picked(m,lang,srcs,ckey,origin,claim)
+    return got
+
+def _picked(m:dict, lang:str, srcs:list, ckey:tuple, origin:dict, claim:bool=True):
+    """Bookkeeping for a chosen meme: fallback depth, no repeats from CAND_CACHE."""
+    names=[s.name for s in srcs]; src=origin.get(m['url'])
+    FALLBACK.inc(lang=lang,depth=names.index(src) if src in names else -1)
+    if not claim: return
+    for s in srcs:
+        if s.cached: CAND_CACHE.claim((s.name,)+ckey,m['url'])
+
+def pick_english_meme(key:str|None, blacklist=None, deadline=None, claim:bool=True)->dict:
+    if key:
+        m=_pick("eng",key,blacklist,deadline,claim)
+        if m: return m
+    api=SOURCES["meme-api"]
+    got=api.call(key,"eng") if api.available(time.monotonic()) else []
+    if got: return got[0]
+    raise RuntimeError("meme-api unavailable")
+
+def pick_russian_meme(key:str|None, blacklist=None, deadline=None, claim:bool=True)->dict:
+    m=_pick("rus",key,blacklist,deadline,claim)
+    if m: return m
     raise RuntimeError("No RU meme found")
 
-def fetch_external_unique(key:str|None, lang:str, blacklist:set[str])->dict:
+@traced()
+def fetch_external_unique(key:str|None, lang:str, blacklist, claim:bool=True)->dict:
+    with STAGE.time(stage="external"):
+        return _fetch_external_unique(key,lang,blacklist,claim)
+
+def _fetch_external_unique(key:str|None, lang:str, blacklist, claim:bool=True)->dict:
     ATT=20
+    end=time.monotonic()+FETCH_DEADLINE
     for _ in range(ATT):
-        m = pick_russian_meme(key) if lang=="rus" else pick_english_meme(key)
+        left=end-time.monotonic()
+        if left<=0: break
+        m = (pick_russian_meme(key,blacklist,left,claim) if lang=="rus"
+             else pick_english_meme(key,blacklist,left,claim))
         if m['url'] not in blacklist: return m
     raise RuntimeError("External fetch failed to find unique")
 
+@traced()
+def fetch_external_many(key:str|None, lang:str, blacklist, n:int, taken=frozenset())->list[dict]:
+    """Up to n distinct unseen memes, several per round of source calls."""
+    with STAGE.time(stage="external"):
+        got={}; end=time.monotonic()+FETCH_DEADLINE
+        for _ in range(5):
+            left=end-time.monotonic()
+            if left<=0 or len(got)>=n: break
+            for m in _pick_n(lang,key,blacklist,left,n-len(got),set(taken)|set(got)):
+                got[m['url']]=m
+        return [dict(m) for m in got.values()]       # callers add id/path; cached dicts are shared
+
+# ─── SEEN FILTER ────────────────────────────────────────────────────────────
+class Bloom:
+    """Fixed-size Bloom filter over md5 hex digests (double hashing)."""
+    def __init__(self,bits:int=BLOOM_BITS,k:int=BLOOM_K):
+        self.m=bits; self.k=k; self.buf=bytearray((bits+7)//8)
+        self.last_id=0                       # newest journal ID folded in
+    def _idx(self,h:str):
+        a=int(h[:16],16); b=int(h[16:],16)|1
+        return ((a+i*b)%self.m for i in range(self.k))
+    def add(self,h:str):
+        for i in self._idx(h): self.buf[i>>3]|=1<<(i&7)
+    def __contains__(self,h:str)->bool:
+        return all(self.buf[i>>3]>>(i&7)&1 for i in self._idx(h))
+
+_UNSEEN_BUILT:set[tuple]=set()          # unseen queues known to exist
+
+_BLOOMS:OrderedDict=OrderedDict()
+_BLOOM_LOCK=threading.Lock()
+
+class SeenSet:
+    """
+    Lazy per-identity blacklist. Nothing is loaded up front: candidates are
+    checked in batches with an anti-join on md5(url). With BLOOM on, a
+    per-identity filter (refreshed incrementally from the journal) answers
+    definite misses in-process and only possible hits go to the DB.
+    """
+    def __init__(self,db:"Db",field:str,val:int):
+        self.db=db; self.field=field; self.val=val
+        self.bloom=self._bloom() if BLOOM else None
+
+    def _bloom(self)->Bloom:
+        key=(self.db._identity_clause(self.field),self.val)
+        with _BLOOM_LOCK:
+            bf=_BLOOMS.get(key)
+            if bf is not None: _BLOOMS.move_to_end(key)
+        # IDs are handed out at INSERT but become visible at COMMIT, so a
+        # slow transaction can land below last_id; re-reading a window is
+        # cheap (identity-filtered) and re-adding a hash is a no-op. The query
+        # runs unlocked: identities must not queue behind each other's reads.
+        after=0 if bf is None else max(0,bf.last_id-BLOOM_LAG)
+        rows=self.db.journal_hashes(self.field,self.val,after)
+        with _BLOOM_LOCK:
+            if bf is None:                   # published filled: an empty one calls everything unseen
+                bf=_BLOOMS.get(key) or Bloom()
+                _BLOOMS[key]=bf
+                while len(_BLOOMS)>BLOOM_MAX_ID: _BLOOMS.popitem(last=False)
+            for jid,h in rows:
+                bf.add(h); bf.last_id=max(bf.last_id,jid)
+        return bf
+
+    def filter(self,urls)->list[str]:
+        """Return the urls (order kept, deduped) the identity has NOT seen."""
+        cand=list(dict.fromkeys(urls))
+        hs={u:url_hash(u) for u in cand}
+        maybe=[h for h in hs.values() if self.bloom is None or h in self.bloom]
+        unseen=set(hs.values())-set(maybe)
+        for i in range(0,len(maybe),SEEN_BATCH):
+            unseen|=self.db.unseen_hashes(self.field,self.val,maybe[i:i+SEEN_BATCH])
+        if WB: unseen-=WB.pending_hashes(self.field,self.val)
+        return [u for u in cand if hs[u] in unseen]
+
+    def __contains__(self,url:str)->bool:
+        return not self.filter([url])
+
+    def add(self,url:str):
+        if self.bloom is not None:
+            with _BLOOM_LOCK: self.bloom.add(url_hash(url))
+
+# ─── NEAR-DUPLICATES ────────────────────────────────────────────────────────
+def _s64(h:int)->int: return h-(1<<64) if h>=1<<63 else h     # bigint column
+def _u64(h:int)->int: return h&0xFFFFFFFFFFFFFFFF
+
+def _masks(bits:int,r:int)->list[int]:
+    out=[0]
+    for _ in range(r): out=list({m|1<<b for m in out for b in range(bits)}|set(out))
+    return sorted(out)
+
+class NearIndex:
+    """
+    Multi-index hashing over 64-bit dHashes. Each hash is split into four
+    16-bit chunks with one table per chunk position; a hash within
+    PHASH_DIST bits shares at least one chunk within PHASH_DIST//4 bits, so a
+    lookup probes a few dozen buckets and popcounts their entries. Entries
+    are flat arrays (~24 bytes per hash); reads take no lock.
+    """
+    def __init__(self,dist:int=PHASH_DIST):
+        self.dist=dist; self.masks=_masks(16,dist//4)
+        self.hashes=array('Q'); self.ids=array('q')
+        self.tables:list[dict]=[{},{},{},{}]     # chunk -> array of positions
+        self.db_id=0                             # newest memes_all_urls ID loaded
+        self._own:set[int]=set()                 # added here since the last refresh
+        self._lock=threading.Lock(); self._refreshing=threading.Lock()
+        self._refreshed=0.0
+
+    def __len__(self): return len(self.hashes)
+
+    def _put(self,h:int,url_id:int):
+        pos=len(self.hashes); self.hashes.append(h); self.ids.append(url_id)
+        for t in range(4):
+            c=h>>(16*t)&0xFFFF; b=self.tables[t].get(c)
+            if b is None: b=self.tables[t][c]=array('I')
+            b.append(pos)
+
+    def add(self,h:int,url_id:int):
+        with self._lock:
+            self._put(h,url_id); self._own.add(url_id)
+
+    def near(self,h:int,exclude:int|None=None)->set[int]:
+        """url IDs whose hash is within dist bits of h."""
+        out=set(); hashes=self.hashes; ids=self.ids
+        for t in range(4):
+            c=h>>(16*t)&0xFFFF; tbl=self.tables[t]
+            for m in self.masks:
+                for pos in tbl.get(c^m,()):
+                    if (hashes[pos]^h).bit_count()<=self.dist: out.add(ids[pos])
+        out.discard(exclude)
+        return out
+
+    def refresh(self,db:"Db",force:bool=False):
+        """Fold in rows hashed since the last refresh (any process); one caller at a time."""
+        if not force and time.monotonic()-self._refreshed<PHASH_REFRESH: return
+        if not self._refreshing.acquire(blocking=False): return
+        try:
+            self._refreshed=time.monotonic()
+            with self._lock: own=self._own; self._own=set()
+            while True:
+                rows=db.phash_rows(self.db_id,50000)
+                if not rows: break
+                with self._lock:
+                    for url_id,h in rows:
+                        if url_id not in own: self._put(_u64(h),url_id)
+                self.db_id=rows[-1][0]
+        finally:
+            self._refreshing.release()
+
+NEAR=NearIndex()
+PHASHES.track(lambda: len(NEAR))
+
+def load_near_index():
+    """Startup: load every stored perceptual hash into NEAR."""
+    with pooled_db() as db: NEAR.refresh(db,force=True)
+
+def phash_of(db:"Db",url_id:int,path:Path|None)->int|None:
+    """Stored dHash of a url row; computed from the downloaded file on first sight."""
+    h=db.phash(url_id)
+    if h is None and path is not None:
+        h=media.dhash(path)
+        if h is not None: db.set_phash(url_id,h); NEAR.add(h,url_id)
+    return h
+
 # ─── DB WRAPPER ─────────────────────────────────────────────────────────────
+def _row_cols()->str:
+    return 'a."ID",a."url",a."name",a."source"'+(',a."phash"' if PHASH else '')
+
+def _row_limit(skip:set,n:int=1)->int:
+    return n+len(skip)+(PHASH_SCAN if PHASH else 0)
+
 class Db:
-    def __init__(self,dsn:str): self.cx=pyodbc.connect(dsn,autocommit=False)
-    def close(self): self.cx.close()
+    def __init__(self,dsn:str|None=None,pool:"Pool|None"=None):
+        self.pool=pool; self.broken=False
+        self.cx=profiling.traced_cx(pool.get() if pool else pyodbc.connect(dsn,autocommit=False))
+    def close(self):
+        cx=profiling.raw_cx(self.cx)
+        if self.pool: self.pool.put(cx,self.broken)
+        else: cx.close()
 
     # helper
     def _identity_clause(self, field:str):
         return "USER_ID" if field=="USER_ID" else "CHAT_ID"
 
-    def blacklist(self, field:str, value:int)->set[str]:
+    def blacklist(self, field:str, value:int)->SeenSet:
+        with STAGE.time(stage="blacklist"):
+            return SeenSet(self,field,value)
+
+    def unseen_hashes(self, field:str, value:int, hashes:list[str])->set[str]:
+        """Anti-join: which of the candidate md5(url) values are NOT in the journal."""
+        if not hashes: return set()
         clause=self._identity_clause(field)
-        sql=f'''SELECT a."url"
-                 FROM "memes_all_urls" a
-                 JOIN "memes_queries_journal" q ON a."ID"=q."URL_ID"
-                 WHERE q."{clause}"=?'''
-        return {r.url for r in self.cx.cursor().execute(sql, value)}
+        vals=",".join("(?)" for _ in hashes)
+        sql=f'''SELECT c.h FROM (VALUES {vals}) AS c(h)
+                 WHERE NOT EXISTS (
+                   SELECT 1 FROM "memes_all_urls" a
+                   JOIN "memes_queries_journal" q ON a."ID"=q."URL_ID"
+                   WHERE md5(a."url")=c.h AND q."{clause}"=?)'''
+        return {r[0] for r in self.cx.cursor().execute(sql,*hashes,value)}
 
-    def find_cached_url(self, key:str|None, lang:str,
-                        field:str, val:int):
+    def journal_hashes(self, field:str, value:int, after_id:int=0):
+        """(journal ID, md5(url)) rows newer than after_id – feeds the Bloom filter."""
         clause=self._identity_clause(field)
-        params=[val]
+        sql=f'''SELECT q."ID", md5(a."url")
+                 FROM "memes_queries_journal" q
+                 JOIN "memes_all_urls" a ON a."ID"=q."URL_ID"
+                 WHERE q."{clause}"=? AND q."ID">?'''
+        return [(r[0],r[1]) for r in self.cx.cursor().execute(sql,value,after_id)]
+
+    def _unseen_sql(self, key:str|None, lang:str|None, clause:str, cols:str|None=None):
+        """Anti-join of memes_all_urls against the identity's journal (slow path)."""
+        cols=cols or _row_cols()
+        params=[]
         sql=(
-            'SELECT a."ID",a."url",a."name",a."source" '
+            f'SELECT {cols} '
             'FROM "memes_all_urls" a '
             f'LEFT JOIN "memes_queries_journal" q '
             f'ON a."ID"=q."URL_ID" AND q."{clause}"=? '
@@ -157,22 +848,232 @@ class Db:
                 'WHERE k."ID_URL"=a."ID" '
             )
             if key:
-                sql+='AND k."Keywords_Searched_user"=? '
-                params.append(key)
+                sql+=('AND k."kw_norm"=? ' if KW_INDEX else
+                      'AND k."Keywords_Searched_user"=? ')
+                params.append(_kw(key))
             if lang:
                 sql+='AND k."Language"=? '
                 params.append(lang)
             sql+=")"
-        sql+=' ORDER BY a."date_upload" DESC LIMIT 1'
+        return sql,params
+
+    def find_cached_url(self, key:str|None, lang:str,
+                        field:str, val:int, read_only:bool=False):
+        rows=self.find_cached_urls(key,lang,field,val,1,read_only)
+        return rows[0] if rows else None
+
+    def find_cached_urls(self, key:str|None, lang:str,
+                         field:str, val:int, n:int, read_only:bool=False)->list[dict]:
+        """
+        Up to n unseen cached memes; fuzzy matches top up a short exact result.
+        read_only (dry runs) scans instead of building a queue and does not
+        journal near-duplicates.
+        """
+        with STAGE.time(stage="find_cached_url"):
+            rows=(self._find_queued(key,lang,field,val,n) if UNSEEN_QUEUE and not read_only
+                  else self._find_scan(key,lang,field,val,n,read_only)); how="hit" if rows else "miss"
+            if len(rows)<n and key and lang and KW_INDEX and KW_FUZZY and stem_key(key):
+                have={r['id'] for r in rows}
+                more=[r for r in self._find_fuzzy(key,lang,field,val,n,read_only) if r['id'] not in have]
+                if more and not rows: how="fuzzy"
+                rows+=more[:n-len(rows)]
+        CACHED.inc(result=how)
+        return rows
+
+    def _fresh(self, rows, skip:set, field:str, val:int, n:int, read_only:bool=False)->list[dict]:
+        """
+        First n rows neither pending in WB nor near-duplicates of a seen meme.
+        Near-duplicates are journaled (unless read_only) so the identity never
+        gets them later.
+        """
+        out=[]
+        for r in rows:
+            if len(out)>=n: break
+            if r[0] in skip: continue
+            if PHASH and self.near_seen(r[4],r[0],field,val):
+                NEAR_DUP.inc(path="cached")
+                if not read_only: self.add_journal(r[0],field,val,r[1])
+                continue
+            out.append(dict(id=r[0],url=r[1],title=r[2],source=r[3]))
+        return out
+
+    def _find_fuzzy(self, key:str, lang:str, field:str, val:int, n:int=1,
+                    read_only:bool=False)->list[dict]:
+        """
+        Unseen memes ranked by pg_trgm similarity of the stemmed query to
+        their stemmed keywords, or its word similarity to their titles.
+        """
+        q=stem_key(key); clause=self._identity_clause(field)
+        skip=WB.pending_ids(field,val) if WB else set()
+        sql=(f'SELECT {_row_cols()} FROM ('
+             ' SELECT m."ID_URL", max(m.s) AS s FROM ('
+             '  SELECT k."ID_URL", similarity(k."kw_norm",?) AS s'
+             '  FROM "memes_key_words_using" k'
+             '  WHERE k."kw_norm" % ? AND k."Language"=?'
+             '  UNION ALL'
+             '  SELECT t."ID", word_similarity(?,lower(t."name"))'
+             '  FROM "memes_all_urls" t'
+             '  WHERE ? <% lower(t."name") AND EXISTS (SELECT 1 FROM "memes_key_words_using" k'
+             '   WHERE k."ID_URL"=t."ID" AND k."Language"=?)'
+             ' ) m GROUP BY m."ID_URL"'
+             ') r JOIN "memes_all_urls" a ON a."ID"=r."ID_URL" '
+             f'LEFT JOIN "memes_queries_journal" q ON a."ID"=q."URL_ID" AND q."{clause}"=? '
+             'WHERE q."ID" IS NULL '
+             f'ORDER BY r.s DESC, a."date_upload" DESC LIMIT {_row_limit(skip,n)}')
+        rows=self.cx.cursor().execute(sql,q,q,lang,q,q,lang,val).fetchall()
+        return self._fresh(rows,skip,field,val,n,read_only)
+
+    def _find_scan(self, key:str|None, lang:str, field:str, val:int, n:int=1,
+                   read_only:bool=False)->list[dict]:
+        clause=self._identity_clause(field)
+        skip=WB.pending_ids(field,val) if WB else set()   # journaled, not yet flushed
+        sql,params=self._unseen_sql(key,lang,clause)
+        sql+=f' ORDER BY a."date_upload" DESC LIMIT {_row_limit(skip,n)}'
         #print(sql)
         #print(params)
-        cur=self.cx.cursor().execute(sql,*params)
-        row=cur.fetchone()
-        if row:
-            #print(dir(row))
-            #print(row)
-            return dict(id=row.ID,url=row.url,title=row.name,source=row.source)
-        return None
+        cur=self.cx.cursor().execute(sql,val,*params)
+        return self._fresh(cur.fetchall(),skip,field,val,n,read_only)
+
+    # unseen queue: one materialized row per (identity, keyword, lang, url)
+    # not yet delivered; add_journal deletes, add_keyword_usage/insert_url add.
+    def _queue_key(self, key, lang, field, val):
+        kind='U' if self._identity_clause(field)=="USER_ID" else 'C'
+        return kind,val,_kw(key) or '',lang or ''
+
+    def build_unseen(self, key:str|None, lang:str|None, field:str, val:int)->bool:
+        """Materialize the queue for one (identity, keyword, lang); no-op if built."""
+        qk=self._queue_key(key,lang,field,val)
+        if qk in _UNSEEN_BUILT: return False
+        cur=self.cx.cursor()
+        cur.execute('INSERT INTO "memes_unseen_cursor" ("KIND","IDENT","KEYWORD","LANG") '
+                    'VALUES (?,?,?,?) ON CONFLICT DO NOTHING',*qk)
+        built=cur.rowcount==1
+        if built:
+            sql,params=self._unseen_sql(key,lang,self._identity_clause(field),
+                                        cols='CAST(? AS char(1)),CAST(? AS bigint),CAST(? AS text),'
+                                             'CAST(? AS text),a."ID",a."date_upload"')
+            cur.execute('INSERT INTO "memes_unseen_queue" '
+                        '("KIND","IDENT","KEYWORD","LANG","URL_ID","date_upload") '
+                        +sql+' ON CONFLICT DO NOTHING',*qk,val,*params)
+        self.cx.commit()
+        _UNSEEN_BUILT.add(qk)
+        return built
+
+    def _find_queued(self, key, lang, field, val, n:int=1)->list[dict]:
+        qk=self._queue_key(key,lang,field,val)
+        self.build_unseen(key,lang,field,val)
+        skip=WB.pending_ids(field,val) if WB else set()
+        rows=self.cx.cursor().execute(
+            f'SELECT {_row_cols()} '
+            'FROM "memes_unseen_queue" u JOIN "memes_all_urls" a ON a."ID"=u."URL_ID" '
+            'WHERE u."KIND"=? AND u."IDENT"=? AND u."KEYWORD"=? AND u."LANG"=? '
+            f'ORDER BY u."date_upload" DESC LIMIT {_row_limit(skip,n)}',*qk).fetchall()
+        return self._fresh(rows,skip,field,val,n)
+
+    def _enqueue_url(self, cur, url_id, key, lang):
+        """Offer a url to every built queue whose (keyword, lang) it now matches."""
+        cur.execute(
+            'INSERT INTO "memes_unseen_queue" '
+            '("KIND","IDENT","KEYWORD","LANG","URL_ID","date_upload") '
+            'SELECT c."KIND",c."IDENT",c."KEYWORD",c."LANG",a."ID",a."date_upload" '
+            'FROM "memes_unseen_cursor" c JOIN "memes_all_urls" a ON a."ID"=? '
+            'WHERE c."KEYWORD" IN (?,?) AND c."LANG" IN (?,?) '
+            'AND NOT EXISTS (SELECT 1 FROM "memes_queries_journal" q '
+            'WHERE q."URL_ID"=a."ID" AND ((c."KIND"=? AND q."USER_ID"=c."IDENT") '
+            'OR (c."KIND"=? AND q."CHAT_ID"=c."IDENT"))) '
+            'ON CONFLICT DO NOTHING',url_id,_kw(key) or '','',lang or '','','U','C')
+
+    def popular_keywords(self, lang:str, n:int)->list[str]:
+        rows=self.cx.cursor().execute(
+            'SELECT "Keywords_Searched_user" FROM "memes_key_words_using" '
+            'WHERE "Language"=? AND "Keywords_Searched_user" IS NOT NULL '
+            'GROUP BY "Keywords_Searched_user" ORDER BY COUNT(*) DESC LIMIT ?',
+            lang,n).fetchall()
+        return [r[0] for r in rows]
+
+    def file_id(self,url_id)->str|None:
+        row=self.cx.cursor().execute(
+            'SELECT "tg_file_id" FROM "memes_all_urls" WHERE "ID"=?',url_id).fetchone()
+        return row[0] if row else None
+
+    def set_file_id(self,url_id,file_id:str|None):
+        self.cx.cursor().execute(
+            'UPDATE "memes_all_urls" SET "tg_file_id"=? WHERE "ID"=?',file_id,url_id)
+        self.cx.commit()
+
+    def file_ids(self,url_ids:list[int])->dict[int,str]:
+        if not url_ids: return {}
+        rows=self.cx.cursor().execute(
+            'SELECT "ID","tg_file_id" FROM "memes_all_urls" WHERE "tg_file_id" IS NOT NULL '
+            f'AND "ID" IN ({",".join("?"*len(url_ids))})',*url_ids)
+        return {r[0]:r[1] for r in rows}
+
+    def set_file_ids(self,pairs:list[tuple]):
+        """(url_id, file_id) pairs in one UPDATE."""
+        if not pairs: return
+        self.cx.cursor().execute(
+            'UPDATE "memes_all_urls" a SET "tg_file_id"=v.f FROM (VALUES '
+            +",".join("(CAST(? AS bigint),CAST(? AS text))" for _ in pairs)+
+            ') AS v(i,f) WHERE a."ID"=v.i',*[x for p in pairs for x in p])
+        self.cx.commit()
+
+    def phash(self,url_id)->int|None:
+        row=self.cx.cursor().execute(
+            'SELECT "phash" FROM "memes_all_urls" WHERE "ID"=?',url_id).fetchone()
+        return _u64(row[0]) if row and row[0] is not None else None
+
+    def set_phash(self,url_id,h:int):
+        self.cx.cursor().execute(
+            'UPDATE "memes_all_urls" SET "phash"=? WHERE "ID"=?',_s64(h),url_id)
+        self.cx.commit()
+
+    def phash_rows(self,after_id:int,n:int)->list[tuple]:
+        rows=self.cx.cursor().execute(
+            'SELECT "ID","phash" FROM "memes_all_urls" '
+            'WHERE "ID">? AND "phash" IS NOT NULL ORDER BY "ID" LIMIT ?',after_id,n).fetchall()
+        return [(r[0],r[1]) for r in rows]
+
+    def seen_ids(self,field:str,val:int,ids)->set[int]:
+        """Which of the url IDs are in the identity's journal (flushed or pending)."""
+        pend=WB.pending_ids(field,val) if WB else set()
+        hit={i for i in ids if i in pend}; rest=[i for i in ids if i not in pend]
+        if rest:
+            sql=(f'SELECT "URL_ID" FROM "memes_queries_journal" '
+                 f'WHERE "{self._identity_clause(field)}"=? '
+                 f'AND "URL_ID" IN ({",".join("?"*len(rest))})')
+            hit|={r[0] for r in self.cx.cursor().execute(sql,val,*rest)}
+        return hit
+
+    def near_seen(self,h:int|None,url_id:int,field:str,val:int)->bool:
+        """Has the identity seen another url within PHASH_DIST bits of this one?"""
+        if not PHASH or h is None: return False
+        NEAR.refresh(self)
+        h=_u64(h)
+        ids=NEAR.near(h,exclude=url_id)
+        return bool(ids) and bool(self.seen_ids(field,val,ids))
+
+    def ensure_url(self,url,title,source)->int:
+        """ID of the url row, inserting it if new."""
+        if UPSERT_URLS: return self.upsert_url(url,title,source)
+        url_id=self.get_url_id(url)
+        return url_id if url_id is not None else self.insert_url(url,title,source)
+
+    def ensure_urls(self,memes:list[dict])->list[int]:
+        """ensure_url for distinct memes; one statement with UPSERT_URLS."""
+        if not UPSERT_URLS or len(memes)<2:
+            return [self.ensure_url(m['url'],m['title'],m['source']) for m in memes]
+        cur=self.cx.cursor()
+        rows=cur.execute('INSERT INTO "memes_all_urls" ("url","name","source") VALUES '
+                         +",".join("(?,?,?)" for _ in memes)+
+                         ' ON CONFLICT (md5("url")) DO UPDATE SET "url"=EXCLUDED."url" '
+                         'RETURNING "ID", xmax=0, md5("url")',
+                         *[x for m in memes for x in (m['url'],m['title'],m['source'])]).fetchall()
+        if UNSEEN_QUEUE:
+            for r in rows:
+                if r[1]: self._enqueue_url(cur,r[0],None,None)
+        self.cx.commit()
+        ids={r[2]:r[0] for r in rows}
+        return [ids[url_hash(m['url'])] for m in memes]
 
     def get_url_id(self,url)->int|None:
         cur=self.cx.cursor().execute('SELECT "ID" FROM "memes_all_urls" WHERE url=?',url)
@@ -184,58 +1085,412 @@ class Db:
         cur.execute('INSERT INTO "memes_all_urls" ("url","name","source") VALUES (?,?,?) RETURNING "ID"',
                     url,title,source)
         url_id=cur.fetchone()[0]
+        if UNSEEN_QUEUE: self._enqueue_url(cur,url_id,None,None)
         self.cx.commit()
         return url_id
 
-    def add_journal(self,url_id, field:str,val:int):
-        clause=self._identity_clause(field)
+    def upsert_url(self,url,title,source)->int:
+        """get_url_id + insert_url in one statement (unique md5(url) index)."""
         cur=self.cx.cursor()
-        cur.execute(f'INSERT INTO "memes_queries_journal" ("{clause}","URL_ID") VALUES (?,?)',
-                    val,url_id)
+        row=cur.execute('INSERT INTO "memes_all_urls" ("url","name","source") VALUES (?,?,?) '
+                        'ON CONFLICT (md5("url")) DO UPDATE SET "url"=EXCLUDED."url" '
+                        'RETURNING "ID", xmax=0',url,title,source).fetchone()
+        if UNSEEN_QUEUE and row[1]: self._enqueue_url(cur,row[0],None,None)
         self.cx.commit()
+        return row[0]
+
+    def add_journal(self,url_id, field:str,val:int, url:str|None=None):
+        row=(self._identity_clause(field),val,url_id,url and url_hash(url))
+        if WB: WB.journal(row)
+        else: self.write_rows([row],[])
 
     def add_keyword_usage(self,url_id,key,lang,field,val):
         if key == '':
             key = None
+        row=(self._identity_clause(field),val,url_id,key,lang)
+        if WB: WB.keyword(row)
+        else: self.write_rows([],[row])
+
+    def add_deliveries(self,memes:list[dict],key,lang,field:str,val:int):
+        """add_journal + add_keyword_usage for several memes as one batch."""
         clause=self._identity_clause(field)
+        j=[(clause,val,m['id'],url_hash(m['url'])) for m in memes]
+        k=[(clause,val,m['id'],key or None,lang) for m in memes] if key or lang else []
+        if WB:
+            for r in j: WB.journal(r)
+            for r in k: WB.keyword(r)
+        else: self.write_rows(j,k)
+
+    def write_rows(self, journal:list[tuple], keywords:list[tuple]):
+        """
+        Multi-row INSERTs for journal rows (clause, val, url_id, url_hash) and
+        keyword rows (clause, val, url_id, key, lang), one commit in total.
+        Journal rows go first so unseen-queue fan-in skips their identities.
+        """
         cur=self.cx.cursor()
-        cur.execute(f'''INSERT INTO "memes_key_words_using"
-                     ("ID_URL","Keywords_Searched_user","Language","{clause}")
-                     VALUES (?,?,?,?)''',url_id,key,lang,val)
+        for clause in ("USER_ID","CHAT_ID"):
+            rows=[r for r in journal if r[0]==clause]
+            for i in range(0,len(rows),SQL_ROWS):
+                part=rows[i:i+SQL_ROWS]
+                cur.execute(f'INSERT INTO "memes_queries_journal" ("{clause}","URL_ID") VALUES '
+                            +",".join("(?,?)" for _ in part),
+                            *[x for r in part for x in (r[1],r[2])])
+                if UNSEEN_QUEUE:
+                    kind='U' if clause=="USER_ID" else 'C'
+                    cur.execute('DELETE FROM "memes_unseen_queue" WHERE ("KIND","IDENT","URL_ID") IN '
+                                '(VALUES '+",".join("(CAST(? AS char(1)),CAST(? AS bigint),"
+                                                    "CAST(? AS bigint))" for _ in part)+')',
+                                *[x for r in part for x in (kind,r[1],r[2])])
+        for clause in ("USER_ID","CHAT_ID"):
+            rows=[r for r in keywords if r[0]==clause]
+            for i in range(0,len(rows),SQL_ROWS):
+                part=rows[i:i+SQL_ROWS]
+                if KW_INDEX:
+                    cur.execute(f'INSERT INTO "memes_key_words_using" '
+                                f'("ID_URL","Keywords_Searched_user","kw_norm","Language","{clause}") '
+                                'VALUES '+",".join("(?,?,?,?,?)" for _ in part),
+                                *[x for r in part for x in (r[2],r[3],stem_key(r[3]),r[4],r[1])])
+                    continue
+                cur.execute(f'INSERT INTO "memes_key_words_using" '
+                            f'("ID_URL","Keywords_Searched_user","Language","{clause}") VALUES '
+                            +",".join("(?,?,?,?)" for _ in part),
+                            *[x for r in part for x in (r[2],r[3],r[4],r[1])])
+            if UNSEEN_QUEUE:
+                for r in rows: self._enqueue_url(cur,r[2],r[3],r[4])
         self.cx.commit()
 
+# ─── WRITE-BEHIND ───────────────────────────────────────────────────────────
+class WriteBehind:
+    """
+    Buffers journal / keyword-usage rows and flushes them from a background
+    thread every WB_BATCH rows or WB_INTERVAL seconds, on a pooled connection.
+    Rows stay visible through pending_*() until their flush commits, so the
+    blacklist and find_cached_url still read their own writes. A batch that
+    keeps failing is written row by row and rows the DB rejects are dropped;
+    while the DB is down flushes back off exponentially (up to WB_BACKOFF s)
+    and the buffer holds at most WB_MAX rows.
+    """
+    def __init__(self,batch:int=WB_BATCH,interval:float=WB_INTERVAL):
+        self.batch=batch; self.interval=interval
+        self._j:list[tuple]=[]; self._k:list[tuple]=[]
+        self._cv=threading.Condition(); self._flush_lock=threading.Lock()
+        self._stop=False; self._fails=0; self._full=False
+        self._t=threading.Thread(target=self._run,name="write-behind",daemon=True)
+        self._t.start()
+
+    def _add(self,rows:list,row:tuple):
+        with self._cv:
+            n=len(self._j)+len(self._k)
+            if n>=WB_MAX:                        # DB unreachable for a while
+                WB_ERRORS.inc(result="overflow")
+                if not self._full: log.error("write-behind buffer full (%d rows), dropping new rows",n)
+                self._full=True; return
+            rows.append(row)
+            if n+1>=self.batch: self._cv.notify()
+
+    def journal(self,row:tuple): self._add(self._j,row)
+    def keyword(self,row:tuple): self._add(self._k,row)
+
+    def pending_ids(self,field:str,val:int)->set[int]:
+        clause="USER_ID" if field=="USER_ID" else "CHAT_ID"
+        with self._cv: return {r[2] for r in self._j if r[0]==clause and r[1]==val}
+
+    def pending_hashes(self,field:str,val:int)->set[str]:
+        clause="USER_ID" if field=="USER_ID" else "CHAT_ID"
+        with self._cv: return {r[3] for r in self._j if r[0]==clause and r[1]==val and r[3]}
+
+    def flush(self,final:bool=False):
+        with self._flush_lock:
+            with self._cv: j,k=list(self._j),list(self._k)
+            if not j and not k: return
+            try:
+                with pooled_db() as db: db.write_rows(j,k)
+                nj,nk=len(j),len(k)
+            except Exception as e:
+                self._fails+=1; WB_ERRORS.inc(result="batch")
+                if self._fails<WB_RETRIES and not final:
+                    log.warning("write-behind flush of %d rows failed (%d/%d), will retry: %s",
+                                len(j)+len(k),self._fails,WB_RETRIES,e)
+                    return
+                log.warning("write-behind flush failed %d times, writing rows one by one: %s",
+                            self._fails,e)
+                nj,nk=self._isolate(j,k)
+            with self._cv:
+                del self._j[:nj]; del self._k[:nk]
+                if nj==len(j) and nk==len(k): self._fails=0; self._full=False
+            if final and (nj<len(j) or nk<len(k)):
+                log.error("write-behind closed with %d rows unwritten",len(j)-nj+len(k)-nk)
+
+    def _isolate(self,j:list,k:list)->tuple[int,int]:
+        """
+        Write rows one at a time and drop (log) those the DB rejects; stop at
+        any other error, e.g. the DB being down. -> rows done per list.
+        """
+        done=[0,0]
+        try:
+            with pooled_db() as db:
+                for i,rows in enumerate((j,k)):
+                    for r in rows:
+                        try: db.write_rows([r],[]) if i==0 else db.write_rows([],[r])
+                        except (pyodbc.IntegrityError,pyodbc.DataError) as e:
+                            db.cx.rollback(); WB_ERRORS.inc(result="dropped")
+                            log.error("write-behind dropped %s row %r: %s",
+                                      "journal" if i==0 else "keyword",r,e)
+                        done[i]+=1
+        except Exception as e:
+            log.warning("write-behind row-by-row flush stopped after %d rows: %s",sum(done),e)
+        return done[0],done[1]
+
+    def _run(self):
+        while True:
+            with self._cv:
+                if self._fails:                  # the failed rows are still buffered: wait them out
+                    self._cv.wait_for(lambda: self._stop,
+                                      timeout=min(WB_BACKOFF,self.interval*2**min(self._fails,16)))
+                else:
+                    self._cv.wait_for(lambda: self._stop or len(self._j)+len(self._k)>=self.batch,
+                                      timeout=self.interval)
+                stop=self._stop
+            self.flush(final=stop)
+            if stop: return
+
+    def close(self):
+        with self._cv: self._stop=True; self._cv.notify()
+        self._t.join()
+
+WB:WriteBehind|None=None
+
+def start_write_behind():
+    global WB
+    if WB is None: WB=WriteBehind()
+
+def stop_write_behind():
+    """Flush what is buffered and go back to synchronous writes."""
+    global WB
+    if WB: WB.close(); WB=None
+
 # ─── CONNECT ────────────────────────────────────────────────────────────────
+def _dsn(host,port)->str:
+    dsn=f'DRIVER={{PostgreSQL Unicode}};SERVER={host};PORT={port};DATABASE={PG_DB};UID={PG_UID};PWD={PG_PWD}'
+    if PG_SCHEMA: dsn+=f';ConnSettings=SET search_path TO {PG_SCHEMA},public'
+    return dsn
+
+def _new_tunnel()->SSHTunnelForwarder:
+    return SSHTunnelForwarder((SSH_HOST,SSH_PORT),
+                              ssh_username=SSH_USER,
+                              ssh_private_key=SSH_KEY,
+                              remote_bind_address=(PG_HOST,PG_PORT))
+
 def make_dsn()->tuple[str,SSHTunnelForwarder|None]:
     if not SSH_HOST:
-        return (f'DRIVER={{PostgreSQL Unicode}};SERVER={PG_HOST};PORT={PG_PORT};DATABASE={PG_DB};UID={PG_UID};PWD={PG_PWD}', None)
-    tun=SSHTunnelForwarder((SSH_HOST,SSH_PORT),
-                           ssh_username=SSH_USER,
-                           ssh_private_key=SSH_KEY,
-                           remote_bind_address=(PG_HOST,PG_PORT))
-    tun.start()
-    dsn=(f'DRIVER={{PostgreSQL Unicode}};SERVER=127.0.0.1;PORT={tun.local_bind_port};DATABASE={PG_DB};UID={PG_UID};PWD={PG_PWD}')
-    return dsn,tun
+        return _dsn(PG_HOST,PG_PORT), None
+    tun=_new_tunnel(); tun.start()
+    return _dsn('127.0.0.1',tun.local_bind_port),tun
+
+# ─── POOL (one tunnel + warm connections per process) ───────────────────────
+_TUN:SSHTunnelForwarder|None=None
+_TUN_LOCK=threading.Lock()
+
+def shared_dsn()->str:
+    """DSN through the process-wide tunnel; (re)starts it when it is down."""
+    global _TUN
+    if not SSH_HOST: return _dsn(PG_HOST,PG_PORT)
+    with _TUN_LOCK:
+        if _TUN is None:
+            with STAGE.time(stage="tunnel"):
+                _TUN=_new_tunnel(); _TUN.start()
+        elif not _TUN.is_active:
+            with STAGE.time(stage="tunnel"):
+                _TUN.restart()
+        return _dsn('127.0.0.1',_TUN.local_bind_port)
+
+class Pool:
+    """Bounded LIFO pool of pyodbc connections with ping-on-idle + reconnect."""
+    def __init__(self,size:int=PG_POOL_SIZE,dsn=shared_dsn):
+        self.size=size; self.dsn=dsn
+        self._idle:queue.LifoQueue=queue.LifoQueue()
+        self._open=0; self._lock=threading.Lock()
+
+    def _connect(self):
+        return pyodbc.connect(self.dsn(),autocommit=False)
+
+    def _alive(self,cx)->bool:
+        try:
+            cx.cursor().execute("SELECT 1").fetchone(); return True
+        except pyodbc.Error:
+            return False
+
+    def _discard(self,cx):
+        try: cx.close()
+        except pyodbc.Error: pass
+        with self._lock: self._open-=1
+
+    def get(self):
+        with STAGE.time(stage="db_pool"):
+            return self._get()
+
+    def _get(self):
+        deadline=time.monotonic()+PG_POOL_TIMEOUT
+        while True:
+            try: cx,ts=self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    grow=self._open<self.size
+                    if grow: self._open+=1
+                if grow:
+                    try: return self._connect()
+                    except Exception:
+                        with self._lock: self._open-=1
+                        raise
+                try: cx,ts=self._idle.get(timeout=max(0,deadline-time.monotonic()))
+                except queue.Empty: raise TimeoutError("DB pool exhausted") from None
+            if time.monotonic()-ts<PG_POOL_PING or self._alive(cx): return cx
+            self._discard(cx)            # dead after idling → loop reconnects
+
+    def put(self,cx,broken:bool=False):
+        if not broken:
+            try: cx.rollback()           # end read txns; fails fast on a dead link
+            except pyodbc.Error: broken=True
+        if broken: self._discard(cx)
+        else: self._idle.put((cx,time.monotonic()))
+
+    def warm(self,n:int|None=None):
+        cxs=[self.get() for _ in range(min(n or self.size,self.size))]
+        for cx in cxs: self.put(cx)
+
+    def close(self):
+        global _TUN
+        while True:
+            try: cx,_=self._idle.get_nowait()
+            except queue.Empty: break
+            self._discard(cx)
+        with _TUN_LOCK:
+            if _TUN: _TUN.stop(); _TUN=None
+
+_POOL:Pool|None=None
+_POOL_LOCK=threading.Lock()
+
+def get_pool()->Pool:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None: _POOL=Pool()
+        return _POOL
+
+def close_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL: _POOL.close(); _POOL=None
+
+@contextmanager
+def pooled_db():
+    db=Db(pool=get_pool())
+    try: yield db
+    except pyodbc.Error:
+        db.broken=True; raise
+    finally: db.close()
 
 # ─── FILE DL ────────────────────────────────────────────────────────────────
+class DownloadRejected(RuntimeError): pass
+
+def _get_media(url:str)->requests.Response:
+    """Streaming GET that rejects non-media and oversize bodies from the headers."""
+    r=requests.get(url,headers=HEADERS,timeout=30,stream=True)
+    try:
+        r.raise_for_status()
+        _check_media(url,r.headers)
+    except Exception:
+        r.close(); raise
+    return r
+
+def _check_media(url:str, headers):
+    ctype=headers.get("Content-Type","").split(";")[0].strip()
+    if ctype and not ctype.startswith(("image/","video/","application/octet-stream")):
+        raise DownloadRejected(f"{url}: not media ({ctype})")
+    if int(headers.get("Content-Length") or 0)>DL_MAX_BYTES:
+        raise DownloadRejected(f"{url}: larger than {DL_MAX_BYTES} bytes")
+
+def _capped_chunks(r:requests.Response):
+    size=0
+    for chunk in r.iter_content(DL_CHUNK):
+        size+=len(chunk)
+        if size>DL_MAX_BYTES:
+            raise DownloadRejected(f"{r.url}: larger than {DL_MAX_BYTES} bytes")
+        yield chunk
+
+@traced()
 def download(url:str)->Path:
-    name=Path(urlparse(url).path).name or f"meme_{int(time.time())}.jpg"
-    dest=DOWNLOAD_DIR/name
-    data=requests.get(url,timeout=30).content
-    dest.write_bytes(data); return dest
+    """
+    Path of the url's bytes in STORE; streams to disk only on a store miss,
+    and concurrent misses for one url share that transfer.
+    """
+    path=STORE.get(url)
+    if path: return path
+    return DOWNLOADS.do(url,_download_once,url)
+
+def _download_once(url:str)->Path:
+    path=STORE.get(url)
+    if path: return path
+    with STAGE.time(stage="download"):
+        return _download(url)
+
+def _download(url:str)->Path:
+    fd,tmp=tempfile.mkstemp(dir=DOWNLOAD_DIR,suffix=".part")
+    h=hashlib.sha256(); size=0
+    try:
+        with _get_media(url) as r, os.fdopen(fd,"wb") as f:
+            for chunk in _capped_chunks(r):
+                h.update(chunk); f.write(chunk); size+=len(chunk)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True); raise
+    return STORE.put_file(url,Path(tmp),h.hexdigest(),size)
+
+class MediaStream:
+    """
+    Read-only, size-capped file object over a streaming GET (STREAM_UPLOAD).
+    read() returns the whole body (≤ DL_MAX_BYTES): PTB buffers uploads in
+    memory either way, so the bot bounds concurrent stream sends (STREAM_MAX).
+    """
+    def __init__(self,url:str):
+        self.name=Path(urlparse(url).path).name or "meme.jpg"
+        self._r=_get_media(url); self._it=_capped_chunks(self._r)
+    def read(self)->bytes:
+        return b"".join(self._it)          # at most DL_MAX_BYTES
+    def close(self): self._r.close()
+    def __enter__(self): return self
+    def __exit__(self,*exc): self.close()
+
+def open_stream(url:str)->MediaStream:
+    return MediaStream(url)
 
 # ─── MAIN ────────────────────────────────────────────────────────────────────
-def parse_args():
-    p=argparse.ArgumentParser()
+def parse_args(argv=None):
+    p=argparse.ArgumentParser(description="Pick, journal and download memes per user/chat.")
     p.add_argument("keywords",nargs="?",help="search keywords")
     p.add_argument("lang",nargs="?",choices=["eng","rus"],default="eng")
-    g=p.add_mutually_exclusive_group(required=True)
+    g=p.add_mutually_exclusive_group()
     g.add_argument("--user",type=int,help="user id")
     g.add_argument("--chat",type=int,help="chat id")
-    return p.parse_args()
+    g.add_argument("--bulk",metavar="FILE",help="JSON-lines jobs, - for stdin")
+    p.add_argument("--workers",type=int,default=PG_POOL_SIZE,help="bulk: jobs in flight")
+    p.add_argument("--out",help="bulk: append result lines here instead of stdout")
+    p.add_argument("--resume",action="store_true",help="bulk: skip jobs already ok in --out")
+    p.add_argument("--dry-run",action="store_true",
+                   help="only resolve the candidate: no download, no journal")
+    a=p.parse_args(argv)
+    if a.bulk is None and a.user is None and a.chat is None:
+        p.error("one of --user, --chat or --bulk is required")
+    if a.resume and not a.out: p.error("--resume needs --out")
+    return a
 
+@traced()
 def main(keywords:str|None, lang:str|None,
-                        user:str|None, chat:str|None):
-    #args=parse_args()
+                        user:str|None, chat:str|None, db:Db|None=None)->dict:
+    """
+    Pick a meme for the identity, journal it and return the delivery:
+    dict(id, url, title, source, file_id, path). When a Telegram file_id is
+    known (FILE_IDS=1) or STREAM_UPLOAD=1, the download is skipped and
+    path is None.
+    """
     field='USER_ID' if user is not None else 'CHAT_ID'
     val = user if user is not None else chat
     #print(val)
@@ -244,8 +1499,10 @@ def main(keywords:str|None, lang:str|None,
     #print(user)
     #print(chat)
     #print(field)
-    dsn,tun=make_dsn()
-    db=Db(dsn)
+    own=db is None
+    if own:
+        dsn,tun=make_dsn()
+        db=Db(dsn)
     try:
         # 1. blacklist
         bl=db.blacklist(field,val)
@@ -253,26 +1510,191 @@ def main(keywords:str|None, lang:str|None,
         cached=db.find_cached_url(keywords,lang,field,val)
         if cached:
             url_id=cached['id']
-            path=download(cached['url'])
-            db.add_journal(url_id,field,val)
+            fid=db.file_id(url_id) if FILE_IDS else None
+            path=None if fid or STREAM_UPLOAD else download(cached['url'])
+            if PHASH: phash_of(db,url_id,path)
+            db.add_journal(url_id,field,val,cached['url'])
             if keywords or lang:
                 db.add_keyword_usage(url_id,keywords,lang,field,val)
-            print(f"📁 Cached meme delivered → {path}")
-            return
-
-        # 3. fetch external
-        meme=fetch_external_unique(keywords,lang,bl)
-        url_id=db.get_url_id(meme['url'])
-        if url_id is None:
-            url_id=db.insert_url(meme['url'],meme['title'],meme['source'])
-        db.add_journal(url_id,field,val)
+            log.info("📁 Cached meme delivered → %s",path or fid)
+            return dict(cached,file_id=fid,path=path)
+
+        # 3. fetch external; a near-duplicate of a seen meme is journaled, re-picked
+        for left in range(PHASH_RETRY if PHASH else 1,0,-1):
+            meme=fetch_external_unique(keywords,lang,bl)
+            url_id=db.ensure_url(meme['url'],meme['title'],meme['source'])
+            fid=db.file_id(url_id) if FILE_IDS else None
+            path=None if fid or STREAM_UPLOAD else download(meme['url'])
+            h=phash_of(db,url_id,path) if PHASH else None
+            if left==1 or not db.near_seen(h,url_id,field,val): break
+            NEAR_DUP.inc(path="external")
+            db.add_journal(url_id,field,val,meme['url']); bl.add(meme['url'])
+        db.add_journal(url_id,field,val,meme['url'])
         if keywords or lang:
             db.add_keyword_usage(url_id,keywords,lang,field,val)
-        path=download(meme['url'])
-        print(f"✅ New meme fetched → {path}")
+        log.info("✅ New meme fetched → %s",path or fid)
+        return dict(meme,id=url_id,file_id=fid,path=path)
+    finally:
+        if own:
+            db.close()
+            if tun: tun.stop()
+
+def _try_download(url:str)->Path|None:
+    try: return download(url)
+    except Exception as e:
+        log.warning("album: %s dropped: %s",url,e); return None
+
+def album_pick(db:Db, keywords:str|None, lang:str|None, field:str, val:int, n:int)->list[dict]:
+    """Up to n unseen memes with url IDs: cached ones first, the rest fetched together."""
+    memes=db.find_cached_urls(keywords,lang,field,val,n)
+    if len(memes)<n:
+        ext=fetch_external_many(keywords,lang,db.blacklist(field,val),n-len(memes),
+                                {m['url'] for m in memes})
+        for m,url_id in zip(ext,db.ensure_urls(ext)): m['id']=url_id
+        memes+=ext
+    fids=db.file_ids([m['id'] for m in memes]) if FILE_IDS else {}
+    for m in memes: m['file_id']=fids.get(m['id'])
+    return memes
+
+def album_deliver(db:Db, memes:list[dict], keywords, lang, field:str, val:int)->list[dict]:
+    """
+    Drop memes without media and near-duplicates of seen ones (journaled as
+    seen, like main()), then journal the rest in one batch.
+    """
+    keep=[]
+    for m in memes:
+        if not (m['file_id'] or m['path'] or STREAM_UPLOAD): continue
+        if PHASH and db.near_seen(phash_of(db,m['id'],m['path']),m['id'],field,val):
+            NEAR_DUP.inc(path="album"); db.add_journal(m['id'],field,val,m['url']); continue
+        keep.append(m)
+    db.add_deliveries(keep,keywords,lang,field,val)
+    return keep
+
+@traced()
+def main_many(keywords:str|None, lang:str|None,
+              user:int|None, chat:int|None, n:int, db:Db)->list[dict]:
+    """
+    main() for an album: up to n unseen memes from one cached lookup and one
+    round of source calls, downloaded in parallel and journaled in one batch.
+    """
+    field='USER_ID' if user is not None else 'CHAT_ID'
+    val = user if user is not None else chat
+    memes=album_pick(db,keywords,lang,field,val,n)
+    need=[m for m in memes if not (m['file_id'] or STREAM_UPLOAD)]
+    paths=dict(zip([m['url'] for m in need],_SRC_POOL.map(_try_download,[m['url'] for m in need])))
+    for m in memes: m['path']=paths.get(m['url'])
+    return album_deliver(db,memes,keywords,lang,field,val)
+
+def dry_run(keywords:str|None, lang:str|None,
+            user:int|None, chat:int|None, db:Db)->dict:
+    """
+    The meme main() would deliver now, read-only: nothing is downloaded,
+    journaled or queued, and candidates are peeked, not claimed.
+    """
+    field='USER_ID' if user is not None else 'CHAT_ID'
+    val = user if user is not None else chat
+    cached=db.find_cached_url(keywords,lang,field,val,read_only=True)
+    if cached: return dict(cached,cached=True)
+    return dict(fetch_external_unique(keywords,lang,db.blacklist(field,val),claim=False),cached=False)
+
+# ─── BULK ────────────────────────────────────────────────────────────────────
+def _jobs(lines):
+    """(job id, job | error) per JSON line; blank and # lines are skipped."""
+    for n,line in enumerate(lines,1):
+        line=line.strip()
+        if not line or line.startswith("#"): continue
+        try:
+            j=json.loads(line)
+            if ("user" in j)==("chat" in j): raise ValueError("need exactly one of user/chat")
+            yield str(j.get("id",n)),j
+        except (ValueError,TypeError) as e:
+            yield str(n),e
+
+def _run_job(j:dict, dry:bool)->dict:
+    t=time.perf_counter()
+    args=(j.get("keywords"),j.get("lang","eng"),j.get("user"),j.get("chat"))
+    with pooled_db() as db:
+        m=dry_run(*args,db=db) if dry else main(*args,db=db)
+    out={k:m[k] for k in ("id","url","title","source","file_id","cached") if k in m}
+    if m.get("path"): out["path"]=str(m["path"])
+    out["ms"]=round((time.perf_counter()-t)*1e3,1)
+    return out
+
+def done_jobs(path:str, dry:bool=False)->set[str]:
+    """Ids of jobs with an ok result line (of the same dry-run mode) in an --out file."""
+    done=set()
+    try:
+        with open(path,"rb") as f:                   # bytes: a kill can split a UTF-8 char
+            for line in f:
+                try: r=json.loads(line)
+                except ValueError: continue          # torn last line (bad JSON or UTF-8)
+                if r.get("ok") and r.get("dry_run",False)==dry: done.add(str(r["job"]))
+    except FileNotFoundError: pass
+    return done
+
+def bulk(lines, out, workers:int=PG_POOL_SIZE, dry:bool=False, done:set=frozenset())->dict:
+    """
+    Run jobs from JSON lines on `workers` threads over the shared pool and
+    write one result line per job to `out` as it completes. Jobs are read
+    lazily (at most 2×workers queued); ids in `done` are skipped. An
+    interrupted run writes the jobs that finished, so --resume redoes only
+    the rest.
+    """
+    stats=defaultdict(int)
+    def emit(rec:dict):
+        out.write(json.dumps(rec,ensure_ascii=False)+"\n"); out.flush()
+        stats["ok" if rec["ok"] else "failed"]+=1
+    def reap(pending:dict, when):
+        fin,_=wait(pending,return_when=when)
+        for f in fin:
+            jid=pending.pop(f)
+            try: emit(dict(job=jid,ok=True,**f.result(),**({"dry_run":True} if dry else {})))
+            except Exception as e: emit(dict(job=jid,ok=False,error=f"{type(e).__name__}: {e}"))
+    pending={}
+    with ThreadPoolExecutor(max_workers=workers,thread_name_prefix="bulk") as ex:
+        try:
+            for jid,j in _jobs(lines):
+                if jid in done: stats["skipped"]+=1; continue
+                if isinstance(j,Exception):
+                    emit(dict(job=jid,ok=False,error=f"bad job: {j}")); continue
+                pending[ex.submit(_run_job,j,dry)]=jid
+                if len(pending)>=2*workers: reap(pending,FIRST_COMPLETED)
+            reap(pending,ALL_COMPLETED)
+        except KeyboardInterrupt:
+            pending={f:jid for f,jid in pending.items() if not f.cancel()}
+            reap(pending,ALL_COMPLETED)
+            raise
+    return dict(stats)
+
+def cli(argv=None):
+    global _POOL
+    a=parse_args(argv)
+    logging.basicConfig(level=logging.INFO,stream=sys.stderr,
+                        format="%(asctime)s %(levelname)s %(name)s | %(message)s")
+    _POOL=Pool(size=max(PG_POOL_SIZE,a.workers if a.bulk else 1))
+    if a.bulk and not a.dry_run: start_write_behind()
+    try:
+        if a.bulk is None:
+            with pooled_db() as db:
+                m=(dry_run if a.dry_run else main)(a.keywords,a.lang,a.user,a.chat,db=db)
+            print(json.dumps(m,ensure_ascii=False,default=str)); return
+        done=done_jobs(a.out,a.dry_run) if a.resume else set()
+        src=sys.stdin if a.bulk=="-" else open(a.bulk,encoding="utf-8")
+        if a.out:
+            with open(a.out,"ab+") as f:               # bytes: the tail may be half a char
+                if f.tell():
+                    f.seek(-1,os.SEEK_END)
+                    if f.read(1)!=b"\n": f.write(b"\n")  # after a torn line
+        out=open(a.out,"a",encoding="utf-8") if a.out else sys.stdout
+        t=time.perf_counter()
+        try: stats=bulk(src,out,a.workers,a.dry_run,done)
+        finally:
+            if src is not sys.stdin: src.close()
+            if out is not sys.stdout: out.close()
+        wall=time.perf_counter()-t; n=stats.get("ok",0)+stats.get("failed",0)
+        log.info("bulk: %s in %.1fs (%.0f jobs/min)",stats,wall,60*n/wall if wall else 0)
     finally:
-        db.close()
-        if tun: tun.stop()
+        stop_write_behind(); close_pool()
 
 if __name__=="__main__":
-    main()
+    cli()
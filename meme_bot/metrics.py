@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+metrics.py – tiny Prometheus-style metrics for meme_bot / meme_fetcher_4
+
+Counters, gauges and histograms with labels, rendered in the Prometheus
+text format on an optional /metrics endpoint (METRICS_PORT, 0 = off).
+Recording is a dict lookup plus a bisect under a lock, so it stays on in
+production; gauges backed by a function are only evaluated on scrape.
+"""
+
+import os, time, bisect, threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+METRICS_PORT = int(os.getenv("METRICS_PORT","0"))
+BUCKETS = (.005,.01,.025,.05,.1,.25,.5,1,2.5,5,10,20,30)
+
+_REGISTRY:list["_Metric"] = []
+
+# ─── METRIC TYPES ───────────────────────────────────────────────────────────
+class _Metric:
+    kind = ""
+    def __init__(self, name:str, help:str, labels:tuple=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, kw:dict)->tuple:
+        return tuple(str(kw[l]) for l in self.labels)
+
+    def _lbl(self, key:tuple, extra:tuple=())->str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+    def render(self)->list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw); self._v:dict[tuple,float] = {}
+    def inc(self, n:float=1, **labels):
+        k = self._key(labels)
+        with self._lock: self._v[k] = self._v.get(k, 0) + n
+    def render(self):
+        with self._lock: items = list(self._v.items())
+        return super().render() + [f"{self.name}{self._lbl(k)} {v}" for k, v in items]
+
+class Gauge(_Metric):
+    kind = "gauge"
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw); self._v:dict[tuple,object] = {}
+    def set(self, v:float, **labels):
+        with self._lock: self._v[self._key(labels)] = v
+    def track(self, fn, **labels):
+        """Evaluate fn() at scrape time instead of pushing values."""
+        with self._lock: self._v[self._key(labels)] = fn
+    def render(self):
+        with self._lock: items = list(self._v.items())
+        out = super().render()
+        for k, v in items:
+            try: v = v() if callable(v) else v
+            except Exception: continue
+            out.append(f"{self.name}{self._lbl(k)} {v}")
+        return out
+
+class Histogram(_Metric):
+    kind = "histogram"
+    def __init__(self, *a, buckets:tuple=BUCKETS, **kw):
+        super().__init__(*a, **kw)
+        self.buckets = buckets
+        self._v:dict[tuple,list] = {}          # key -> [bucket counts..., +Inf, sum]
+    def observe(self, v:float, **labels):
+        k = self._key(labels); i = bisect.bisect_left(self.buckets, v)
+        with self._lock:
+            row = self._v.get(k)
+            if row is None: row = self._v[k] = [0] * (len(self.buckets) + 2)
+            row[i] += 1; row[-1] += v
+    @contextmanager
+    def time(self, **labels):
+        t = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - t, **labels)
+    def render(self):
+        with self._lock: items = [(k, list(r)) for k, r in self._v.items()]
+        out = super().render()
+        for k, row in items:
+            acc = 0
+            for b, c in zip(self.buckets + ("+Inf",), row):
+                acc += c
+                out.append(f"{self.name}_bucket{self._lbl(k, (('le', b),))} {acc}")
+            out.append(f"{self.name}_sum{self._lbl(k)} {row[-1]}")
+            out.append(f"{self.name}_count{self._lbl(k)} {acc}")
+        return out
+
+# ─── HOT-PATH METRICS ───────────────────────────────────────────────────────
+STAGE    = Histogram("meme_stage_seconds", "Latency of one hot-path stage", ("stage",))
+SOURCE   = Histogram("meme_source_seconds", "Latency of one meme source call", ("source",))
+CACHED   = Counter("meme_cached_lookups_total", "find_cached_url outcomes", ("result",))
+FALLBACK = Counter("meme_fallback_depth_total",
+                   "Position, in that request's source order, of the source that served it",
+                   ("lang","depth"))
+BREAKER  = Gauge("meme_source_breaker_open", "1 while a source is paused", ("source",))
+NEAR_DUP = Counter("meme_near_duplicates_total",
+                   "Candidates skipped as near-duplicates of a seen meme", ("path",))
+QUEUE    = Gauge("meme_executor_queue_depth", "Tasks waiting for a worker thread", ("executor",))
+DL_BYTES = Gauge("meme_download_dir_bytes", "Bytes held in DOWNLOAD_DIR")
+PHASHES  = Gauge("meme_phash_index_entries", "Perceptual hashes in the near-duplicate index")
+COALESCED = Counter("meme_coalesced_calls_total",
+                    "Searches/downloads that joined an identical in-flight call", ("kind",))
+WB_ERRORS = Counter("meme_write_behind_errors_total",
+                    "Write-behind failures: failed batches, dropped poison rows, buffer overflow",
+                    ("result",))
+BCAST    = Counter("meme_broadcast_messages_total", "Daily broadcast sends by outcome",
+                   ("lang","result"))
+
+def executor_depth(pool)->int:
+    return pool._work_queue.qsize()
+
+# ─── EXPOSITION ─────────────────────────────────────────────────────────────
+def render()->str:
+    return "\n".join(line for m in _REGISTRY for line in m.render()) + "\n"
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404); return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, *a): pass
+
+def serve(port:int=METRICS_PORT)->ThreadingHTTPServer|None:
+    """Start /metrics on a daemon thread; no-op when port is 0."""
+    if not port: return None
+    srv = ThreadingHTTPServer(("0.0.0.0", port), _Handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="metrics", daemon=True).start()
+    return srv
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+migrate.py – idempotent schema changes for meme_fetcher_4 / meme_bot
+
+Usage
+-----
+python migrate.py                    # apply all DDL below
+python migrate.py --backfill-unseen  # + build unseen queues from the journal
+python migrate.py --backfill-phash   # + perceptual hashes for memes still in memes/
+python migrate.py --backfill-keywords  # + stemmed keywords for KW_INDEX=1
+"""
+
+import argparse
+import meme_fetcher_4 as mf
+import media
+
+# ─── DDL ────────────────────────────────────────────────────────────────────
+DDL = [
+    # lazy blacklist: anti-join on md5(url), incremental Bloom refresh by journal ID
+    'CREATE INDEX IF NOT EXISTS "memes_all_urls_md5_idx" '
+    'ON "memes_all_urls" (md5("url"))',
+    'CREATE INDEX IF NOT EXISTS "memes_queries_journal_user_idx" '
+    'ON "memes_queries_journal" ("USER_ID","ID")',
+    'CREATE INDEX IF NOT EXISTS "memes_queries_journal_chat_idx" '
+    'ON "memes_queries_journal" ("CHAT_ID","ID")',
+    # "next unseen meme" queue for find_cached_url (UNSEEN_QUEUE=1)
+    'CREATE TABLE IF NOT EXISTS "memes_unseen_cursor" ('
+    ' "KIND" char(1) NOT NULL, "IDENT" bigint NOT NULL,'
+    ' "KEYWORD" text NOT NULL, "LANG" text NOT NULL,'
+    ' "built_at" timestamp NOT NULL DEFAULT NOW(),'
+    ' PRIMARY KEY ("KIND","IDENT","KEYWORD","LANG"))',
+    'CREATE INDEX IF NOT EXISTS "memes_unseen_cursor_kw_idx" '
+    'ON "memes_unseen_cursor" ("KEYWORD","LANG")',
+    'CREATE TABLE IF NOT EXISTS "memes_unseen_queue" ('
+    ' "KIND" char(1) NOT NULL, "IDENT" bigint NOT NULL,'
+    ' "KEYWORD" text NOT NULL, "LANG" text NOT NULL,'
+    ' "URL_ID" bigint NOT NULL, "date_upload" timestamp,'
+    ' PRIMARY KEY ("KIND","IDENT","KEYWORD","LANG","URL_ID"))',
+    'CREATE INDEX IF NOT EXISTS "memes_unseen_queue_next_idx" '
+    'ON "memes_unseen_queue" ("KIND","IDENT","KEYWORD","LANG","date_upload" DESC)',
+    'CREATE INDEX IF NOT EXISTS "memes_unseen_queue_url_idx" '
+    'ON "memes_unseen_queue" ("KIND","IDENT","URL_ID")',
+    'CREATE INDEX IF NOT EXISTS "memes_key_words_using_url_idx" '
+    'ON "memes_key_words_using" ("ID_URL","Keywords_Searched_user","Language")',
+    # Telegram file_id of the first upload, reused by later sends (FILE_IDS=1)
+    'ALTER TABLE "memes_all_urls" ADD COLUMN IF NOT EXISTS "tg_file_id" text',
+    # perceptual hash (dHash) for near-duplicate skipping (PHASH=1)
+    'ALTER TABLE "memes_all_urls" ADD COLUMN IF NOT EXISTS "phash" bigint',
+    'CREATE INDEX IF NOT EXISTS "memes_all_urls_phash_idx" '
+    'ON "memes_all_urls" ("ID") WHERE "phash" IS NOT NULL',
+    # stemmed keywords + trigram search over keywords and titles (KW_INDEX=1);
+    # CREATE EXTENSION needs a role allowed to create it (superuser before PG13)
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'ALTER TABLE "memes_key_words_using" ADD COLUMN IF NOT EXISTS "kw_norm" text',
+    'CREATE INDEX IF NOT EXISTS "memes_key_words_using_norm_idx" '
+    'ON "memes_key_words_using" ("kw_norm","Language","ID_URL")',
+    'CREATE INDEX IF NOT EXISTS "memes_key_words_using_norm_trgm_idx" '
+    'ON "memes_key_words_using" USING gin ("kw_norm" gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS "memes_all_urls_name_trgm_idx" '
+    'ON "memes_all_urls" USING gin (lower("name") gin_trgm_ops)',
+    # daily broadcast: the day's pick per language, progress and a lease (broadcast.py)
+    'CREATE TABLE IF NOT EXISTS "memes_broadcast" ('
+    ' "DAY" date NOT NULL, "LANG_ID" int NOT NULL,'
+    ' "URL_ID" bigint REFERENCES "memes_all_urls" ("ID"), "file_id" text,'
+    ' "sent" int NOT NULL DEFAULT 0, "lease_until" timestamptz, "done_at" timestamptz,'
+    ' PRIMARY KEY ("DAY","LANG_ID"))',
+    # who already got the day's meme: anti-join on the url's journal rows
+    'CREATE INDEX IF NOT EXISTS "memes_queries_journal_url_idx" '
+    'ON "memes_queries_journal" ("URL_ID")',
+]
+
+# statements that can fail on existing data: each runs in its own transaction
+# so a failure is reported without rolling back DDL above
+OPTIONAL_DDL = [
+    # INSERT ... ON CONFLICT (md5(url)) for upsert_url (UPSERT_URLS=1);
+    # fails if memes_all_urls already holds duplicate urls – dedupe those first
+    ('CREATE UNIQUE INDEX IF NOT EXISTS "memes_all_urls_md5_key" '
+     'ON "memes_all_urls" (md5("url"))',
+     'SELECT count(*) FROM (SELECT 1 FROM "memes_all_urls" '
+     'GROUP BY md5("url") HAVING count(*)>1) d'),
+]
+
+def apply_ddl(db:mf.Db)->list[str]:
+    """DDL in one transaction, then OPTIONAL_DDL one by one. -> failure messages."""
+    cur=db.cx.cursor()
+    for stmt in DDL:
+        cur.execute(stmt)
+    db.cx.commit()
+    failed=[]
+    for stmt,why in OPTIONAL_DDL:
+        try:
+            cur.execute(stmt); db.cx.commit()
+        except mf.pyodbc.Error as e:
+            db.cx.rollback()
+            n=cur.execute(why).fetchone()[0]
+            failed.append(f"{stmt.split(' ON ')[0]}: {e} ({n} conflicting values)")
+    return failed
+
+def backfill_unseen(db:mf.Db)->int:
+    """Build an unseen queue for every (identity, keyword, lang) in the usage log."""
+    rows=db.cx.cursor().execute(
+        'SELECT DISTINCT "USER_ID","CHAT_ID","Keywords_Searched_user","Language" '
+        'FROM "memes_key_words_using"').fetchall()
+    n=0
+    for uid,cid,key,lang in rows:
+        field,val=('USER_ID',uid) if uid is not None else ('CHAT_ID',cid)
+        if val is None: continue
+        n+=db.build_unseen(key,lang,field,val)
+    return n
+
+def backfill_phash(db:mf.Db)->int:
+    """dHash every un-hashed url whose bytes are still in the download store."""
+    rows=db.cx.cursor().execute(
+        'SELECT "ID","url" FROM "memes_all_urls" WHERE "phash" IS NULL').fetchall()
+    n=0
+    for url_id,url in rows:
+        path=mf.STORE.get(url)
+        h=media.dhash(path) if path else None
+        if h is None: continue
+        db.set_phash(url_id,h); n+=1
+    return n
+
+def backfill_keywords(db:mf.Db)->int:
+    """Fill kw_norm for usage rows written before KW_INDEX was on."""
+    cur=db.cx.cursor()
+    keys=[r[0] for r in cur.execute(
+        'SELECT DISTINCT "Keywords_Searched_user" FROM "memes_key_words_using" '
+        'WHERE "kw_norm" IS NULL AND "Keywords_Searched_user" IS NOT NULL').fetchall()]
+    for key in keys:
+        cur.execute('UPDATE "memes_key_words_using" SET "kw_norm"=? '
+                    'WHERE "Keywords_Searched_user"=? AND "kw_norm" IS NULL',mf.stem_key(key),key)
+    db.cx.commit()
+    return len(keys)
+
+def main():
+    p=argparse.ArgumentParser()
+    p.add_argument("--backfill-unseen",action="store_true",
+                   help="materialize unseen queues from the existing journal")
+    p.add_argument("--backfill-phash",action="store_true",
+                   help="perceptual-hash memes whose files are still stored")
+    p.add_argument("--backfill-keywords",action="store_true",
+                   help="stem keywords already in memes_key_words_using")
+    args=p.parse_args()
+    with mf.pooled_db() as db:
+        failed=apply_ddl(db)
+        print(f"✅ {len(DDL)+len(OPTIONAL_DDL)-len(failed)} DDL statements applied")
+        for msg in failed: print(f"⚠️ {msg}")
+        if args.backfill_unseen:
+            print(f"✅ {backfill_unseen(db)} unseen queues built")
+        if args.backfill_phash:
+            print(f"✅ {backfill_phash(db)} perceptual hashes stored")
+        if args.backfill_keywords:
+            print(f"✅ {backfill_keywords(db)} distinct keywords stemmed")
+    mf.close_pool()
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+prefetch.py – warm pool of ready-to-send memes for meme_bot
+
+• keeps PREFETCH_N memes per language and per popular keyword
+• metadata goes to memes_all_urls, bytes to mf.DOWNLOAD_DIR
+• refills in the background between low/high watermarks, drops stale entries
+• serve() hands one unseen meme to an identity and journals it
+"""
+
+import os, time, asyncio, logging, threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import meme_fetcher_4 as mf
+
+log = logging.getLogger("prefetch")
+
+# ─── CONFIG ─────────────────────────────────────────────────────────────────
+PREFETCH             = os.getenv("PREFETCH","1")=="1"
+PREFETCH_N           = int(os.getenv("PREFETCH_N","8"))            # high watermark
+PREFETCH_LOW         = int(os.getenv("PREFETCH_LOW","3"))          # refill below this
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY","4"))
+PREFETCH_TTL         = float(os.getenv("PREFETCH_TTL","3600"))     # seconds a meme stays
+PREFETCH_KEYWORDS    = int(os.getenv("PREFETCH_KEYWORDS","5"))     # popular keywords per lang
+PREFETCH_TICK        = float(os.getenv("PREFETCH_TICK","10"))
+KW_REFRESH_TICKS     = 60                                          # re-rank keywords every ~10 min
+LANGS = ("eng","rus")
+
+# ─── PREFETCHER ─────────────────────────────────────────────────────────────
+class Prefetcher:
+    def __init__(self):
+        self.pools:dict[tuple,deque]=defaultdict(deque)   # (lang, norm keyword) -> memes
+        self.keys:list[tuple]=[(l,'') for l in LANGS]
+        self._filling:set[tuple]=set()
+        self._lock=threading.Lock()
+        self._exec=ThreadPoolExecutor(max_workers=PREFETCH_CONCURRENCY,
+                                      thread_name_prefix="prefetch")
+
+    # --- background side -----------------------------------------------------
+    def _popular(self)->list[tuple]:
+        with mf.pooled_db() as db:
+            return [(l,mf.norm_key(k)) for l in LANGS
+                    for k in db.popular_keywords(l,PREFETCH_KEYWORDS)]
+
+    def _fetch_one(self, lang:str, key:str)->dict:
+        m=(mf.pick_russian_meme(key or None) if lang=="rus"
+           else mf.pick_english_meme(key or None))
+        path=mf.download(m['url'])
+        with mf.pooled_db() as db:
+            url_id=db.ensure_url(m['url'],m['title'],m['source'])
+            h=mf.phash_of(db,url_id,path) if mf.PHASH else None
+        return dict(m,id=url_id,path=path,phash=h,ts=time.monotonic())
+
+    def _evict(self):
+        old=time.monotonic()-PREFETCH_TTL
+        with self._lock:
+            for pool in self.pools.values():
+                while pool and pool[0]['ts']<old: pool.popleft()
+
+    async def _refill(self, key:tuple):
+        loop=asyncio.get_running_loop()
+        self._filling.add(key)
+        try:
+            # bounded: a keyword with fewer than PREFETCH_N distinct memes keeps
+            # returning ones already pooled; stop on a repeat, retry next tick
+            for _ in range(2*PREFETCH_N):
+                if len(self.pools[key])>=PREFETCH_N: break
+                try:
+                    m=await loop.run_in_executor(self._exec,self._fetch_one,*key)
+                except Exception as e:
+                    log.warning("prefetch %s failed: %s",key,e); break
+                with self._lock:
+                    if m['url'] in {x['url'] for x in self.pools[key]}: break
+                    self.pools[key].append(m)
+        finally:
+            self._filling.discard(key)
+
+    async def run(self):
+        loop=asyncio.get_running_loop(); tick=0
+        while True:
+            if tick%KW_REFRESH_TICKS==0:
+                try:
+                    self.keys=[(l,'') for l in LANGS]+await loop.run_in_executor(
+                        self._exec,self._popular)
+                except Exception as e:
+                    log.warning("popular keywords failed: %s",e)
+            self._evict()
+            for key in self.keys:
+                if len(self.pools[key])<PREFETCH_LOW and key not in self._filling:
+                    loop.create_task(self._refill(key))
+            tick+=1
+            await asyncio.sleep(PREFETCH_TICK)
+
+    def close(self):
+        self._exec.shutdown(wait=False,cancel_futures=True)
+
+    # --- request side (runs in the fetch thread) -----------------------------
+    def serve(self, keywords:str|None, lang:str,
+              user:int|None, chat:int|None)->dict|None:
+        """Pop a ready meme the identity has not seen and journal it; None on miss."""
+        key=(lang,mf.norm_key(keywords))
+        with self._lock:
+            urls=[m['url'] for m in self.pools.get(key,())]
+        if not urls: return None
+        field='USER_ID' if user is not None else 'CHAT_ID'
+        val=user if user is not None else chat
+        with mf.pooled_db() as db:
+            unseen=set(db.blacklist(field,val).filter(urls))
+            with self._lock:
+                cand=[x for x in self.pools[key] if x['url'] in unseen and x['path'].exists()]
+            m=next((x for x in cand if not db.near_seen(x['phash'],x['id'],field,val)),None)
+            if m is None: return None
+            with self._lock:
+                try: self.pools[key].remove(m)
+                except ValueError: return None       # served to someone else meanwhile
+            db.add_journal(m['id'],field,val,m['url'])
+            if keywords or lang:
+                db.add_keyword_usage(m['id'],keywords,lang,field,val)
+            fid=db.file_id(m['id']) if mf.FILE_IDS else None
+        return dict(m,file_id=fid)
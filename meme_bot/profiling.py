@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+profiling.py – opt-in profiling for meme_bot / meme_fetcher_4
+
+    PROFILE=1 python meme_bot.py         # on from the start (PROFILE_MEM=1: tracemalloc too)
+    /profile on|off|status|cpu [s]|mem|dump   (ADMIN_IDS only, at runtime)
+
+• @traced handlers (send_meme, _fetch_sync, afetch.main, …) record their
+  nested spans and every SQL statement with its time; a request slower than
+  PROFILE_SLOW s is dumped as slow-*.json, with the EXPLAIN of slow
+  find_cached_url queries and, with PROFILE_CPROFILE=1, its cProfile stats
+• cProfile runs for one request at a time (one profiler per interpreter on
+  3.12+); stats are also summed per handler for /profile dump
+• /profile cpu 30 samples every thread's stack for 30 s into a folded-stack
+  file (flamegraph.pl, speedscope); /profile mem starts tracemalloc, then
+  dumps a snapshot plus the top growth since the last one
+• files land in PROFILE_DIR (`docker cp` them out); when off, hooks cost one
+  flag check and connections are not wrapped
+"""
+
+import os, sys, json, time, inspect, logging, cProfile, pstats, functools, threading, tracemalloc, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, defaultdict
+from pathlib import Path
+
+log = logging.getLogger("profiling")
+
+# ─── CONFIG ─────────────────────────────────────────────────────────────────
+ACTIVE          = os.getenv("PROFILE","0")=="1"                  # traces + SQL timing
+CPROFILE        = os.getenv("PROFILE_CPROFILE","0")=="1"         # + cProfile per request
+PROFILE_DIR     = Path(os.getenv("PROFILE_DIR") or Path(__file__).parent.resolve() / "profiles")
+PROFILE_SLOW    = float(os.getenv("PROFILE_SLOW","2"))           # s; slower requests are dumped
+PROFILE_SQL_SLOW = float(os.getenv("PROFILE_SQL_SLOW","0.1"))    # s; EXPLAIN find_cached_url SQL above this
+PROFILE_ANALYZE = os.getenv("PROFILE_ANALYZE","0")=="1"          # EXPLAIN ANALYZE (runs the query again)
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL","0.005"))  # stack sampling period
+PROFILE_MEM     = os.getenv("PROFILE_MEM","0")=="1"              # tracemalloc from import on
+PROFILE_FRAMES  = int(os.getenv("PROFILE_FRAMES","10"))          # tracemalloc traceback depth
+PROFILE_KEEP    = int(os.getenv("PROFILE_KEEP","200"))           # newest dump files kept
+TRACE_EVENTS    = 500                                            # spans/statements per trace
+SQL_TEXT        = 300                                            # chars of SQL kept per event
+
+_TRACE:contextvars.ContextVar["Trace|None"] = contextvars.ContextVar("trace", default=None)
+_SLOT = threading.Lock()                  # the one cProfile that may run
+_STATS:dict[str,pstats.Stats] = {}        # handler -> summed cProfile stats
+_SQL:dict[str,list] = defaultdict(lambda: [0, 0.0, 0.0])   # sql -> [count, total, max]
+_LOCK = threading.Lock()
+_SAMPLER:"Sampler|None" = None
+_LAST_MEM:tracemalloc.Snapshot|None = None
+_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profile-dump")   # off the loop
+if PROFILE_MEM: tracemalloc.start(PROFILE_FRAMES)
+
+# ─── FILES ──────────────────────────────────────────────────────────────────
+def _path(kind:str, name:str="", ext:str=".json")->Path:
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    def mtime(p):
+        try: return p.stat().st_mtime
+        except OSError: return 0                  # pruned by another writer meanwhile
+    old = sorted(PROFILE_DIR.iterdir(), key=mtime)
+    for p in old[:max(0, len(old) - PROFILE_KEEP + 1)]: p.unlink(missing_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S") + f"-{time.time_ns() // 1000 % 10**6:06d}"
+    return PROFILE_DIR / f"{kind}-{stamp}{'-' + name if name else ''}{ext}"
+
+# ─── TRACES ─────────────────────────────────────────────────────────────────
+class Trace:
+    """One request: spans, SQL statements, EXPLAINs; list appends are thread-safe."""
+    def __init__(self, name:str, tags:dict):
+        self.name, self.tags = name, tags
+        self.t0 = time.perf_counter(); self.start = time.time()
+        self.spans:list = []; self.sql:list = []; self.explain:list = []
+        self.prof:cProfile.Profile|None = None
+
+    def at(self)->float:
+        return round((time.perf_counter() - self.t0) * 1e3, 2)
+
+    def dump(self, wall:float)->Path:
+        path = _path("slow", self.name)
+        out = dict(name=self.name, tags=self.tags, wall_ms=round(wall * 1e3, 2),
+                   start=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)),
+                   spans=self.spans, sql=self.sql, explain=self.explain,
+                   sql_ms=round(sum(e["ms"] for e in self.sql), 2))
+        if self.prof:
+            prof = path.with_suffix(".pstats"); self.prof.dump_stats(prof); out["pstats"] = prof.name
+        path.write_text(json.dumps(out, indent=1, ensure_ascii=False, default=str))
+        return path
+
+    def dump_safe(self, wall:float):
+        """dump() for the writer thread: a failing PROFILE_DIR only costs a warning."""
+        try: self.dump(wall)
+        except Exception as e: log.warning("slow trace %s not written: %s", self.name, e)
+
+def _begin(name:str, tags:dict):
+    """(trace, token, started_here): a new root, or a span inside the current one."""
+    tr = _TRACE.get()
+    if tr is not None: return tr, None, False
+    tr = Trace(name, tags)
+    if CPROFILE and _SLOT.acquire(blocking=False):
+        tr.prof = cProfile.Profile()
+        try: tr.prof.enable()
+        except ValueError:                          # another profiler is already active
+            tr.prof = None; _SLOT.release()
+    return tr, _TRACE.set(tr), True
+
+def _end(tr:Trace, token, root:bool, name:str, t:float, err:BaseException|None):
+    ms = round((time.perf_counter() - t) * 1e3, 2)
+    if not root:
+        if len(tr.spans) < TRACE_EVENTS:
+            tr.spans.append(dict(name=name, at=round((t - tr.t0) * 1e3, 2), ms=ms,
+                                 **({"error": repr(err)} if err else {})))
+        return
+    _TRACE.reset(token)
+    if tr.prof:
+        tr.prof.disable(); _SLOT.release()
+        with _LOCK:
+            if name in _STATS: _STATS[name].add(tr.prof)
+            else: _STATS[name] = pstats.Stats(tr.prof)
+    if err: tr.tags["error"] = repr(err)
+    if ms >= PROFILE_SLOW * 1e3: _WRITER.submit(tr.dump_safe, ms / 1e3)
+
+def traced(name:str|None=None):
+    """Decorator for handlers and fetch functions, sync or async; one flag check when off."""
+    def wrap(fn):
+        label = name or fn.__name__; names = list(inspect.signature(fn).parameters)
+        tags = lambda a, kw: {k: v for k, v in (*zip(names, a), *kw.items())
+                              if isinstance(v, (int, str, type(None)))}
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def run(*a, **kw):
+                if not ACTIVE: return await fn(*a, **kw)
+                tr, token, root = _begin(label, tags(a, kw)); t = time.perf_counter(); err = None
+                try: return await fn(*a, **kw)
+                except BaseException as e: err = e; raise
+                finally: _end(tr, token, root, label, t, err)
+        else:
+            @functools.wraps(fn)
+            def run(*a, **kw):
+                if not ACTIVE: return fn(*a, **kw)
+                tr, token, root = _begin(label, tags(a, kw)); t = time.perf_counter(); err = None
+                try: return fn(*a, **kw)
+                except BaseException as e: err = e; raise
+                finally: _end(tr, token, root, label, t, err)
+        return run
+    return wrap
+
+def bind(fn):
+    """fn carrying the caller's trace into run_in_executor (which drops contextvars)."""
+    if not ACTIVE or _TRACE.get() is None: return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+# ─── SQL ────────────────────────────────────────────────────────────────────
+class TracedCursor:
+    """pyodbc cursor that times execute() into the current trace and _SQL."""
+    def __init__(self, cur, cx):
+        object.__setattr__(self, "_cur", cur); object.__setattr__(self, "_cx", cx)
+
+    def execute(self, sql:str, *params):
+        t = time.perf_counter()
+        try: self._cur.execute(sql, *params)
+        finally: dt = time.perf_counter() - t
+        key = " ".join(sql.split())[:SQL_TEXT]
+        with _LOCK:
+            s = _SQL[key]; s[0] += 1; s[1] += dt; s[2] = max(s[2], dt)
+        tr = _TRACE.get()
+        if tr is not None and len(tr.sql) < TRACE_EVENTS:
+            caller = sys._getframe(1).f_code.co_name
+            tr.sql.append(dict(at=tr.at(), ms=round(dt * 1e3, 2), caller=caller, sql=key,
+                               params=[p if isinstance(p, (int, float)) else str(p)[:80]
+                                       for p in params[:20]]))
+            if dt >= PROFILE_SQL_SLOW and caller.startswith("_find_") and key[:6].upper() == "SELECT":
+                tr.explain.append(dict(caller=caller, ms=round(dt * 1e3, 2), sql=key,
+                                       plan=_explain(self._cx, sql, params)))
+        return self
+
+    def __iter__(self): return iter(self._cur)
+    def __getattr__(self, name): return getattr(self._cur, name)
+    def __setattr__(self, name, value): setattr(self._cur, name, value)
+
+def _explain(cx, sql:str, params)->list[str]|str:
+    try:
+        head = "EXPLAIN (ANALYZE, BUFFERS) " if PROFILE_ANALYZE else "EXPLAIN "
+        return [r[0] for r in cx.cursor().execute(head + sql, *params).fetchall()]
+    except Exception as e:
+        return f"EXPLAIN failed: {e}"
+
+class TracedConnection:
+    """pyodbc connection whose cursors are TracedCursors; .raw goes back to the pool."""
+    def __init__(self, cx):
+        object.__setattr__(self, "raw", cx)
+    def cursor(self): return TracedCursor(self.raw.cursor(), self.raw)
+    def __getattr__(self, name): return getattr(self.raw, name)
+    def __setattr__(self, name, value): setattr(self.raw, name, value)
+
+def traced_cx(cx):
+    return TracedConnection(cx) if ACTIVE else cx
+
+def raw_cx(cx):
+    return cx.raw if isinstance(cx, TracedConnection) else cx
+
+# ─── SAMPLER ────────────────────────────────────────────────────────────────
+class Sampler(threading.Thread):
+    """Wall-clock stack sampling of every thread into folded stacks."""
+    def __init__(self, secs:float, interval:float=PROFILE_INTERVAL):
+        super().__init__(name="sampler", daemon=True)
+        self.secs, self.interval = secs, interval
+        self.counts:Counter = Counter(); self.halt = threading.Event()
+        self.path = _path("wall", ext=".folded")
+
+    def run(self):
+        me = threading.get_ident(); end = time.monotonic() + self.secs; names = {}
+        while time.monotonic() < end and not self.halt.is_set():
+            frames = sys._current_frames()
+            if frames.keys() - names.keys():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, f in frames.items():
+                if tid == me: continue
+                stack = []
+                while f is not None:
+                    c = f.f_code
+                    stack.append(f"{c.co_name} ({os.path.basename(c.co_filename)}:{c.co_firstlineno})")
+                    f = f.f_back
+                self.counts[";".join([names.get(tid, str(tid))] + stack[::-1])] += 1
+            time.sleep(self.interval)
+        self.path.write_text("".join(f"{s} {n}\n" for s, n in self.counts.most_common()))
+
+# ─── CONTROL ────────────────────────────────────────────────────────────────
+def start_sampler(secs:float)->Path:
+    global _SAMPLER
+    if _SAMPLER and _SAMPLER.is_alive(): _SAMPLER.halt.set(); _SAMPLER.join()
+    _SAMPLER = Sampler(secs); _SAMPLER.start()
+    return _SAMPLER.path
+
+def mem_snapshot()->tuple[Path,Path]|None:
+    """Start tracemalloc, or dump a snapshot and its top growth since the last one."""
+    global _LAST_MEM
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(PROFILE_FRAMES); return None
+    snap = tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),))
+    path = _path("mem", ext=".tracemalloc"); snap.dump(str(path))
+    top = snap.compare_to(_LAST_MEM, "lineno") if _LAST_MEM else snap.statistics("lineno")
+    txt = path.with_suffix(".txt")
+    txt.write_text("".join(f"{s}\n" for s in top[:30]))
+    _LAST_MEM = snap
+    return path, txt
+
+def dump()->list[Path]:
+    """Summed cProfile stats per handler and per-SQL timings since profiling started."""
+    out = []
+    with _LOCK:
+        stats = dict(_STATS); sql = {k: list(v) for k, v in _SQL.items()}
+    for name, st in stats.items():
+        p = _path("cprofile", name, ".pstats"); st.dump_stats(p); out.append(p)
+    rows = sorted(({"sql": k, "count": c, "total_ms": round(t * 1e3, 2),
+                    "mean_ms": round(t / c * 1e3, 3), "max_ms": round(m * 1e3, 2)}
+                   for k, (c, t, m) in sql.items()), key=lambda r: -r["total_ms"])
+    p = _path("sql"); p.write_text(json.dumps(rows, indent=1, ensure_ascii=False)); out.append(p)
+    return out
+
+def command(args:list[str])->str:
+    """/profile on [cprofile] | off | status | cpu [secs] | mem | dump"""
+    try: return _command(args)
+    except Exception as e:
+        log.warning("/profile %s failed: %s", " ".join(args), e)
+        return f"failed: {e}"
+
+def _command(args:list[str])->str:
+    global ACTIVE, CPROFILE
+    cmd = args[0] if args else "status"
+    if cmd == "on":
+        ACTIVE = True; CPROFILE = CPROFILE or "cprofile" in args[1:]
+        return f"tracing on (cprofile {'on' if CPROFILE else 'off'}), slow > {PROFILE_SLOW}s"
+    if cmd == "off":
+        ACTIVE = CPROFILE = False
+        if tracemalloc.is_tracing(): tracemalloc.stop()
+        return "profiling off"
+    if cmd == "cpu":
+        secs = float(args[1]) if len(args) > 1 else 30
+        return f"sampling {secs:g}s → {start_sampler(secs)}"
+    if cmd == "mem":
+        got = mem_snapshot()
+        return "tracemalloc started, send /profile mem again" if got is None else \
+            f"snapshot → {got[0]}\ntop growth → {got[1]}"
+    if cmd == "dump":
+        return "\n".join(str(p) for p in dump())
+    return (f"tracing {'on' if ACTIVE else 'off'}, cprofile {'on' if CPROFILE else 'off'}, "
+            f"tracemalloc {'on' if tracemalloc.is_tracing() else 'off'}, "
+            f"sampler {'running' if _SAMPLER and _SAMPLER.is_alive() else 'idle'}; files in {PROFILE_DIR}")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+store.py – content-addressed download store for meme_fetcher_4
+
+Files live at <root>/<sha256[:2]>/<sha256><ext>, so two memes that share a
+basename never collide and identical downloads are stored once. A small
+sqlite index (url → sha, sha → size/last access) is loaded into an LRU at
+startup; lookups are O(1) and eviction trims the oldest blobs incrementally
+whenever the byte budget is exceeded. A normalized copy made by media.py
+lives beside its blob as <sha>.tg.<ext>, counts toward the blob's size and
+is evicted with it.
+
+The in-memory index is owned by one process per root: another process
+(broadcast.py from cron, a second worker on a shared volume) keeps its own
+copy, and its evictions are only noticed when get() finds the file gone.
+Give each long-running process its own MEME_DIR.
+"""
+
+import os, time, sqlite3, hashlib, threading, tempfile
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import urlparse
+
+EXTS = {".jpg",".jpeg",".png",".gif",".webp",".mp4",".webm"}
+
+def url_key(url:str)->str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+class Store:
+    def __init__(self, root:Path, max_bytes:int):
+        self.root=root; self.max_bytes=max_bytes
+        self._lock=threading.Lock()
+        self._db=sqlite3.connect(root/"index.sqlite3",check_same_thread=False)
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY, name TEXT,'
+            ' size INTEGER, atime REAL);'
+            'CREATE TABLE IF NOT EXISTS urls (ukey TEXT PRIMARY KEY, sha TEXT);'
+            'CREATE INDEX IF NOT EXISTS urls_sha ON urls (sha);')
+        self._lru:OrderedDict=OrderedDict()      # sha -> [name, size], oldest first
+        self._urls:dict[str,str]={}              # url key -> sha
+        self._refs:dict[str,set]={}              # sha -> url keys
+        self.total=0
+        for sha,name,size in self._db.execute(
+                'SELECT sha,name,size FROM blobs ORDER BY atime'):
+            self._lru[sha]=[name,size]; self.total+=size
+        for ukey,sha in self._db.execute('SELECT ukey,sha FROM urls'):
+            self._urls[ukey]=sha; self._refs.setdefault(sha,set()).add(ukey)
+
+    def _path(self, name:str)->Path:
+        return self.root/name[:2]/name
+
+    def get(self, url:str)->Path|None:
+        """Path of an already stored url (and mark it recently used), else None."""
+        with self._lock:
+            sha=self._urls.get(url_key(url))
+            if sha is None or sha not in self._lru: return None
+            if not self._path(self._lru[sha][0]).exists():   # removed behind our back
+                self._drop(sha); self._db.commit(); return None
+            self._lru.move_to_end(sha)
+            self._db.execute('UPDATE blobs SET atime=? WHERE sha=?',(time.time(),sha))
+            self._db.commit()
+            return self._path(self._lru[sha][0])
+
+    def put_file(self, url:str, tmp:Path, sha:str, size:int)->Path:
+        """Adopt a fully written temp file whose sha256/size the caller computed."""
+        ext=Path(urlparse(url).path).suffix.lower()
+        name=sha+(ext if ext in EXTS else ".jpg")
+        with self._lock:
+            if sha in self._lru:                 # identical bytes already stored
+                tmp.unlink(missing_ok=True)
+                name=self._lru[sha][0]; self._lru.move_to_end(sha)
+            else:
+                dest=self._path(name); dest.parent.mkdir(exist_ok=True)
+                os.replace(tmp,dest)
+                self._lru[sha]=[name,size]; self.total+=size
+                self._db.execute('INSERT OR REPLACE INTO blobs VALUES (?,?,?,?)',
+                                 (sha,name,size,time.time()))
+            ukey=url_key(url); self._urls[ukey]=sha
+            self._refs.setdefault(sha,set()).add(ukey)
+            self._db.execute('INSERT OR REPLACE INTO urls VALUES (?,?)',(ukey,sha))
+            self._evict(keep=sha)
+            self._db.commit()
+            return self._path(name)
+
+    def put(self, url:str, data:bytes)->Path:
+        fd,tmp=tempfile.mkstemp(dir=self.root,suffix=".part")
+        with os.fdopen(fd,"wb") as f: f.write(data)
+        return self.put_file(url,Path(tmp),hashlib.sha256(data).hexdigest(),len(data))
+
+    def derived(self, path:Path)->Path|None:
+        """The normalized sibling (<sha>.tg.<ext>) of a stored blob, if any."""
+        sha=path.name.split(".")[0]
+        return next((p for p in path.parent.glob(sha+".tg.*")
+                     if p.suffix!=".part"),None)
+
+    def put_derived(self, path:Path, tmp:Path)->Path:
+        """
+        Adopt <sha>.tg.<ext>.<job>.part, written from blob `path`, as its
+        derived copy; if another job adopted one first, keep that one.
+        """
+        sha=path.name.split(".")[0]
+        dest=tmp.with_name(".".join(tmp.name.split(".")[:3]))
+        with self._lock:
+            e=self._lru.get(sha)
+            if e is None or dest.exists():       # evicted meanwhile / already adopted
+                tmp.unlink(missing_ok=True)
+                return dest if e is not None else path
+            size=tmp.stat().st_size
+            os.replace(tmp,dest)
+            e[1]+=size; self.total+=size
+            self._db.execute('UPDATE blobs SET size=? WHERE sha=?',(e[1],sha))
+            self._evict(keep=sha)
+            self._db.commit()
+        return dest
+
+    def _evict(self, keep:str):
+        while self.total>self.max_bytes and len(self._lru)>1:
+            sha,(name,size)=next(iter(self._lru.items()))
+            if sha==keep: break
+            self._drop(sha)
+
+    def _drop(self, sha:str):
+        name,size=self._lru.pop(sha); self.total-=size
+        self._path(name).unlink(missing_ok=True)
+        for p in self._path(name).parent.glob(sha+".tg.*"): p.unlink(missing_ok=True)
+        self._db.execute('DELETE FROM blobs WHERE sha=?',(sha,))
+        self._db.execute('DELETE FROM urls WHERE sha=?',(sha,))
+        for k in self._refs.pop(sha,()): self._urls.pop(k,None)
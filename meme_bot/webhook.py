@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+webhook.py – webhook front + sharded workers for meme_bot
+
+    python webhook.py                      # front: receives Telegram's POSTs
+    BOT_MODE=worker python meme_bot.py     # worker: one event loop, one core
+
+• the front registers WEBHOOK_URL with Telegram and forwards every update
+  to one worker, picked by rendezvous hashing of its chat id over the
+  addresses WORKERS resolves to (re-resolved every WORKER_REFRESH s), so a
+  chat's locks and caches stay in one process and adding or removing a
+  worker moves only that worker's share of chats
+• the front answers Telegram only after a worker queued the update; any
+  non-2xx makes Telegram deliver it again later, so nothing is lost while
+  a front or worker restarts
+• a draining worker (SIGTERM) answers 503 and the front tries the next
+  worker in that chat's ranking – the one the chat moves to anyway once the
+  worker leaves DNS – then the worker finishes its queued updates
+  (DRAIN_TIMEOUT) and exits
+"""
+
+import os, json, signal, socket, asyncio, hashlib, logging
+
+import httpx
+
+log = logging.getLogger("webhook")
+
+# ─── CONFIG ─────────────────────────────────────────────────────────────────
+TELEGRAM_TOKEN    = os.getenv("TELEGRAM_TOKEN","")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE","https://api.telegram.org/bot")
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL","")                 # public https url of the front
+WEBHOOK_PATH   = os.getenv("WEBHOOK_PATH","/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET","")              # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_CONN   = int(os.getenv("WEBHOOK_CONN","100"))        # Telegram's parallel deliveries
+FRONT_PORT     = int(os.getenv("FRONT_PORT","8080"))
+WORKER_PORT    = int(os.getenv("WORKER_PORT","8081"))
+WORKERS        = os.getenv("WORKERS","127.0.0.1:8081")       # host:port,…  a host may resolve to many
+WORKER_REFRESH = float(os.getenv("WORKER_REFRESH","10"))
+DRAIN_TIMEOUT  = float(os.getenv("DRAIN_TIMEOUT","30"))
+MAX_BODY       = 1<<20
+REASON = {200:"OK",400:"Bad Request",403:"Forbidden",404:"Not Found",
+          413:"Payload Too Large",503:"Service Unavailable"}
+
+# ─── TINY HTTP/1.1 SERVER ───────────────────────────────────────────────────
+class HttpServer:
+    """
+    Just enough HTTP for Telegram and the front: Content-Length bodies,
+    keep-alive. handle(method, path, headers, body) -> (status, body).
+    """
+    def __init__(self, handle):
+        self.handle = handle; self.inflight = 0
+        self.draining = False; self.server = None
+
+    async def start(self, port: int):
+        self.server = await asyncio.start_server(self._conn, "0.0.0.0", port)
+        return self
+
+    async def _conn(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                method, path, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (h := await reader.readline()).strip():
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                size = int(headers.get("content-length") or 0)
+                if size > MAX_BODY: status, out = 413, b""
+                else:
+                    body = await reader.readexactly(size)
+                    self.inflight += 1
+                    try: status, out = await self.handle(method, path.split("?")[0], headers, body)
+                    except Exception:
+                        log.exception("%s %s failed", method, path); status, out = 503, b""
+                    finally: self.inflight -= 1
+                writer.write(f"HTTP/1.1 {status} {REASON.get(status,'')}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(out)}\r\n\r\n"
+                             .encode() + out)
+                await writer.drain()
+                if status == 413 or headers.get("connection","").lower() == "close": break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """Stop listening, answer 503 on open connections, wait for in-flight requests."""
+        self.draining = True
+        if self.server: self.server.close()
+        end = asyncio.get_running_loop().time() + timeout
+        while self.inflight and asyncio.get_running_loop().time() < end:
+            await asyncio.sleep(.05)
+
+def _stop_event() -> asyncio.Event:
+    ev = asyncio.Event(); loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT): loop.add_signal_handler(sig, ev.set)
+    return ev
+
+# ─── SHARDING ───────────────────────────────────────────────────────────────
+def chat_of(update: dict) -> int:
+    """Chat id an update belongs to (the user id for inline/pre-checkout queries)."""
+    for v in update.values():
+        if not isinstance(v, dict): continue
+        chat = v.get("chat") or (v.get("message") or {}).get("chat")
+        if chat: return chat["id"]
+        user = v.get("from") or v.get("user")
+        if user: return user["id"]
+    return 0
+
+def ranked(chat: int, workers: list[str]) -> list[str]:
+    """Workers by rendezvous score for chat; [0] owns it, [1] takes over if it leaves."""
+    score = lambda w: hashlib.blake2b(f"{w}|{chat}".encode(), digest_size=8).digest()
+    return sorted(workers, key=score, reverse=True)
+
+async def resolve(spec: str = WORKERS) -> list[str]:
+    """Every ip:port the WORKERS entries resolve to (compose: one A record per replica)."""
+    loop = asyncio.get_running_loop(); out = set()
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        host, _, port = entry.rpartition(":")
+        try:
+            for *_, addr in await loop.getaddrinfo(host, int(port), type=socket.SOCK_STREAM):
+                out.add(f"{addr[0]}:{port}")
+        except OSError as e:
+            log.warning("resolve %s: %s", entry, e)
+    return sorted(out)
+
+# ─── FRONT ──────────────────────────────────────────────────────────────────
+class Front:
+    def __init__(self):
+        self.workers: list[str] = []
+        self.client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(
+            max_connections=WEBHOOK_CONN * 2, max_keepalive_connections=WEBHOOK_CONN))
+        self.http = HttpServer(self.handle)
+
+    async def refresh(self):
+        while True:
+            workers = await resolve()
+            if workers and workers != self.workers:
+                log.info("workers: %s", ", ".join(workers)); self.workers = workers
+            await asyncio.sleep(WORKER_REFRESH)
+
+    async def handle(self, method, path, headers, body):
+        if path == "/healthz":
+            return (503 if self.http.draining or not self.workers else 200), b"{}"
+        if method != "POST" or path != WEBHOOK_PATH: return 404, b""
+        if WEBHOOK_SECRET and headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return 403, b""
+        if self.http.draining: return 503, b""
+        try: chat = chat_of(json.loads(body))
+        except (ValueError, AttributeError, KeyError, TypeError): return 400, b""
+        for w in ranked(chat, self.workers)[:2]:
+            try:
+                r = await self.client.post(f"http://{w}/update", content=body,
+                                           headers={"Content-Type": "application/json"})
+            except httpx.TransportError as e:
+                log.warning("worker %s: %s", w, e); continue
+            if r.status_code != 503: return r.status_code, b""
+        return 503, b""                    # Telegram redelivers later
+
+    async def set_webhook(self):
+        r = await self.client.post(f"{TELEGRAM_API_BASE}{TELEGRAM_TOKEN}/setWebhook", json={
+            "url": WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, "secret_token": WEBHOOK_SECRET or None,
+            "max_connections": WEBHOOK_CONN})
+        r.raise_for_status(); log.info("webhook set to %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+    async def run(self):
+        stop = _stop_event()
+        self.workers = await resolve()
+        refresher = asyncio.create_task(self.refresh())
+        await self.http.start(FRONT_PORT)
+        log.info("front on :%s → %s", FRONT_PORT, WORKERS)
+        if WEBHOOK_URL: await self.set_webhook()
+        await stop.wait()
+        log.info("draining front")
+        await self.http.drain()
+        refresher.cancel(); await self.client.aclose()
+
+# ─── WORKER ─────────────────────────────────────────────────────────────────
+async def run_worker(app, port: int = WORKER_PORT):
+    """
+    Run a PTB Application (built with .updater(None)) behind the front:
+    POST /update queues the update, SIGTERM drains and shuts down.
+    """
+    from telegram import Update
+    stop = _stop_event()
+
+    async def handle(method, path, headers, body):
+        if path == "/healthz": return (503 if http.draining else 200), b"{}"
+        if method != "POST" or path != "/update": return 404, b""
+        if http.draining: return 503, b""
+        try: update = Update.de_json(json.loads(body), app.bot)
+        except ValueError: return 400, b""
+        await app.update_queue.put(update)
+        return 200, b"{}"
+
+    http = HttpServer(handle)
+    await app.initialize()
+    if app.post_init: await app.post_init(app)
+    await app.start()
+    await http.start(port)
+    log.info("worker on :%s", port)
+    await stop.wait()
+    log.info("draining worker")
+    await http.drain()
+    try: await asyncio.wait_for(app.stop(), DRAIN_TIMEOUT)   # finishes queued updates
+    except asyncio.TimeoutError: log.warning("updates still running after %ss", DRAIN_TIMEOUT)
+    if getattr(app, "post_stop", None): await app.post_stop(app)
+    await app.shutdown()
+    if app.post_shutdown: await app.post_shutdown(app)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s | %(message)s")
+    asyncio.run(Front().run())